@@ -36,6 +36,8 @@
 // Links defined in the grid HTML template:
 
 // var grid_info_url = "/streampunk/api/grid/<pk>/";
+// var grid_moves_url = "/streampunk/api/grid/<pk>/moves/";
+// var changes_url = "/streampunk/api/changes/?grid=<pk>";
 // var room_info_url = "/streampunk/api/rooms/";
 // var can_drag = true;
 // var draggable_class = "draggable";
@@ -622,10 +624,11 @@ function placeitem(iid) {
   var item = items[iid];
   var room = item.room;
   for (var slotnum in item.slots) {
-    var slot = item.slots[slotnum];
     // The item can cover several slots, and they might not be slots
-    // that are in this grid.
-    if (slots[slot]) {
+    // that are in this grid - even if they have the same names as
+    // ones that are, on another day - so they're matched by id.
+    var slot = slotids[item.slots[slotnum]];
+    if (slot !== undefined) {
       var key = normkey(room, slot);
       var divid = itemid(iid, slot);
       var cls = itemclass(iid);
@@ -713,25 +716,58 @@ function moveditem(newitem) {
   placeitem(newitem.id);
 }
 
+// Drags are sent to the server in batches, so that rearranging
+// a grid doesn't mean a request per item. Each drop waits a
+// moment for more before sending them all.
+var pending_moves = [];
+var pending_timer = null;
+
 // We've dragged an item to a new location, so update its state to
 // reflect that.
 function moveitem(iid, room, slot) {
-  var newitem = {
-    "id": iid,
+  pending_moves.push({
+    "item": iid,
     "room": rooms[room],
     "start": slots[slot]
-  };
-  // This is failing because we're omitting the csrf token.
-  $.ajax(items[iid].api, {
+  });
+  if (pending_timer)
+    clearTimeout(pending_timer);
+  pending_timer = setTimeout(sendmoves, 500);
+}
+
+function sendmoves() {
+  var moves = pending_moves;
+  pending_moves = [];
+  pending_timer = null;
+  $.ajax(grid_moves_url, {
      "dataType": "json",
-     "type": "PUT",
-     "data": newitem, 
+     "type": "POST",
+     "contentType": "application/json",
+     "data": JSON.stringify({ "moves": moves }),
      "headers": { "X-CSRFToken": csrf_token },
-     "success": moveditem,
+     "success": movedall,
      "error": jserror
   });
 }
 
+// The server's sent back the whole grid after the moves, and
+// the clashes they caused, so re-draw the items that are still
+// in the grid.
+function movedall(data) {
+  var gitems = data.grid.items;
+  for (var i = 0; i < gitems.length; i++) {
+    unplaceitem(gitems[i].id);
+    moveditem(gitems[i]);
+  }
+  if (data.clashes.length > 0) {
+    var msg = "Clashes:";
+    for (var j = 0; j < data.clashes.length; j++) {
+      msg += "\n" + data.clashes[j].text;
+    }
+    alert(msg);
+  }
+}
+
 var draggable_config = {
     // Make sure dragged things are at front.
     zIndex: 1,
@@ -817,7 +853,7 @@ function mkitem(item) {
   var api = item.api;
   var islots = [];
   for (var i = 0; i < item.slots.length; i++) {
-    islots.push(item.slots[i].startText);
+    islots.push(item.slots[i].id);
   }
   items[id] = {
      "title": title,
@@ -834,6 +870,63 @@ function mkitems() {
   }
 }
 
+// Other people may be editing the grid at the same time, so we
+// keep asking the server what's changed since we last looked,
+// and re-draw just those items. A change can be committed after
+// one that's numbered later, so each time we look a few changes
+// further back than the last version we saw; redrawing an item
+// that hasn't changed again does no harm.
+var change_version = null;
+var change_overlap = 20;
+
+function pollchanges() {
+  var params = { };
+  if (change_version !== null) {
+    // The version is "ChangeLog id.count"; it's the id we go back from.
+    var parts = change_version.split(".");
+    params = { "since": Math.max(0, parseInt(parts[0], 10) - change_overlap) + "." + parts[1] };
+  }
+  $.ajax(changes_url, {
+     "dataType": "json",
+     "data": params,
+     "success": gotchanges,
+     "error": function() { setTimeout(pollchanges, 10000); }
+  });
+}
+
+function gotchanges(data) {
+  if (change_version !== null) {
+    if (data.reload) {
+      // We can't tell which items changed, so fetch them all again.
+      $.getJSON(grid_info_url, "", redrawitems);
+    } else {
+      for (var i = 0; i < data.items.length; i++) {
+        unplaceitem(data.items[i].id);
+        moveditem(data.items[i]);
+      }
+      // Items that have gone, or moved off this grid.
+      var gone = data.deleted.concat(data.elsewhere);
+      for (var j = 0; j < gone.length; j++) {
+        unplaceitem(gone[j]);
+        delete items[gone[j]];
+      }
+    }
+  }
+  change_version = data.version;
+  setTimeout(pollchanges, 5000);
+}
+
+function redrawitems(data) {
+  for (var iid in items) {
+    unplaceitem(iid);
+  }
+  items = { };
+  gridinfo = data;
+  mkitems();
+  filltable(lastkeyfn);
+  setup_dragging();
+}
+
 // Steps (c) and (d)
 function allinfofetched() {
   // Create shorthand arrays
@@ -842,6 +935,8 @@ function allinfofetched() {
   mkitems();
   // Populate our table
   roomxslot_table();
+  // And keep it up to date.
+  pollchanges();
 }
 
 // Step (b) part II - invoked when the grid info is received.
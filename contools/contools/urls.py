@@ -53,7 +53,8 @@ from streampunk.views import name_cards_for_item, name_cards
 from streampunk.views import drinks_form_for_item, drinks_forms
 from streampunk.views import door_listing_for_room_and_day, door_listings
 from streampunk.views import door_listings_for_room, door_listings_for_day
-from streampunk.views import api_grid, api_slot_items, api_item, api_rooms
+from streampunk.views import api_grid, api_grid_moves, api_slot_items, api_item, api_rooms, api_changes
+from streampunk.views import api_jobs, api_job, job_file, make_artifact
 from streampunk.views import drag_grid
 
 # Uncomment the next two lines to enable the admin:
@@ -279,11 +280,17 @@ urlpatterns = patterns('',
     url(r'^streampunk/door_listing_for_room/(?P<rpk>\d+)/day/(?P<dpk>\d+)/$', door_listing_for_room_and_day, name='door_listing_for_room_and_day'),
     url(r'^streampunk/door_listings/$', door_listings, name='door_listings'),
     url(r'^streampunk/drag/(?P<gr>\d+)/$', drag_grid, name='drag_grid'),
+    url(r'^streampunk/make/(?P<kind>\w+)/$', make_artifact, name='make_artifact'),
+    url(r'^streampunk/job/(?P<pk>\d+)/file/$', job_file, name='job_file'),
 )
 
 apipatterns = patterns('',
     url(r'^api/grid/(?P<pk>\d+)/$', api_grid.as_view(), name='api_grid'),
+    url(r'^api/grid/(?P<pk>\d+)/moves/$', api_grid_moves.as_view(), name='api_grid_moves'),
     url(r'^api/rooms/$', api_rooms.as_view(), name='api_rooms'),
+    url(r'^api/changes/$', api_changes.as_view(), name='api_changes'),
+    url(r'^api/jobs/(?P<kind>\w+)/$', api_jobs.as_view(), name='api_jobs'),
+    url(r'^api/job/(?P<pk>\d+)/$', api_job.as_view(), name='api_job'),
     url(r'^api/item/(?P<pk>\d+)/$', api_item.as_view(), name='api_item'),
     url(r'^api/slot_items/(?P<pk>\d+)/$', api_slot_items.as_view(), name='api_slot_items'),
 )
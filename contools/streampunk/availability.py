@@ -0,0 +1,96 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Bulk availability lookups, for checking the whole programme at once.
+
+Availability is held as slot bitmasks (see models.slot_mask). An Availability
+loads the slot layout once, and then works out which slots an item or a room
+assignment covers without going back to the database, so the availability
+checks can do all their work in memory.
+"""
+
+from bisect import bisect_left
+
+from .models import Slot, ConInfoBool, slot_mask
+
+class Availability(object):
+  def __init__(self):
+    self.no_avail_means_always_avail = ConInfoBool.objects.no_avail_means_always_avail()
+    # For each day, the slot starts in order, and a running OR of their bits,
+    # so that the mask for a run of slots is two bisections and an XOR. The
+    # slots on all the con's days are also kept together, under None, by their
+    # slot_minute(), for things with a startMin and endMin - which can run
+    # past midnight.
+    days = {}
+    for (day, date, undefined, start, order) in Slot.objects.values_list('day', 'day__date', 'day__isUndefined', 'start', 'order'):
+      days.setdefault(day, []).append((start, order))
+      if not undefined:
+        days.setdefault(None, []).append((date.toordinal() * 24 * 60 + start, order))
+    self.starts = {}
+    self.prefix = {}
+    for day, slots in days.items():
+      slots.sort()
+      self.starts[day] = [ start for (start, order) in slots ]
+      prefix = [ 0 ]
+      for (start, order) in slots:
+        prefix.append(prefix[-1] | slot_mask([ order ]))
+      self.prefix[day] = prefix
+
+  def span_mask(self, day, start, end):
+    """
+    Return the mask of the slots on the day that start at or after start, and
+    before end. If day is None, start and end are in slot_minute() terms.
+    """
+    starts = self.starts.get(day)
+    if not starts:
+      return 0
+    prefix = self.prefix[day]
+    return prefix[bisect_left(starts, end)] & ~prefix[bisect_left(starts, start)]
+
+  def item_mask(self, item):
+    "The mask of the slots an item occupies - as Item.slots()."
+    if item.startMin is not None:
+      return self.span_mask(None, item.startMin, item.endMin)
+    return self.span_mask(item.start.day_id, item.start.start, item.start.start + item.length.length)
+
+  def assignment_mask(self, assignment):
+    "The mask of the slots a room assignment occupies - as KitRoomAssignment.slots()."
+    if assignment.startMin is not None:
+      return self.span_mask(None, assignment.startMin, assignment.endMin)
+    return self.span_mask(assignment.fromSlot.day_id, assignment.fromSlot.start,
+                          assignment.toSlot.start + assignment.toLength.length)
+
+  def masks(self, model, ids=None):
+    """
+    Return a dict of availability masks for a Person, Room or KitThing model,
+    keyed by id, from a single query on the availability table. Things with
+    no availability don't appear. ids, if given, may be a list or a queryset.
+    """
+    field = model._meta.get_field('availability')
+    owner = field.m2m_field_name()
+    rows = field.rel.through.objects.all()
+    if ids is not None:
+      rows = rows.filter(**{ "%s__in" % (owner,): ids })
+    masks = {}
+    for (oid, order) in rows.values_list(owner, '%s__order' % (field.m2m_reverse_field_name(),)):
+      masks[oid] = masks.get(oid, 0) | slot_mask([ order ])
+    return masks
+
+  def covers(self, avail, needed):
+    "True if the availability mask covers all the needed slots."
+    if avail == 0 and self.no_avail_means_always_avail:
+      return True
+    return (needed & ~avail) == 0
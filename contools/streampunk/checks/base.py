@@ -17,10 +17,12 @@ from ..models import Check, CheckResult
 from ..models import Person, Item
 
 class CheckOutput:
-  def __init__(self, check, things):
+  def __init__(self, check, things, elapsed=None, queries=None):
     self.check = check
     self.things = things
     self.count = len(things)
+    self.elapsed = elapsed
+    self.queries = queries
     self.template = "streampunk/checks/%s.html" % (check.module,)
     self.person_list = check.result.name == 'Person List'
     self.item_list = check.result.name == 'Item List'
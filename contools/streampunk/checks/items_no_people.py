@@ -13,9 +13,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db.models import Count
 from .base import CheckOutput
-from ..models import Item, ItemPerson, Person
+from ..snapshot import ProgrammeSnapshot
 
-def run_check(check):
-  return CheckOutput(check, Item.objects.annotate(num_people=Count('people')).filter(num_people=0))
+needs = ('itempeople',)
+
+def find_problems(snapshot):
+  "Items which have no people on them."
+  return [ i for i in snapshot.items if not snapshot.people_on[i.id] ]
+
+def run_check(check, snapshot=None):
+  return CheckOutput(check, find_problems(snapshot or ProgrammeSnapshot(needs=needs)))
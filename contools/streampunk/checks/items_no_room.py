@@ -14,7 +14,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from .base import CheckOutput
-from ..models import Item, Room
+from ..snapshot import ProgrammeSnapshot
 
-def run_check(check):
-  return CheckOutput(check, Item.objects.filter(room=Room.objects.find_undefined()))
+needs = ('items',)
+
+def find_problems(snapshot):
+  "Items that are not assigned to a real room yet."
+  return [ i for i in snapshot.items if i.room_id == snapshot.undefined_room ]
+
+def run_check(check, snapshot=None):
+  return CheckOutput(check, find_problems(snapshot or ProgrammeSnapshot(needs=needs)))
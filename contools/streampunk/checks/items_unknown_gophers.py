@@ -14,7 +14,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from .base import CheckOutput
-from ..models import Item
+from ..snapshot import ProgrammeSnapshot
 
-def run_check(check):
-  return CheckOutput(check, Item.objects.filter(gophers=-1))
+needs = ('items',)
+
+def find_problems(snapshot):
+  "Items for which the gopher count is -1."
+  return [ i for i in snapshot.items if i.gophers == -1 ]
+
+def run_check(check, snapshot=None):
+  return CheckOutput(check, find_problems(snapshot or ProgrammeSnapshot(needs=needs)))
@@ -13,15 +13,19 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db.models import Count
 from .base import CheckOutput
-from ..models import Item, Room
+from ..snapshot import ProgrammeSnapshot
 
-def run_check(check):
+needs = ('kit_satisfaction',)
+
+def find_problems(snapshot):
   """
   To find the items with unsatisfied kit requests, we need to find the items that:
   - have kit requests
   - but do not have kit-thing-item-assignments that satisfy the request
   - and are not in rooms that have kit-thing-room-assignments that satisfy the request
   """
-  return CheckOutput(check, [ i for i in Item.objects.all() if i.has_unsatisfied_kit_requests() ])
+  return [ ks.item for ks in snapshot.kit_satisfaction if not ks.satisfied ]
+
+def run_check(check, snapshot=None):
+  return CheckOutput(check, find_problems(snapshot or ProgrammeSnapshot(needs=needs)))
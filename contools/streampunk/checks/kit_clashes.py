@@ -13,45 +13,24 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db.models import Count
 from .base import CheckOutput
-from ..models import Item, KitItemAssignment, KitRoomAssignment, Room
+from ..snapshot import ProgrammeSnapshot
+from ..timeline import KitOccupancy
 
-def run_check(check):
-  # We want the items that overlap (a.start <= b.end and b.start <= a.end)
-  # and which have the same item assigned to them.
+needs = ('kit',)
+
+def find_problems(snapshot):
+  # We want the items that overlap (a.start < b.end and b.start < a.end)
+  # and which have the same kit thing assigned to them.
   # Also want items with kit assigned to them which overlaps with when same kit is
   # assigned to a room (which is not the room the item's in).
-  # Also rooms where the same item is assigned concurrently.
-
-  things = []
-
-  kititems = KitItemAssignment.objects.all()
-  kitrooms = KitRoomAssignment.objects.all()
-
-  # Look for the same kithing assigned to overlapping items
-
-  for kasx in kititems:
-    for kasy in kititems:
-      if not (kasx == kasy) and (kasx.thing == kasy.thing):
-        if kasx.item.overlaps(kasy.item):
-          things.append((kasx, kasy))
-
-  # Look for rooms that have concurrent assignments
-
-  for krax in kitrooms:
-    for kray in kitrooms:
-      if not (krax == kray) and (krax.thing == kray.thing):
-        if krax.overlaps_room_assignment(kray):
-          things.append((krax, kray))
-
-  # Look for the same kit thing assigned to a room and item concurrently
+  # Also rooms where the same thing is assigned concurrently.
+  # Things inside bundles count as well as things assigned directly.
+  return list(KitOccupancy.build(snapshot).clashes())
 
-  for kra in kitrooms:
-    for kas in kititems:
-      if kra.thing == kas.thing and not (kas.item.room == kra.room):
-        if kra.overlaps(kas.item):
-          things.append((kra, kas))
+def subject(problem):
+  "Clashes are filed under the kit thing, for problems.py."
+  return problem[2]
 
-  # First part: Only interested in scheduled items that actually have kit things assigned
-  return CheckOutput(check, things)
+def run_check(check, snapshot=None):
+  return CheckOutput(check, find_problems(snapshot or ProgrammeSnapshot(needs=needs)))
@@ -1,5 +1,5 @@
 # This file is part of Streampunk, a Django application for convention programmes
-# Copyright (C) 2014 Stephen Kilbane
+# Copyright (C) 2012-2014 Stephen Kilbane
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU Affero General Public License as
 # published by the Free Software Foundation, either version 3 of the
@@ -13,12 +13,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db.models import Count
 from .base import CheckOutput
-from ..models import KitThing
+from ..snapshot import ProgrammeSnapshot
 
-def run_check(check):
+needs = ('kit', 'availability')
+
+def find_problems(snapshot):
   """
   Return the list of kit things that have no availability defined.
   """
-  return CheckOutput(check, KitThing.objects.all().annotate(num_availability=Count('availability')).filter(num_availability=0))
+  return [ t for t in snapshot.things if t.id not in snapshot.thing_masks ]
+
+def run_check(check, snapshot=None):
+  return CheckOutput(check, find_problems(snapshot or ProgrammeSnapshot(needs=needs)))
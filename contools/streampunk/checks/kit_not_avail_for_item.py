@@ -1,5 +1,5 @@
 # This file is part of Streampunk, a Django application for convention programmes
-# Copyright (C) 2014 Stephen Kilbane
+# Copyright (C) 2012-2014 Stephen Kilbane
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU Affero General Public License as
 # published by the Free Software Foundation, either version 3 of the
@@ -13,20 +13,28 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db.models import Count
 from .base import CheckOutput
-from ..models import Item, KitThing, KitItemAssignment, ConInfoBool
+from ..snapshot import ProgrammeSnapshot
 
-def run_check(check):
+needs = ('kit', 'availability')
+
+def find_problems(snapshot):
   """
   List of KitThings which are not available for items to which they've been scheduled.
   """
   things = []
 
   # Only interested in scheduled items
-  items = Item.scheduled.all()
-  for item in items:
-    for kt in item.kit.all():
-      if not kt.available_for(item):
-        things.append((item, kt))
-  return CheckOutput(check, things)
+  avail = snapshot.availability
+  for kia in snapshot.kit_item_assignments:
+    if kia.item_id in snapshot.scheduled_ids:
+      if not avail.covers(snapshot.thing_masks.get(kia.thing_id, 0), avail.item_mask(kia.item)):
+        things.append((kia.item, kia.thing))
+  return things
+
+def subject(problem):
+  "Problems are filed under the kit thing, for problems.py."
+  return problem[1]
+
+def run_check(check, snapshot=None):
+  return CheckOutput(check, find_problems(snapshot or ProgrammeSnapshot(needs=needs)))
@@ -1,5 +1,5 @@
 # This file is part of Streampunk, a Django application for convention programmes
-# Copyright (C) 2014 Stephen Kilbane
+# Copyright (C) 2012-2014 Stephen Kilbane
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU Affero General Public License as
 # published by the Free Software Foundation, either version 3 of the
@@ -13,18 +13,28 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db.models import Count
 from .base import CheckOutput
-from ..models import Room, KitThing, KitRoomAssignment
+from ..snapshot import ProgrammeSnapshot
 
-def run_check(check):
+needs = ('kit', 'availability')
+
+def find_problems(snapshot):
   """
   List of KitThings which are not available for rooms to which they've been assigned.
   """
   things = []
 
-  # Only interested in scheduled items
-  for kra in KitRoomAssignment.objects.all():
-    if not kra.thing.available_for(kra) or not kra.room.available_for(kra):
+  avail = snapshot.availability
+  for kra in snapshot.kit_room_assignments:
+    needed = avail.assignment_mask(kra)
+    if (   not avail.covers(snapshot.thing_masks.get(kra.thing_id, 0), needed)
+        or not avail.covers(snapshot.room_masks.get(kra.room_id, 0), needed)):
       things.append((kra.room, kra.thing))
-  return CheckOutput(check, things)
+  return things
+
+def subject(problem):
+  "Problems are filed under the kit thing, for problems.py."
+  return problem[1]
+
+def run_check(check, snapshot=None):
+  return CheckOutput(check, find_problems(snapshot or ProgrammeSnapshot(needs=needs)))
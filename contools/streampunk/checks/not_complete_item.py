@@ -14,7 +14,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from .base import CheckOutput
-from ..models import Item
+from ..snapshot import ProgrammeSnapshot
 
-def run_check(check):
-  return CheckOutput(check, Item.objects.exclude(complete='Yes'))
+needs = ('items',)
+
+def find_problems(snapshot):
+  "Items that aren't marked as complete."
+  return [ i for i in snapshot.items if i.complete != 'Yes' ]
+
+def run_check(check, snapshot=None):
+  return CheckOutput(check, find_problems(snapshot or ProgrammeSnapshot(needs=needs)))
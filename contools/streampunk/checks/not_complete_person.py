@@ -14,7 +14,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from .base import CheckOutput
-from ..models import Person
+from ..snapshot import ProgrammeSnapshot
 
-def run_check(check):
-  return CheckOutput(check, Person.objects.exclude(complete='Yes'))
+needs = ('people',)
+
+def find_problems(snapshot):
+  "People who aren't marked as complete."
+  return [ p for p in snapshot.people if p.complete != 'Yes' ]
+
+def run_check(check, snapshot=None):
+  return CheckOutput(check, find_problems(snapshot or ProgrammeSnapshot(needs=needs)))
@@ -13,27 +13,37 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db.models import Count
 from .base import CheckOutput
-from ..models import Item, ItemPerson, Person
+from ..snapshot import ProgrammeSnapshot
+from ..timeline import item_period, overlapping_pairs
 
-def run_check(check):
-  # We want the items that overlap (a.start <= b.end and b.start <= a.end)
+needs = ('itempeople',)
+
+def find_problems(snapshot):
+  # We want the items that overlap (a.start < b.end and b.start < a.end)
   # and which have the same person assigned to them.
   # Result is interesting, because we really want to return an item/person pair here,
   # not just an item.
 
   things = []
 
-  # Only interested in scheduled items that actually have people on them.
-  items = Item.scheduled.all().annotate(num_people=Count('people')).filter(num_people__gt=0)
-  for itemx in items:
-    peoplex = [ ip.person for ip in ItemPerson.objects.filter(item=itemx, role__canClash=True) ]
-    for person in peoplex:
-      # fetch the other items that person is on.
-      person_items = ItemPerson.objects.filter(person=person, role__canClash=True).exclude(item=itemx)
-      for pi in person_items:
-        itemy = pi.item
-        if itemx.overlaps(itemy):
-          things.append((itemx, itemy, person))
-  return CheckOutput(check, things)
+  # Group every clashable assignment on a scheduled item by person, then
+  # sweep each person's items in time order.
+  per_person = {}
+  for ip in snapshot.itempeople:
+    if ip.role.canClash and ip.item_id in snapshot.scheduled_ids:
+      start, end = item_period(ip.item)
+      per_person.setdefault(ip.person_id, (ip.person, []))[1].append((start, end, ip.item))
+
+  for (person, intervals) in per_person.values():
+    for (itemx, itemy) in overlapping_pairs(intervals):
+      things.append((itemx, itemy, person))
+      things.append((itemy, itemx, person))
+  return things
+
+def subject(problem):
+  "Clashes are filed under the person, for problems.py."
+  return problem[2]
+
+def run_check(check, snapshot=None):
+  return CheckOutput(check, find_problems(snapshot or ProgrammeSnapshot(needs=needs)))
@@ -13,12 +13,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db.models import Count
 from .base import CheckOutput
-from ..models import Person
+from ..snapshot import ProgrammeSnapshot
 
-def run_check(check):
+needs = ('people', 'availability')
+
+def find_problems(snapshot):
   """
   Return the list of people who have no availability defined.
   """
-  return CheckOutput(check, Person.objects.all().annotate(num_availability=Count('availability')).filter(num_availability=0))
+  return [ p for p in snapshot.people if p.id not in snapshot.person_masks ]
+
+def run_check(check, snapshot=None):
+  return CheckOutput(check, find_problems(snapshot or ProgrammeSnapshot(needs=needs)))
@@ -13,21 +13,28 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db.models import Count
 from .base import CheckOutput
-from ..models import Item, ItemPerson, Person, ConInfoBool
+from ..snapshot import ProgrammeSnapshot
 
-def run_check(check):
+needs = ('itempeople', 'availability')
+
+def find_problems(snapshot):
   """
   List of people who are not available for items on which they've been scheduled.
   """
   things = []
 
   # Only interested in scheduled items that actually have people on them.
-  items = Item.scheduled.all().annotate(num_people=Count('people')).filter(num_people__gt=0)
-  for itemx in items:
-    peoplex = [ ip.person for ip in ItemPerson.objects.filter(item=itemx, role__canClash=True) ]
-    for person in peoplex:
-      if not person.available_for(itemx):
-        things.append((itemx, person))
-  return CheckOutput(check, things)
+  avail = snapshot.availability
+  for ip in snapshot.itempeople:
+    if ip.role.canClash and ip.item_id in snapshot.scheduled_ids:
+      if not avail.covers(snapshot.person_masks.get(ip.person_id, 0), avail.item_mask(ip.item)):
+        things.append((ip.item, ip.person))
+  return things
+
+def subject(problem):
+  "Problems are filed under the person, for problems.py."
+  return problem[1]
+
+def run_check(check, snapshot=None):
+  return CheckOutput(check, find_problems(snapshot or ProgrammeSnapshot(needs=needs)))
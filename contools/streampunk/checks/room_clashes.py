@@ -13,25 +13,26 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db.models import Count
 from .base import CheckOutput
-from ..models import Item, Room
+from ..snapshot import ProgrammeSnapshot
+from ..timeline import RoomOccupancy
 
-def run_check(check):
-  # We want the items that overlap (a.start <= b.end and b.start <= a.end)
-  # and which have the same room assigned to them.
+needs = ('items',)
+
+def find_problems(snapshot):
+  # We want the items that overlap (a.start < b.end and b.start < a.end)
+  # and which have the same room assigned to them - or where one is in a
+  # room and the other is in one of that room's sub-rooms.
   # Result is interesting, because we really want to return an item/room pair here,
   # not just an item.
 
-  things = []
-
   # Only interested in scheduled items (that eliminates Nowhere) that are in
-  # rooms that participate in clashes.
-  rooms = Room.objects.filter(canClash=True)
-  for r in rooms:
-    items = Item.scheduled.filter(room=r)
-    for itemx in items:
-      for itemy in items:
-        if itemx.overlaps(itemy):
-          things.append((itemx, itemy, r))
-  return CheckOutput(check, things)
+  # rooms that participate in clashes; the occupancy index handles both.
+  return list(RoomOccupancy.build(snapshot).clashes())
+
+def subject(problem):
+  "Clashes are filed under the room, for problems.py."
+  return problem[2]
+
+def run_check(check, snapshot=None):
+  return CheckOutput(check, find_problems(snapshot or ProgrammeSnapshot(needs=needs)))
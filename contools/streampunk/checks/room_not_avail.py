@@ -13,20 +13,27 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db.models import Count
 from .base import CheckOutput
-from ..models import Item, Room
+from ..snapshot import ProgrammeSnapshot
 
-def run_check(check):
+needs = ('items', 'availability')
 
+def find_problems(snapshot):
+  "Items that are scheduled in rooms when the room is unavailable."
   things = []
 
   # Only interested in scheduled items (that eliminates Nowhere) that are in
   # rooms that participate in clashes.
-  rooms = Room.objects.filter(canClash=True)
-  for r in rooms:
-    items = Item.scheduled.filter(room=r)
-    for itemx in items:
-      if not r.available_for(itemx):
-        things.append((itemx, r))
-  return CheckOutput(check, things)
+  avail = snapshot.availability
+  for itemx in snapshot.scheduled_items:
+    if itemx.room.canClash:
+      if not avail.covers(snapshot.room_masks.get(itemx.room_id, 0), avail.item_mask(itemx)):
+        things.append((itemx, itemx.room))
+  return things
+
+def subject(problem):
+  "Problems are filed under the room, for problems.py."
+  return problem[1]
+
+def run_check(check, snapshot=None):
+  return CheckOutput(check, find_problems(snapshot or ProgrammeSnapshot(needs=needs)))
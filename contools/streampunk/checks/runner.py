@@ -0,0 +1,108 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runs a set of checks over a single snapshot of the programme.
+
+The snapshot is loaded once, in this process, with just the parts the checks
+need, and the checks then run in a pool of worker processes. The snapshot
+goes to the workers as they start, and since they're forked, they share it
+rather than each loading their own or having it pickled across, and they
+never touch the database. Each is told which check to run by name.
+
+How many workers to use comes from the STREAMPUNK_CHECK_WORKERS setting,
+defaulting to the number of CPUs; with one worker, or one check, everything
+runs in this process. So does anything run from a thread other than the
+main one - a threaded web server's request handlers, say - since forking a
+process that has other threads running isn't safe.
+"""
+
+import time
+from importlib import import_module
+from multiprocessing import cpu_count
+
+from django.conf import settings
+from django.db import connection
+
+from .base import CheckOutput
+from ..snapshot import ProgrammeSnapshot
+from ..pool import worker_pool, can_fork
+
+# The snapshot, in a worker process; set as the worker starts, and never in
+# the process that runs the checks.
+_worker_snapshot = None
+
+def check_module(check):
+  "Return the module that implements the check."
+  return import_module('streampunk.checks.%s' % (check.module,))
+
+def needs_of(modules):
+  "Return the parts of a ProgrammeSnapshot that the check modules need."
+  needs = set()
+  for module in modules:
+    needs.update(module.needs)
+  return needs
+
+def default_workers():
+  return getattr(settings, 'STREAMPUNK_CHECK_WORKERS', None) or cpu_count()
+
+def counting_queries():
+  "True if the database connection is recording the queries it makes."
+  return bool(connection.use_debug_cursor or (connection.use_debug_cursor is None and settings.DEBUG))
+
+def _timed(module, snapshot):
+  # A check shouldn't need any queries beyond the snapshot's, but count them
+  # if we can, to catch any that do.
+  before = len(connection.queries)
+  started = time.time()
+  things = list(module.find_problems(snapshot))
+  elapsed = time.time() - started
+  queries = len(connection.queries) - before if counting_queries() else None
+  return (things, elapsed, queries)
+
+def _start_worker(snapshot):
+  global _worker_snapshot
+  _worker_snapshot = snapshot
+
+def _run_in_worker(name):
+  return _timed(import_module('streampunk.checks.%s' % (name,)), _worker_snapshot)
+
+def run_checks(checks, snapshot=None, workers=None):
+  """
+  Run the checks over one snapshot of the programme, loading it if not given,
+  and return their CheckOutputs in the same order, each with its elapsed time,
+  and the number of queries it made if the connection is counting them.
+  """
+  checks = list(checks)
+  modules = [ check_module(check) for check in checks ]
+  for check in checks:
+    # CheckOutput needs this; load it now rather than in a worker.
+    check.result
+  if snapshot is None:
+    snapshot = ProgrammeSnapshot(needs=needs_of(modules))
+  workers = min(workers or default_workers(), len(checks))
+
+  if workers <= 1 or not can_fork():
+    results = [ _timed(module, snapshot) for module in modules ]
+  else:
+    pool = worker_pool(workers, _start_worker, (snapshot,))
+    try:
+      results = pool.map(_run_in_worker, [ check.module for check in checks ])
+    finally:
+      pool.close()
+      pool.join()
+
+  return [ CheckOutput(check, things, elapsed, queries)
+           for (check, (things, elapsed, queries)) in zip(checks, results) ]
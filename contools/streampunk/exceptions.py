@@ -31,3 +31,7 @@ class DeleteUndefException(DeleteNeededObjectException):
 class DeleteDefaultException(DeleteNeededObjectException):
   "Deleting the table entry that is the 'default' value - needed by find_default."
   pass
+
+class PublishException(StreampunkException):
+  "A page couldn't be rendered for the static copy of the programme."
+  pass
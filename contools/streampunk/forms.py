@@ -28,6 +28,7 @@ from .models import ItemPerson, Item, Person, Tag, Room, Check, ConDay
 from .models import KitThing, KitBundle, KitRequest, PersonList
 from .models import KitRoomAssignment, KitItemAssignment, UserProfile
 from .models import BundleRoomAssignment, BundleItemAssignment
+from .timeline import RoomOccupancy
 
 class ItemPersonForm(ModelForm):
   fromPerson = forms.BooleanField(required=False, widget=forms.HiddenInput)
@@ -152,13 +153,37 @@ class AddMultipleTagsForm(forms.Form):
   people = forms.ModelMultipleChoiceField(required=False, queryset=Person.objects.all(),
                                         widget=forms.SelectMultiple(attrs={'size':'10'}))
 
-class FillSlotUnschedForm(forms.Form):
-  item = forms.ModelChoiceField(queryset=Item.unscheduled.all(),
-                                widget=forms.Select(attrs={'size':'10'}))
+class FillSlotItemField(forms.ModelChoiceField):
+  "Item chooser that marks the items that would clash if moved into the slot."
+  clashes = frozenset()
 
-class FillSlotSchedForm(forms.Form):
-  item = forms.ModelChoiceField(queryset=Item.scheduled.all(),
-                                widget=forms.Select(attrs={'size':'10'}))
+  def label_from_instance(self, obj):
+    label = super(FillSlotItemField, self).label_from_instance(obj)
+    return label + ' (clashes)' if obj.id in self.clashes else label
+
+class FillSlotForm(forms.Form):
+  """
+  Base for the Fill Slot forms. If given the room and slot being filled,
+  look up each candidate item in the room occupancy index, so that the
+  user can see which ones would clash with what's already there.
+  """
+  def __init__(self, *args, **kwargs):
+    room = kwargs.pop('room', None)
+    slot = kwargs.pop('slot', None)
+    super(FillSlotForm, self).__init__(*args, **kwargs)
+    if room is not None and slot is not None:
+      field = self.fields['item']
+      field.queryset = field.queryset.select_related('length')
+      occupancy = RoomOccupancy.build()
+      field.clashes = frozenset([ i.id for i in field.queryset if occupancy.would_clash(i, room, slot) ])
+
+class FillSlotUnschedForm(FillSlotForm):
+  item = FillSlotItemField(queryset=Item.unscheduled.all(),
+                           widget=forms.Select(attrs={'size':'10'}))
+
+class FillSlotSchedForm(FillSlotForm):
+  item = FillSlotItemField(queryset=Item.scheduled.all(),
+                           widget=forms.Select(attrs={'size':'10'}))
 
 class CheckModelFormSet(BaseModelFormSet):
   """
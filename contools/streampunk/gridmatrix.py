@@ -0,0 +1,132 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A grid laid out as a room x slot matrix, for the grid pages and the grid API.
+"""
+
+from .models import Room, Item, ItemPerson, slot_minute, day_slots_between
+
+def fill_slots(items):
+  """
+  Fill in each item's slots() from a single query for all the slots between
+  the earliest start and the latest end of the items, rather than a query per
+  item. Items on the undefined day are left to work their slots out as usual.
+  """
+  timed = [ i for i in items if i.startMin is not None ]
+  if not timed:
+    return
+  start = min([ i.startMin for i in timed ])
+  end = max([ i.endMin for i in timed ])
+  around = [ (slot_minute(s), s) for s in day_slots_between(start, end).select_related('day') ]
+  for i in timed:
+    i._slots = [ s for (m, s) in around if i.startMin <= m < i.endMin ]
+
+class GridCell(object):
+  """
+  A run of one or more of the grid's slots in a room, all with the same items
+  in them. An item that runs over several slots gets a single cell, spanning
+  them, unless something else clashes with part of it. Empty slots always get
+  a cell of their own.
+  """
+  def __init__(self, room, slot, items):
+    self.room = room
+    self.slots = [ slot ]
+    self.items = items
+
+  @property
+  def slot(self):
+    return self.slots[0]
+
+  @property
+  def span(self):
+    return len(self.slots)
+
+class GridMatrix(object):
+  """
+  Everything needed to draw a grid, loaded in a fixed number of queries: the
+  slots, the items that are on during them (which may have started earlier),
+  and the people on those items. Each item's itempeople() is filled in from
+  what's loaded, so the templates can use it freely.
+
+  by_room is a list of (room, cells) for drawing the grid with a row per room,
+  and by_slot a list of (slot, cells) for a row per slot. In by_slot, a slot's
+  row only has the cells that start in it, since the rest are covered by cells
+  spanning down from earlier rows.
+
+  If public, items that aren't visible are left out. If detail,
+  each item's people and slots() (which may reach outside the grid) are
+  loaded too, for the API.
+  """
+  def __init__(self, grid, rooms=None, public=False, detail=False):
+    self.grid = grid
+    self.slots = list(grid.slots.select_related('day', 'length'))
+    self.rooms = list(Room.objects.all() if rooms is None else rooms)
+    room_ids = set([ r.id for r in self.rooms ])
+
+    # Slots on the undefined day have no time, so nothing is on in them.
+    minutes = dict((s.id, slot_minute(s)) for s in self.slots if not s.day.isUndefined)
+    items = Item.objects.filter(startMin__lte=max(minutes.values() or [0]),
+                                endMin__gt=min(minutes.values() or [0]),
+                                room__in=list(room_ids))
+    if public:
+      items = items.filter(visible=True)
+    if detail:
+      items = items.prefetch_related('people')
+
+    # Which items are on in each (room, slot), following Slot.items().
+    on = {}
+    self.items = []
+    for i in items:
+      here = [ s for s in self.slots if i.startMin <= minutes.get(s.id, -1) < i.endMin ]
+      if here:
+        self.items.append(i)
+      for s in here:
+        on.setdefault((i.room_id, s.id), []).append(i)
+
+    items = dict((i.id, i) for i in self.items)
+    for i in self.items:
+      i._itempeople = []
+    ips = ItemPerson.objects.filter(item__in=items.keys()).select_related('person').order_by('id')
+    for ip in ips:
+      ip.item = items[ip.item_id]
+      ip.item._itempeople.append(ip)
+
+    if detail:
+      # All the slots the items cover, some of which may be outside the grid.
+      fill_slots(self.items)
+
+    self.by_room = []
+    starting = dict((s.id, []) for s in self.slots)
+    for r in self.rooms:
+      cells = []
+      for s in self.slots:
+        here = on.get((r.id, s.id), [])
+        if here and cells and cells[-1].items == here:
+          cells[-1].slots.append(s)
+        else:
+          cells.append(GridCell(r, s, here))
+          starting[s.id].append(cells[-1])
+      self.by_room.append((r, cells))
+    self.by_slot = [ (s, starting[s.id]) for s in self.slots ]
+
+  def cell(self, room, slot):
+    "Returns the cell covering the slot in the room."
+    for (r, cells) in self.by_room:
+      if r.id == room.id:
+        for c in cells:
+          if slot.id in [ s.id for s in c.slots ]:
+            return c
+    return None
@@ -0,0 +1,139 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Making the big PDFs and exports in the background, rather than while the
+browser (and the proxy in front of us) waits.
+
+A page asks for an artifact with job_for(), which returns the Job making it
+from the programme as it now is, starting one if nobody else has. The
+runjobs command picks queued Jobs off the table, one at a time, and writes
+each one's file under the export directory. Once it's done, everyone who
+asked gets the same file, until the programme changes and the next request
+starts a new Job.
+
+A worker notes the time in the Job's touched as it claims it, and again as
+it makes progress. If a worker dies part way, its Job stops being touched,
+and once it's been left for STREAMPUNK_JOB_TIMEOUT seconds (ten minutes by
+default), it's queued again for another worker.
+"""
+
+import os
+import tempfile
+import traceback
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+from .models import Job, Item, Room, ConDay, programme_version
+from .printing import write_namecards, write_drinks_forms, write_door_listings
+from .xmldump import xml_dump
+from .konopas import konopas_js, export_dir
+
+def render_door_listings(out, private, progress):
+  write_door_listings(out, Room.objects.filter(visible=True), ConDay.objects.filter(visible=True))
+
+def render_name_cards(out, private, progress):
+  write_namecards(out, Item.scheduled.filter(visible=True), progress=progress)
+
+def render_drinks_forms(out, private, progress):
+  write_drinks_forms(out, Item.scheduled.filter(visible=True), progress=progress)
+
+def render_xml_dump(out, private, progress):
+  for piece in xml_dump(private):
+    out.write(piece.encode('utf-8'))
+
+def render_konopas(out, private, progress):
+  out.write(konopas_js())
+
+# For each kind of artifact: the file name to send it as, its content type,
+# whether it differs for those who can see private information, and the
+# function that writes it.
+artifacts = {
+  'door_listings': ('doors.pdf',      'application/pdf',  False, render_door_listings),
+  'name_cards':    ('namecards.pdf',  'application/pdf',  False, render_name_cards),
+  'drinks_forms':  ('drinks.pdf',     'application/pdf',  False, render_drinks_forms),
+  'xml_dump':      ('streampunk.xml', 'application/xml',  True,  render_xml_dump),
+  'konopas':       ('konopas.js',     'application/json', False, render_konopas),
+}
+
+def requeue_stale():
+  "Queue again the running Jobs whose workers haven't touched them for too long."
+  timeout = timedelta(seconds=getattr(settings, 'STREAMPUNK_JOB_TIMEOUT', None) or 600)
+  Job.objects.filter(status='running', touched__lt=datetime.now() - timeout).update(status='queued', progress=0)
+
+def job_for(kind, private):
+  """
+  Return the Job making kind from the programme as it now is, starting one
+  if there isn't one already. One that failed, or whose file has gone, is
+  queued again, as is one whose worker seems to have died.
+  """
+  requeue_stale()
+  private = private and artifacts[kind][2]
+  key = "%s-%s-%s" % (kind, 'private' if private else 'public', programme_version()[0])
+  (job, created) = Job.objects.get_or_create(key=key, defaults={ "kind": kind, "private": private })
+  if job.status == 'failed' or (job.status == 'done' and not os.path.exists(job.path)):
+    Job.objects.filter(id=job.id, status=job.status).update(status='queued', progress=0, error='')
+    job = Job.objects.get(id=job.id)
+  return job
+
+def claim_job():
+  """
+  Return the oldest queued Job, marked as running, or None if there aren't
+  any. If several workers go for the same Job, only one gets it.
+  """
+  requeue_stale()
+  for jid in Job.objects.filter(status='queued').order_by('id').values_list('id', flat=True)[:10]:
+    if Job.objects.filter(id=jid, status='queued').update(status='running', progress=0, touched=datetime.now()):
+      return Job.objects.get(id=jid)
+  return None
+
+def jobs_dir():
+  path = os.path.join(export_dir(), 'jobs')
+  if not os.path.isdir(path):
+    os.makedirs(path)
+  return path
+
+def run_job(job):
+  """
+  Make the Job's file, and mark it done, or failed. Older Jobs for the same
+  artifact, which were made from older versions of the programme, are
+  removed, with their files.
+  """
+  (filename, content_type, varies, render) = artifacts[job.kind]
+  def progress(fraction):
+    Job.objects.filter(id=job.id).update(progress=int(fraction * 100), touched=datetime.now())
+
+  path = os.path.join(jobs_dir(), "%d-%s" % (job.id, filename))
+  (fd, tmp) = tempfile.mkstemp(dir=jobs_dir(), suffix='.tmp')
+  out = os.fdopen(fd, 'wb')
+  try:
+    try:
+      render(out, job.private, progress)
+    finally:
+      out.close()
+    os.rename(tmp, path)
+  except Exception:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+    Job.objects.filter(id=job.id).update(status='failed', error=traceback.format_exc(), finished=datetime.now())
+    return Job.objects.get(id=job.id)
+
+  Job.objects.filter(id=job.id).update(status='done', progress=100, path=path, finished=datetime.now())
+  for old in Job.objects.filter(kind=job.kind, private=job.private, id__lt=job.id, status__in=[ 'done', 'failed' ]):
+    if old.path and os.path.exists(old.path):
+      os.remove(old.path)
+    old.delete()
+  return Job.objects.get(id=job.id)
@@ -0,0 +1,198 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The programme and people for KonOpas (http://konopas.org/), as the
+JavaScript it loads: "var program = [...]; var people = [...];", along
+with the change_version() it was made from, in program_version, to ask for
+changes since.
+
+Attendees' phones fetch it over and over, so it's written once per
+programme_version(), gzipped, to a file under STREAMPUNK_EXPORT_DIR (or the
+temp directory), and that file's served until the programme changes again.
+"""
+
+import os
+import gzip
+import glob
+import tempfile
+from cStringIO import StringIO
+from datetime import date
+
+from django.conf import settings
+from django.utils import simplejson
+from django.db.models import Q
+
+from .models import Item, Person, ItemPerson, Tag, change_version, changes_between
+
+def export_dir():
+  "Where generated exports are kept."
+  path = getattr(settings, 'STREAMPUNK_EXPORT_DIR', None) or os.path.join(tempfile.gettempdir(), 'streampunk-exports')
+  if not os.path.isdir(path):
+    os.makedirs(path)
+  return path
+
+def tags_by(model, ids):
+  "Return { id: [ tag names ] } for the objects of the model, in one query."
+  through = model.tags.through
+  column = model._meta.module_name
+  names = dict(Tag.objects.values_list('id', 'name'))
+  found = dict((oid, []) for oid in ids)
+  for (oid, tid) in through.objects.filter(**{ "%s__in" % (column,): list(ids) }).order_by('id').values_list(column, 'tag'):
+    found[oid].append(names[tid])
+  for tags in found.values():
+    tags.sort()
+  return found
+
+def program_and_people(only_items=None, only_people=None):
+  """
+  Return the KonOpas program and people lists: the visible scheduled items,
+  and everyone, each listing the items they're publicly on. only_items and
+  only_people narrow the lists down to those ids, for a delta.
+  """
+  public = Item.scheduled.filter(visible=True)
+  people = Person.objects.all()
+  itempeople = ItemPerson.objects.filter(visible=True)
+  if only_items is not None:
+    # The people listed may be on items that aren't.
+    public_ids = set(public.values_list('id', flat=True))
+    public = public.filter(id__in=list(only_items))
+    people = people.filter(id__in=list(only_people))
+    itempeople = itempeople.filter(Q(item__in=list(only_items)) | Q(person__in=list(only_people)))
+  items = list(public.select_related('length', 'room'))
+  item_ids = set([ i.id for i in items ])
+  people = list(people)
+  if only_items is None:
+    public_ids = item_ids
+
+  # Who's publicly on which item.
+  on_item = dict((iid, []) for iid in item_ids)
+  prog = dict((p.id, []) for p in people)
+  for ip in itempeople.select_related('person').order_by('id'):
+    if ip.item_id in item_ids:
+      on_item[ip.item_id].append({ "id": unicode(ip.person_id), "name": ip.person.as_badge() })
+    if ip.item_id in public_ids and ip.person_id in prog:
+      prog[ip.person_id].append(unicode(ip.item_id))
+
+  item_tags = tags_by(Item, item_ids)
+  program = []
+  for i in items:
+    (day, minute) = divmod(i.startMin, 1440)
+    program.append({ "id":     unicode(i.id),
+                     "title":  i.title,
+                     "tags":   item_tags[i.id],
+                     "date":   date.fromordinal(day).isoformat(),
+                     "time":   "%02d:%02d" % divmod(minute, 60),
+                     "mins":   unicode(i.length.length),
+                     "loc":    [ i.room.name ],
+                     "people": on_item[i.id],
+                     "desc":   i.blurb })
+
+  person_tags = tags_by(Person, prog.keys())
+  listed = []
+  for p in people:
+    links = {}
+    for (key, value) in (('img', p.headshot), ('url', p.url), ('facebook', p.facebook), ('twitter', p.twitter)):
+      if value:
+        links[key] = value
+    listed.append({ "id":    unicode(p.id),
+                    "name":  [ p.firstName, p.middleName, p.lastName, "" ],
+                    "tags":  person_tags[p.id],
+                    "prog":  prog[p.id],
+                    "links": links,
+                    "bio":   p.pubNotes })
+  return (program, listed)
+
+def konopas_js():
+  "The KonOpas JavaScript, as a string."
+  # The version's read first, so anything that changes meanwhile is in the next delta.
+  version = change_version()
+  (program, people) = program_and_people()
+  return ("var program = %s;\n\nvar people = %s;\n\nvar program_version = %s;\n"
+          % (simplejson.dumps(program, indent=1), simplejson.dumps(people, indent=1), simplejson.dumps(version)))
+
+def konopas_delta(since, upto):
+  """
+  The KonOpas lists of just the items and people that have changed between
+  two change_version()s, with the ids of those deleted, or no longer public.
+  """
+  changes = changes_between(since, upto)
+  (program, people) = program_and_people(changes.items, changes.people)
+  shown = set([ int(i['id']) for i in program ])
+  return { "since":   since,
+           "version": upto,
+           "reload":  changes.reload,
+           "program": program,
+           "people":  people,
+           "deleted": { "program": sorted(changes.deleted | (changes.items - shown)),
+                        "people":  sorted(changes.deleted_people) } }
+
+def gzipped(content):
+  "content, gzipped."
+  buf = StringIO()
+  out = gzip.GzipFile(fileobj=buf, mode='wb')
+  out.write(content)
+  out.close()
+  return buf.getvalue()
+
+def konopas_path(version):
+  # The time's part of the name as well as the version, since a version can
+  # come round again if the database is emptied.
+  (token, when) = version
+  stamp = when.strftime('%Y%m%d%H%M%S%f') if when else 'new'
+  return os.path.join(export_dir(), 'konopas-%s-%s.js.gz' % (token, stamp))
+
+def rewrite_konopas_file(version):
+  """
+  Write the gzipped KonOpas JavaScript for a programme_version(), whether or
+  not it's there already, and return what was written. Older versions are
+  removed, all but the one before this, which someone may still be reading.
+  """
+  path = konopas_path(version)
+  content = gzipped(konopas_js())
+  # Write to a temporary file and rename it into place, so that nobody is
+  # served half a file.
+  (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+  out = os.fdopen(fd, 'wb')
+  try:
+    out.write(content)
+  finally:
+    out.close()
+  os.rename(tmp, path)
+  older = []
+  for old in glob.glob(os.path.join(os.path.dirname(path), 'konopas-*.js.gz')):
+    try:
+      if old != path:
+        older.append((os.path.getmtime(old), old))
+    except OSError:
+      pass
+  for (_, old) in sorted(older, reverse=True)[1:]:
+    try:
+      os.remove(old)
+    except OSError:
+      pass
+  return content
+
+def konopas_file(version):
+  """
+  Return the path of the gzipped KonOpas JavaScript for a programme_version(),
+  writing it first if it isn't there yet. Anyone who finds theirs removed
+  before they could read it, since newer versions have been written, can
+  have it written afresh with rewrite_konopas_file().
+  """
+  path = konopas_path(version)
+  if not os.path.exists(path):
+    rewrite_konopas_file(version)
+  return path
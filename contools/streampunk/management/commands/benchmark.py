@@ -0,0 +1,162 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse, resolve
+from django.contrib.auth.models import User
+from django.db import connection, reset_queries
+from django.db.models import Count
+from django.test.client import RequestFactory
+from django.utils import simplejson
+
+from ...models import Grid, Item, Person, Room, ConDay, Check
+from ...snapshot import ProgrammeSnapshot
+from ...checks.runner import check_module
+from ...problems import rebuild, results
+
+def pages():
+  "The (name, url) of each of the heavier pages, for whatever's in the database."
+  found = [ ('items',         reverse('list_items')),
+            ('items-tech',    reverse('list_items_tech')),
+            ('people',        reverse('list_people')),
+            ('rooms',         reverse('list_rooms')),
+            ('kitthings',     reverse('list_kitthings')),
+            ('kitrequests',   reverse('list_kitrequests')),
+            ('kit-usage',     reverse('kit_usage')),
+            ('xml-dump',      reverse('xml_dump')),
+            ('konopas',       reverse('konopas')),
+            ('name-cards',    reverse('name_cards')),
+            ('drinks-forms',  reverse('drinks_forms')),
+            ('door-listings', reverse('door_listings')),
+            ('api-rooms',     reverse('api_rooms')) ]
+  for grid in Grid.objects.order_by('id')[:1]:
+    found.append(('grid',      reverse('show_grid', kwargs={ "gr": grid.id })))
+    found.append(('drag-grid', reverse('drag_grid', kwargs={ "gr": grid.id })))
+    found.append(('api-grid',  reverse('api_grid', kwargs={ "pk": grid.id })))
+  for day in ConDay.objects.filter(isUndefined=False).order_by('date')[:1]:
+    found.append(('door-listings-day', reverse('door_listings_for_day', kwargs={ "pk": day.id })))
+  for item in Item.objects.annotate(n=Count('itemperson')).order_by('-n')[:1]:
+    found.append(('item-detail', reverse('show_item_detail', kwargs={ "pk": item.id })))
+  for person in Person.objects.annotate(n=Count('itemperson')).order_by('-n')[:1]:
+    found.append(('person-detail', reverse('show_person_detail', kwargs={ "pk": person.id })))
+  for room in Room.objects.annotate(n=Count('item')).order_by('-n')[:1]:
+    found.append(('room-detail', reverse('show_room_detail', kwargs={ "pk": room.id })))
+  return found
+
+def measure(fn, repeat):
+  "Run fn repeat times. Returns the fastest time, and the number of queries in the last run."
+  best = None
+  for n in range(repeat):
+    reset_queries()
+    started = time.time()
+    fn()
+    elapsed = time.time() - started
+    best = elapsed if best is None else min(best, elapsed)
+  return (best, len(connection.queries))
+
+class Command(BaseCommand):
+  args = '[benchmark ...]'
+  help = """Times the heavy pages and the checks against what's in the database (see
+makecon), and counts their queries. Only runs the named benchmarks, if any
+are given. Compares against a saved baseline, and fails on regressions."""
+
+  option_list = BaseCommand.option_list + (
+    make_option('--user', dest='user', default=None,
+                help='The user to view the pages as. Defaults to the first superuser.'),
+    make_option('--repeat', type='int', dest='repeat', default=3,
+                help='Run each benchmark this many times, and keep the fastest.'),
+    make_option('--baseline', dest='baseline', default=None,
+                help='A JSON file of earlier results to compare against.'),
+    make_option('--save', action='store_true', dest='save', default=False,
+                help='Write the results to the baseline file, rather than comparing them.'),
+    make_option('--tolerance', type='float', dest='tolerance', default=1.5,
+                help='How many times slower than the baseline counts as a regression.'),
+  )
+
+  def benchmarks(self, user):
+    "Yield (name, function) for each benchmark."
+    factory = RequestFactory()
+    def view(url):
+      def fetch():
+        request = factory.get(url)
+        request.user = user
+        request.session = {}
+        match = resolve(url)
+        response = match.func(request, *match.args, **match.kwargs)
+        if hasattr(response, 'render'):
+          response.render()
+        if response.streaming:
+          return sum([ len(piece) for piece in response.streaming_content ])
+        return len(response.content)
+      return fetch
+    for (name, url) in pages():
+      yield ('page:%s' % (name,), view(url))
+
+    checks = list(Check.objects.order_by('name'))
+    snapshot = ProgrammeSnapshot()
+    yield ('snapshot', ProgrammeSnapshot)
+    for check in checks:
+      yield ('check:%s' % (check.module,), lambda module=check_module(check): module.find_problems(snapshot))
+    yield ('checks-rebuild', lambda: rebuild(checks, workers=1))
+    yield ('checks-stored', lambda: results(checks))
+
+  def handle(self, *args, **options):
+    if options['user']:
+      user = User.objects.get(username=options['user'])
+    else:
+      users = User.objects.filter(is_superuser=True).order_by('id')[:1]
+      if not users:
+        raise CommandError("There's no superuser to view the pages as; use --user.")
+      user = users[0]
+
+    baseline = {}
+    if options['baseline'] and not options['save'] and os.path.exists(options['baseline']):
+      baseline = simplejson.load(open(options['baseline']))
+
+    was_debugging = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    found = {}
+    regressions = []
+    try:
+      for (name, fn) in self.benchmarks(user):
+        if args and name not in args:
+          continue
+        (elapsed, queries) = measure(fn, options['repeat'])
+        found[name] = { "elapsed": elapsed, "queries": queries }
+        line = "%-32s %8.3fs %6d queries" % (name, elapsed, queries)
+        if name in baseline:
+          was = baseline[name]
+          line += "   (was %.3fs, %d queries)" % (was['elapsed'], was['queries'])
+          # Ignore small differences in time, which are mostly noise.
+          if (   queries > was['queries']
+              or (elapsed > was['elapsed'] * options['tolerance'] and elapsed - was['elapsed'] > 0.05)):
+            line += "  REGRESSION"
+            regressions.append(name)
+        self.stdout.write(line + "\n")
+    finally:
+      connection.use_debug_cursor = was_debugging
+
+    if options['save']:
+      if not options['baseline']:
+        raise CommandError("--save needs --baseline to say where.")
+      out = open(options['baseline'], 'w')
+      simplejson.dump(found, out, indent=2, sort_keys=True)
+      out.close()
+    if regressions:
+      raise CommandError("Slower than the baseline: %s" % (", ".join(regressions),))
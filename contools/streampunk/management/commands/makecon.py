@@ -0,0 +1,53 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...synthetic import ConGenerator
+
+class Command(BaseCommand):
+  help = """Fills the database with a made-up convention, for testing how things scale.
+Start with a database that has the initial data, but no programme."""
+
+  option_list = BaseCommand.option_list + (
+    make_option('--size', dest='size', default='small',
+                help='How big a con to make: %s. The other options override it.' % (", ".join(sorted(ConGenerator.sizes.keys())),)),
+    make_option('--seed', type='int', dest='seed', default=0,
+                help='The same seed always makes the same con.'),
+    make_option('--items', type='int', dest='items'),
+    make_option('--people', type='int', dest='people'),
+    make_option('--rooms', type='int', dest='rooms'),
+    make_option('--things', type='int', dest='things', help='How many kit things.'),
+    make_option('--bundles', type='int', dest='bundles', help='How many kit bundles.'),
+  )
+
+  def handle(self, *args, **options):
+    if options['size'] not in ConGenerator.sizes:
+      raise CommandError("Unknown size: %s" % (options['size'],))
+    sizes = dict(ConGenerator.sizes[options['size']])
+    for name in sizes.keys():
+      if options.get(name) is not None:
+        sizes[name] = options[name]
+
+    started = time.time()
+    with transaction.commit_on_success():
+      made = ConGenerator(seed=options['seed'], **sizes).generate()
+    for (name, count) in sorted(made.items()):
+      self.stdout.write("%s: %d\n" % (name, count))
+    self.stdout.write("Took %.1fs\n" % (time.time() - started,))
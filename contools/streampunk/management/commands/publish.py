@@ -0,0 +1,50 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...publish import publish
+from ...exceptions import PublishException
+
+class Command(BaseCommand):
+  args = '<directory>'
+  help = """Writes the public programme - grids, item and person pages, door listings,
+KonOpas and the XML dump - as static files under the directory, for a web
+server to serve. Only what's changed since the last run is written again."""
+
+  option_list = BaseCommand.option_list + (
+    make_option('--all', action='store_true', dest='all', default=False,
+                help='Write every page, whether it has changed or not.'),
+  )
+
+  def handle(self, *args, **options):
+    if len(args) != 1:
+      raise CommandError("Say which directory to publish to.")
+    started = time.time()
+    try:
+      publisher = publish(args[0], everything=options['all'])
+    except PublishException as e:
+      raise CommandError(str(e))
+    if int(options['verbosity']) > 1:
+      for path in publisher.written:
+        self.stdout.write("Wrote %s\n" % (path,))
+      for path in publisher.removed:
+        self.stdout.write("Removed %s\n" % (path,))
+    self.stdout.write("%d files written, %d pages removed, in %.3fs\n" % (len(publisher.written),
+                                                                          len(publisher.removed),
+                                                                          time.time() - started))
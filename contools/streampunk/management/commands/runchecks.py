@@ -0,0 +1,92 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import simplejson
+
+from ...models import Check
+from ...snapshot import ProgrammeSnapshot
+from ...checks.runner import run_checks, check_module, needs_of
+from ...problems import rebuild
+
+def describe(obj):
+  return { "kind": obj._meta.module_name, "id": obj.id, "name": unicode(obj) }
+
+def problem_json(problem):
+  "A problem as a list of the objects it's about, whether the check gives one or several."
+  objs = problem if isinstance(problem, tuple) else (problem,)
+  return [ describe(obj) for obj in objs ]
+
+class Command(BaseCommand):
+  args = '[check ...]'
+  help = """Runs the checks, or just the named ones (by name or module), and writes
+the problems they find to stdout as JSON, with the time each check took and
+how many queries it made on stderr. Exits with status 1 if there are any problems."""
+
+  option_list = BaseCommand.option_list + (
+    make_option('--workers', type='int', dest='workers', default=None,
+                help='How many processes to run the checks in. Defaults to the STREAMPUNK_CHECK_WORKERS setting, or the number of CPUs.'),
+    make_option('--store', action='store_true', dest='store', default=False,
+                help='Also replace the problems stored for the checks page with these results.'),
+    make_option('--indent', type='int', dest='indent', default=None,
+                help='Indent the JSON output by this many spaces.'),
+  )
+
+  def handle(self, *args, **options):
+    checks = list(Check.objects.order_by('name'))
+    if args:
+      wanted = set(args)
+      unknown = wanted - set([ c.name for c in checks ]) - set([ c.module for c in checks ])
+      if unknown:
+        raise CommandError("No such check: %s" % (", ".join(sorted(unknown)),))
+      checks = [ c for c in checks if c.name in wanted or c.module in wanted ]
+
+    # Count the queries even when DEBUG is off.
+    was_debugging = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    try:
+      before = len(connection.queries)
+      started = time.time()
+      snapshot = ProgrammeSnapshot(needs=needs_of([ check_module(c) for c in checks ]))
+      self.stderr.write("Loading the programme: %.3fs, %d queries\n" % (time.time() - started,
+                                                                        len(connection.queries) - before))
+      if options['store']:
+        outputs = rebuild(checks, snapshot=snapshot, workers=options['workers'])
+      else:
+        outputs = run_checks(checks, snapshot=snapshot, workers=options['workers'])
+    finally:
+      connection.use_debug_cursor = was_debugging
+
+    total = 0
+    results = []
+    for output in outputs:
+      total += output.count
+      queries = "%d queries" % (output.queries,) if output.queries is not None else "queries not counted"
+      self.stderr.write("%s: %d problems, %.3fs, %s\n" % (output.check.name, output.count, output.elapsed, queries))
+      results.append({ "name":     output.check.name,
+                       "module":   output.check.module,
+                       "count":    output.count,
+                       "elapsed":  output.elapsed,
+                       "queries":  output.queries,
+                       "problems": [ problem_json(p) for p in output.things ] })
+    self.stdout.write(simplejson.dumps({ "checks": results }, indent=options['indent']))
+    self.stdout.write("\n")
+
+    if total:
+      raise CommandError("%d problems found" % (total,))
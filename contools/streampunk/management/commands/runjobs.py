@@ -0,0 +1,46 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ...jobs import claim_job, run_job
+
+class Command(BaseCommand):
+  help = """Makes the PDFs and exports that have been asked for in the background,
+one at a time, as they're queued. Runs until interrupted, unless --once is given."""
+
+  option_list = BaseCommand.option_list + (
+    make_option('--once', action='store_true', dest='once', default=False,
+                help='Stop once there are no more jobs queued, rather than waiting for more.'),
+    make_option('--sleep', type='float', dest='sleep', default=1.0,
+                help='How many seconds to wait between looks at the queue, when it is empty.'),
+  )
+
+  def handle(self, *args, **options):
+    while True:
+      job = claim_job()
+      if job is None:
+        if options['once']:
+          return
+        time.sleep(options['sleep'])
+        continue
+      started = time.time()
+      job = run_job(job)
+      self.stdout.write("%s: %s in %.3fs\n" % (job.key, job.status, time.time() - started))
+      if job.status == 'failed':
+        self.stderr.write(job.error)
@@ -17,13 +17,17 @@
 Models for Streampunk
 """
 
-from datetime import timedelta, datetime
+import operator
+from bisect import bisect_left
+from datetime import date, timedelta, datetime
 from django.db import models
 from django.db.models import Q
 from django import forms
 from django.forms import ModelForm, BooleanField, HiddenInput
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.core.cache import cache
 from django.template.loader import render_to_string
 from django.core.urlresolvers import reverse
 
@@ -49,8 +53,16 @@ item_log_map = {
   'igophers':     { 'text': 'Item gopher count', 'fields': [ 'gophers', ], },
   'istewards':    { 'text': 'Item steward count', 'fields': [ 'stewards', ], },
   'ibudget':      { 'text': 'Item budget', 'fields': [ 'budget', ], },
+  'iblurb':       { 'text': 'Item blurb', 'fields': [ 'blurb', 'pubBring', ], },
   'itech':        { 'text': 'Item tech', 'fields': [ 'projNeeded', 'techNeeded', 'techNotes', 'audienceMics', 'allTechCrew',
                                                      'needsReset', 'needsCleanUp', 'mediaStatus' ], },
+  'ikind':        { 'text': 'Item kind', 'fields': [ 'kind', ], },
+  'ilayout':      { 'text': 'Item seating/layout', 'fields': [ 'seating', 'frontLayout', ], },
+  'irevision':    { 'text': 'Item revision', 'fields': [ 'revision', ], },
+  'iaudience':    { 'text': 'Item expected audience', 'fields': [ 'expAudience', ], },
+  'icomplete':    { 'text': 'Item completeness', 'fields': [ 'complete', ], },
+  'iprivNotes':   { 'text': 'Item privNotes', 'fields': [ 'privNotes', ], },
+  'ifollows':     { 'text': 'Item follows', 'fields': [ 'follows', ], },
 }
 
 itemperson_log_map = {
@@ -59,6 +71,9 @@ itemperson_log_map = {
   'ipitem':       { 'text': 'Person move to another item', 'fields': [ 'item', ], },
   'ipperson':     { 'text': 'Person replaced on item', 'fields': [ 'person', ], },
   'ipvisible':    { 'text': 'Person visibility on item', 'fields': [ 'visible', ], },
+  'iprole':       { 'text': 'Person role on item', 'fields': [ 'role', ], },
+  'ipstatus':     { 'text': 'Person status on item', 'fields': [ 'status', ], },
+  'ipprefs':      { 'text': 'Person distribution/recording on item', 'fields': [ 'distEmail', 'recordingOkay', ], },
 }
 
 kitrequest_log_map = {
@@ -74,6 +89,13 @@ person_log_map = {
   'pemail':       { 'text': 'Person email changed', 'fields': [ 'email', ], },
   'pbadge_only':  { 'text': 'Person badge-only changed', 'fields': [ 'badge_only', ], },
   'pprivNotes':   { 'text': 'Person privNotes changed', 'fields': [ 'privNotes', ], },
+  'pname':        { 'text': 'Person name changed', 'fields': [ 'firstName', 'middleName', 'lastName', 'badge', ], },
+  'ppubNotes':    { 'text': 'Person pubNotes changed', 'fields': [ 'pubNotes', ], },
+  'plinks':       { 'text': 'Person links changed', 'fields': [ 'headshot', 'url', 'facebook', 'twitter', ], },
+  'pgender':      { 'text': 'Person gender changed', 'fields': [ 'gender', ], },
+  'pcontact':     { 'text': 'Person contact changed', 'fields': [ 'contact', ], },
+  'pcomplete':    { 'text': 'Person complete changed', 'fields': [ 'complete', ], },
+  'pprefs':       { 'text': 'Person distribution/recording changed', 'fields': [ 'distEmail', 'recordingOkay', ], },
 }
 
 log_map = dict(item_log_map.items() + itemperson_log_map.items() + kitrequest_log_map.items() + person_log_map.items())
@@ -102,9 +124,26 @@ def model_cmp(old_obj, new_obj, fields):
         old_val = getattr(old_obj, field)
         new_val = getattr(new_obj, field)
         if old_val != new_val:
-          log = ChangeLog(log_id=int(old_obj.id), username=get_current_username(), field=log_key, old_val=str(old_val), new_val=str(new_val))
+          log = ChangeLog(log_id=int(old_obj.id), username=get_current_username(), field=log_key,
+                          old_val=unicode(old_val)[:256], new_val=unicode(new_val)[:256])
           log.save()
-  
+
+def unlogged_change(old_obj, new_obj, fields, derived=()):
+  """
+  True if new_obj differs from old_obj in a field that none of the log
+  entries in fields cover. The derived fields, which follow from ones that
+  are covered, don't count.
+  """
+  if old_obj is None:
+    return False
+  covered = set([ f for log_key in fields.keys() for f in fields[log_key]['fields'] ] + list(derived))
+  for field in old_obj._meta.fields:
+    if field.primary_key or field.name in covered:
+      continue
+    if getattr(old_obj, field.attname) != getattr(new_obj, field.attname):
+      return True
+  return False
+
 
 class DefUndefManager(models.Manager):
   """
@@ -116,15 +155,140 @@ class DefUndefManager(models.Manager):
   def find_undefined(self):
     return self.get(isUndefined=True)
 
+def slot_mask(orders):
+  """
+  Return a bitmask for a set of slots, given their Slot.order values: bit N
+  is set if the slot with order N is in the set. Availability is held this
+  way, so "is this person free for all of this item?" is a single AND.
+  """
+  mask = 0
+  for order in orders:
+    mask |= 1 << order
+  return mask
+
+def slots_mask(slots):
+  "Return the bitmask for a queryset (or list) of slots."
+  if hasattr(slots, 'values_list'):
+    return slot_mask(slots.values_list('order', flat=True))
+  return slot_mask([ s.order for s in slots ])
+
+def slot_minute(slot):
+  """
+  Return the start of a slot in minutes, counted from a fixed point rather than
+  from midnight, so that times on different days compare, and an item that runs
+  past midnight overlaps the first slots of the next day.
+  """
+  return slot.day.date.toordinal() * 24 * 60 + slot.start
+
+def day_slots_between(start, end):
+  "Return a queryset of the slots on the con's days that start at or after start, and before end, in slot_minute() terms."
+  # A slot can start after midnight on the day before (e.g. at 1500), so
+  # look at that day too.
+  first = date.fromordinal(start // (24 * 60) - 1)
+  last = date.fromordinal(max(start, end - 1) // (24 * 60))
+  days = [ first + timedelta(days=n) for n in range((last - first).days + 1) ]
+  within = [ Q(day__date=d, start__gte=start - d.toordinal() * 24 * 60, start__lt=end - d.toordinal() * 24 * 60)
+             for d in days ]
+  return Slot.objects.filter(reduce(operator.or_, within), day__isUndefined=False)
+
+def grid_items_key(grid_id):
+  "The cache key for Grid.item_ids()."
+  return "streampunk-grid-items-%d" % (grid_id,)
+
+def forget_grid_items(start=None, end=None):
+  """
+  Drop the cached item ids of the grids with a slot between start and end
+  (in slot_minute() terms), or of all the grids if no times are given.
+  """
+  grids = Grid.objects.all()
+  if start is not None:
+    grids = grids.filter(slots__in=day_slots_between(start, end)).distinct()
+  cache.delete_many([ grid_items_key(gid) for gid in grids.values_list('id', flat=True) ])
+
+def minute_text(minute):
+  "A slot_minute() as a date and time, for the ChangeLog."
+  if minute is None:
+    return ''
+  return "%s %02d:%02d" % (date.fromordinal(minute // (24 * 60)), (minute % (24 * 60)) // 60, minute % 60)
+
+def refresh_minutes(qs, log=True):
+  """
+  Work out startMin and endMin again for each of the items or room assignments
+  in qs, saving them without going through save(). Used when a slot, length
+  or day they depend on changes, and for fixtures, which skip save().
+
+  Since save() isn't called, neither the ChangeLog nor problems.py would hear
+  about the move, so unless log is false (as for fixtures), each item that's
+  moved gets an istart entry with its old and new times, and the problems of
+  everything moved are marked for working out again.
+  """
+  moved = []
+  for obj in qs:
+    period = obj.period()
+    if period != (obj.startMin, obj.endMin):
+      qs.model.objects.filter(id=obj.id).update(startMin=period[0], endMin=period[1])
+      moved.append((obj, period))
+  if not (moved and log):
+    return
+  if qs.model is Item:
+    username = get_current_username()
+    ChangeLog.objects.bulk_create([ ChangeLog(log_id=obj.id, username=username, field='istart',
+                                              old_val=minute_text(obj.startMin), new_val=minute_text(period[0]))
+                                    for (obj, period) in moved ])
+  subjects = []
+  for (obj, period) in moved:
+    subjects.extend(streampunk.problems.attached_to(qs.model, obj))
+  streampunk.problems.mark(subjects)
+
+# How many times each model's availability has changed in this process, so
+# that the masks cached on its instances can tell when they're out of date.
+avail_generation = {}
+
 def avail_for_slots(avail, slots):
   """
   avail and slots are both querysets of slots. Return true if all of
   the slots listed in slots are also listed in avail, and false otherwise.
   """
-  avail_set = set([ s.id for s in avail ])
-  slots_set = set([ s.id for s in slots ])
-  not_covered = slots_set - avail_set
-  return len(not_covered) == 0
+  return (slots_mask(slots) & ~slots_mask(avail)) == 0
+
+class AvailabilityMixin(object):
+  """
+  For models that have an availability list of slots (people, rooms and kit).
+  The availability is cached on the instance as a slot_mask(), and dropped
+  when the availability of any instance of the model changes, from either
+  side (see forget_avail_mask below).
+  """
+  def avail_mask(self):
+    "Return the bitmask of the slots for which this is available."
+    generation = avail_generation.get(self.__class__, 0)
+    if getattr(self, '_avail_mask', None) is None or self._avail_mask_generation != generation:
+      self._avail_mask = slots_mask(self.availability.all())
+      self._avail_mask_generation = generation
+    return self._avail_mask
+
+  def always_available(self):
+    """
+    Return true if there are no slots where this is not available.
+    If there are no slots listed, then it's a con preference whether that
+    means "always available" or never available".
+    """
+    return self.avail_mask() == 0 and ConInfoBool.objects.no_avail_means_always_avail()
+
+  def never_available(self):
+    """
+    Return true if there are no slots listed, and that should be interpreted
+    as 'never available'.
+    """
+    return self.avail_mask() == 0 and not ConInfoBool.objects.no_avail_means_always_avail()
+
+  def available_for(self, item):
+    """
+    Return true if the item falls entirely within the periods of availability.
+    If there's NO availability listed, that might be a problem, or it might
+    mean it's always available - con preference.
+    NOTE: "item" might actually be a room assignment - anything with slots().
+    """
+    return self.always_available() or (slots_mask(item.slots()) & ~self.avail_mask()) == 0
 
 class ConInfoBoolManager(models.Manager):
   "A manager that knows how to look up certain flags within the database."
@@ -276,19 +440,36 @@ class Slot(models.Model):
   def __unicode__(self):
     return "%s %s" % (self.day, self.startText)
     # return self.startText
+
+  def clean(self):
+    "Availability is held as bits numbered by order, so each slot needs its own, and none can be negative."
+    if self.order is None:
+      return
+    if self.order < 0:
+      raise ValidationError("A slot's order cannot be negative.")
+    if Slot.objects.filter(order=self.order).exclude(id=self.id).exists():
+      raise ValidationError("Another slot already has order %d." % (self.order,))
   def get_absolute_url(self):
     return reverse('show_slot_detail', kwargs={"pk": self.id})
 
   def items(self, room=None):
     """
-    Returns the list of items that are on (but may start earlier) during
-    this slot.
+    Returns the list of items that are on (but may start earlier, even on
+    the day before) during this slot.
     """
-    all = Item.objects.filter(start__day=self.day, start__start__lte=self.start)
+    return list(self.items_on(room))
+
+  def items_on(self, room=None):
+    "The items() as a queryset, so that callers can add select_related() and the like."
+    if self.day.isUndefined:
+      # Times on the undefined day don't mean anything, so the items have no
+      # startMin or endMin; the only items on are those starting here.
+      return self.items_starting(room).exclude(length__length=0)
+    start = slot_minute(self)
+    all = Item.objects.filter(startMin__lte=start, endMin__gt=start)
     if room:
       all = all.filter(room=room)
-    overlaps = [ i for i in all if (self.start < (i.start.start + i.length.length)) ]
-    return overlaps
+    return all
 
   def items_public(self, room=None):
     """
@@ -340,13 +521,36 @@ class Grid(models.Model):
   def tabler_exclude(cls, request):
     return None
 
+  def item_ids(self):
+    """
+    Return the ids of the items on during any of the grid's slots. They're
+    found with one range query over the grid's span, and cached per grid;
+    forget_grid_items() drops the cache when the items in the grid's time
+    window change.
+    """
+    key = grid_items_key(self.id)
+    ids = cache.get(key)
+    if ids is None:
+      minutes = sorted([ slot_minute(s) for s in self.slots.select_related('day') if not s.day.isUndefined ])
+      ids = []
+      if minutes:
+        rows = Item.objects.filter(startMin__lte=minutes[-1], endMin__gt=minutes[0])
+        for (iid, start, end) in rows.values_list('id', 'startMin', 'endMin'):
+          # The grid's slots needn't be consecutive, so check the item's on in one of them.
+          n = bisect_left(minutes, start)
+          if n < len(minutes) and minutes[n] < end:
+            ids.append(iid)
+      cache.set(key, ids)
+    return ids
+
   def items(self):
     "List all the items that appear in this grid."
-    # Is there not a way to union QuerySets?
-    item_set = set([])
-    for slot in self.slots.all():
-      item_set |= set(slot.items())
-    return list(item_set)
+    ids = self.item_ids()
+    items = []
+    for n in range(0, len(ids), 500):
+      items.extend(Item.objects.filter(id__in=ids[n:n+500]))
+    items.sort(key=lambda i: (i.title, i.shortname))
+    return items
 
 class Revision(models.Model):
   """
@@ -596,20 +800,24 @@ class KitSatisfaction(object):
       d[k] += v
     return d
 
-  def __init__(self, i):
+  def __init__(self, i, requests=None, item_kit=None, room_kit=None):
+   """
+   requests, item_kit and room_kit are lists of (KitKind id, count) pairs for what the
+   item asks for, what's assigned to the item, and what's assigned to its room for the
+   duration of the item. If they're not given, they're looked up; use for_items() to
+   look them up for many items at once.
+   """
    self.item = i
+   if requests is None:
+     (requests, item_kit, room_kit) = KitSatisfaction.gather([ i ])[i.id]
 
    # Each of the Map members is a dict, mapping KitKind id onto a count.
    # What the item wants
-   self.requestMap = self.count_things([ (r.kind.id, r.count) for r in self.item.kitRequests.all() ])
+   self.requestMap = self.count_things(requests)
    # What the item provides
-   item_bundles = [ (thing.id, thing.count) for bundle in self.item.bundles.all() for thing in bundle.things_all() ]
-   item_things = [ (kia.thing.kind.id, kia.thing.count) for kia in KitItemAssignment.objects.filter(item=self.item) ]
-   self.itemMap = self.count_things( item_bundles + item_things )
+   self.itemMap = self.count_things(item_kit)
    # What the room provides
-   room_bundles = [ (thing.id, thing.count) for bra in BundleRoomAssignment.objects.filter(room=self.item.room) if bra.covers(self.item) for thing in bra.bundle.things_all() ]
-   room_things = [ (kra.thing.kind.id, kra.thing.count) for kra in KitRoomAssignment.objects.filter(room=self.item.room) if kra.covers(self.item) ]
-   self.roomMap = self.count_things(room_bundles + room_things)
+   self.roomMap = self.count_things(room_kit)
    # Total of the two
    self.totalMap = self.count_things(self.itemMap.items() + self.roomMap.items())
 
@@ -633,6 +841,68 @@ class KitSatisfaction(object):
        self.satisfied = False
        self.missingMap[thing] = count
 
+   # Overall counts: how many things were asked for, how many of those are
+   # provided, and how many are still missing.
+   self.requested = sum(self.requestMap.values())
+   self.missing = sum(self.missingMap.values())
+   self.provided = self.requested - self.missing
+
+  @classmethod
+  def gather(cls, items):
+    """
+    Look up the kit requested by and provided for each of the items, in a fixed
+    number of queries. Returns a dict mapping item id onto (requests, item_kit,
+    room_kit) lists of (KitKind id, count) pairs. Room assignments are checked
+    against the items' startMin and endMin.
+    """
+    ids = [ i.id for i in items ]
+    room_ids = set([ i.room_id for i in items ])
+    requests = dict([ (iid, []) for iid in ids ])
+    item_kit = dict([ (iid, []) for iid in ids ])
+    room_kit = dict([ (iid, []) for iid in ids ])
+
+    bundle_things = {}
+    for (bid, kind, count) in KitBundle.things.through.objects.values_list('kitbundle', 'kitthing__kind', 'kitthing__count'):
+      bundle_things.setdefault(bid, []).append((kind, count))
+
+    for (iid, kind, count) in Item.kitRequests.through.objects.filter(item__in=ids).values_list('item', 'kitrequest__kind', 'kitrequest__count'):
+      requests[iid].append((kind, count))
+    for (iid, bid) in BundleItemAssignment.objects.filter(item__in=ids).values_list('item', 'bundle'):
+      item_kit[iid].extend(bundle_things.get(bid, []))
+    for (iid, kind, count) in KitItemAssignment.objects.filter(item__in=ids).values_list('item', 'thing__kind', 'thing__count'):
+      item_kit[iid].append((kind, count))
+
+    by_room = {}
+    for i in items:
+      by_room.setdefault(i.room_id, []).append(i)
+    bras = BundleRoomAssignment.objects.filter(room__in=room_ids)
+    for bra in bras:
+      for i in by_room[bra.room_id]:
+        if bra.covers(i):
+          room_kit[i.id].extend(bundle_things.get(bra.bundle_id, []))
+    kras = KitRoomAssignment.objects.filter(room__in=room_ids).select_related('thing')
+    for kra in kras:
+      for i in by_room[kra.room_id]:
+        if kra.covers(i):
+          room_kit[i.id].append((kra.thing.kind_id, kra.thing.count))
+
+    return dict([ (iid, (requests[iid], item_kit[iid], room_kit[iid])) for iid in ids ])
+
+  @classmethod
+  def for_items(cls, items):
+    """
+    Work out the satisfaction of many items at once - a queryset, or a list. Returns
+    a list of KitSatisfactions, in the same order, and leaves each one on its item so
+    that Item.kit_satisfaction() and friends don't need to work it out again.
+    """
+    items = list(items)
+    gathered = cls.gather(items)
+    sats = []
+    for i in items:
+      i._kit_satisfaction = cls(i, *gathered[i.id])
+      sats.append(i._kit_satisfaction)
+    return sats
+
   def missing_things(self):
     "Return a list of (KitKind, count) pairs of things we still need for this item"
     return [ (kind, self.missingMap[kind.id]) for kind in KitKind.objects.filter(id__in=self.missingMap.keys()) ]
@@ -720,7 +990,7 @@ class KitRequest(models.Model):
     return super(KitRequest, self).delete()
 
 
-class KitThing(models.Model):
+class KitThing(AvailabilityMixin, models.Model):
   """
   A kit thing is an instance of the physical kit. Or, possible, several instances which
   you're moving around as an indivisible unit. Kit things can be assigned to rooms or
@@ -769,30 +1039,6 @@ class KitThing(models.Model):
   def as_xml(self):
     return render_to_string('xml/kitthing.xml', { "kt": self } )
 
-  def always_available(self):
-    """
-    Return true if there are no slots where the thing is not available.
-    If there are no slots listed, then it's a con preference whether that
-    means "always available" or never available".
-    """
-    return self.availability.count() == 0 and ConInfoBool.objects.no_avail_means_always_avail()
-
-  def never_available(self):
-    """
-    Return true if there are no slots listed, and that should be interpreted
-    as 'never available'.
-    """
-    return self.availability.count() == 0 and not ConInfoBool.objects.no_avail_means_always_avail()
-
-  def available_for(self, item):
-    """
-    Return true if the item falls entirely within one of the kit thing's periods of
-    availability. If the thing has NO availability listed, that might be a problem,
-    or it might mean it's always available - con preference.
-    NOTE: "item" might actually be a Room, not an Item.
-    """
-    return self.always_available() or avail_for_slots(self.availability.all(), item.slots()) 
-
   def in_use(self):
     return self.kitbundle_set.exists() or self.kititemassignment_set.exists() or self.kitroomassignment_set.exists()
   def okay_to_edit(self):
@@ -890,37 +1136,49 @@ class KitRoomAssignment(models.Model):
                              help_text="The last slot for this assignment. The assignment can satisfy items that are in this slot.")
   toLength = models.ForeignKey(SlotLength,
                                help_text="The length of the final slot assignment. At the end of this length, the assignment ends.")
+  startMin = models.IntegerField(null=True, blank=True, editable=False,
+                                 help_text="When the assignment starts, as slot_minute(). Kept up to date from fromSlot.")
+  endMin = models.IntegerField(null=True, blank=True, editable=False,
+                               help_text="When the assignment ends, as slot_minute(). Kept up to date from toSlot and toLength.")
+
+  class Meta:
+    index_together = [ [ 'room', 'startMin', 'endMin' ] ]
 
   def __unicode__(self):
     return u"%s in %s" % (self.thing, self.room)
   def get_absolute_url(self):
     return reverse('show_kitroomassignment_detail', kwargs={"pk": self.id})
 
+  def period(self):
+    "Return the (startMin, endMin) the assignment should have, from its slots and length."
+    if self.fromSlot.day.isUndefined or self.toSlot.day.isUndefined:
+      return (None, None)
+    return (slot_minute(self.fromSlot), slot_minute(self.toSlot) + self.toLength.length)
+
+  def save(self, *args, **kwargs):
+    (self.startMin, self.endMin) = self.period()
+    return super(KitRoomAssignment, self).save(*args, **kwargs)
+
   def starts_before_slot(self, slot, mins):
     """
     Return true if this assignment begins before (or at the same time as) this many minutes
     past the given slot.
     """
-    return (   self.fromSlot.day.date < slot.day.date
-            or (    self.fromSlot.day.date == slot.day.date 
-                and self.fromSlot.start <= slot.start))
+    return self.startMin is not None and self.startMin <= slot_minute(slot)
 
   def finishes_after_slot(self, slot, mins):
     """
     Returns true if the assignment lasts until at least the end of this day/slot.
     """
-    return (   slot.day.date < self.toSlot.day.date
-            or (    slot.day.date == self.toSlot.day.date
-                and (slot.start + mins) <= (self.toSlot.start + self.toLength.length)))
-
+    return self.endMin is not None and slot_minute(slot) + mins <= self.endMin
 
   def starts_before(self, item):
     "True if the assignment starts before the item does."
-    return self.starts_before_slot(item.start, 0)
+    return None not in (self.startMin, item.startMin) and self.startMin <= item.startMin
 
   def finishes_after(self, item):
     "True if the assignment finishes after the item does"
-    return self.finishes_after_slot(item.start, item.length.length)
+    return None not in (self.endMin, item.endMin) and item.endMin <= self.endMin
 
   def covers(self, item):
     "True if the assignment entirely encompasses the period for the item."
@@ -929,16 +1187,18 @@ class KitRoomAssignment(models.Model):
 
   def overlaps(self, item):
     "True if any part of the assignment is concurrent with any part of the item."
-    return (    self.starts_before_slot(item.start, item.length.length)
-            and self.finishes_after_slot(item.start, item.length.length))
+    return (    None not in (self.startMin, item.startMin)
+            and self.startMin < item.endMin and item.startMin < self.endMin)
 
   def overlaps_room_assignment(self, other):
     "True if any part of the assignment is concurrent with the other assignment."
-    return (    self.starts_before_slot(other.toSlot, 0)
-            and self.finishes_after_slot(other.fromSlot, 0))
+    return (    None not in (self.startMin, other.startMin)
+            and self.startMin < other.endMin and other.startMin < self.endMin)
 
   def slots(self):
     "Return a queryset of the slots this assignment occupies"
+    if self.startMin is not None:
+      return day_slots_between(self.startMin, self.endMin)
     return Slot.objects.filter(day=self.fromSlot.day, start__gte=self.fromSlot.start, start__lt=self.toSlot.start+self.toLength.length)
 
   @classmethod
@@ -1005,37 +1265,49 @@ class BundleRoomAssignment(models.Model):
                              help_text="The last slot for this assignment. The assignment can satisfy items that are in this slot.")
   toLength = models.ForeignKey(SlotLength,
                                help_text="The length of the final slot assignment. At the end of this length, the assignment ends.")
+  startMin = models.IntegerField(null=True, blank=True, editable=False,
+                                 help_text="When the assignment starts, as slot_minute(). Kept up to date from fromSlot.")
+  endMin = models.IntegerField(null=True, blank=True, editable=False,
+                               help_text="When the assignment ends, as slot_minute(). Kept up to date from toSlot and toLength.")
+
+  class Meta:
+    index_together = [ [ 'room', 'startMin', 'endMin' ] ]
 
   def __unicode__(self):
     return u"%s in %s" % (self.bundle, self.room)
   def get_absolute_url(self):
     return reverse('show_bundleroomassignment_detail', kwargs={"pk": self.id})
 
+  def period(self):
+    "Return the (startMin, endMin) the assignment should have, from its slots and length."
+    if self.fromSlot.day.isUndefined or self.toSlot.day.isUndefined:
+      return (None, None)
+    return (slot_minute(self.fromSlot), slot_minute(self.toSlot) + self.toLength.length)
+
+  def save(self, *args, **kwargs):
+    (self.startMin, self.endMin) = self.period()
+    return super(BundleRoomAssignment, self).save(*args, **kwargs)
+
   def starts_before_slot(self, slot, mins):
     """
     Return true if this assignment begins before (or at the same time as) this many minutes
     past the given slot.
     """
-    return (   self.fromSlot.day.date < slot.day.date
-            or (    self.fromSlot.day.date == slot.day.date 
-                and self.fromSlot.start <= slot.start))
+    return self.startMin is not None and self.startMin <= slot_minute(slot)
 
   def finishes_after_slot(self, slot, mins):
     """
     Returns true if the assignment lasts until at least the end of this day/slot.
     """
-    return (   slot.day.date < self.toSlot.day.date
-            or (    slot.day.date == self.toSlot.day.date
-                and (slot.start + mins) <= (self.toSlot.start + self.toLength.length)))
-
+    return self.endMin is not None and slot_minute(slot) + mins <= self.endMin
 
   def starts_before(self, item):
     "True if the assignment starts before the item does."
-    return self.starts_before_slot(item.start, 0)
+    return None not in (self.startMin, item.startMin) and self.startMin <= item.startMin
 
   def finishes_after(self, item):
     "True if the assignment finishes after the item does"
-    return self.finishes_after_slot(item.start, item.length.length)
+    return None not in (self.endMin, item.endMin) and item.endMin <= self.endMin
 
   def covers(self, item):
     "True if the assignment entirely encompasses the period for the item."
@@ -1044,16 +1316,18 @@ class BundleRoomAssignment(models.Model):
 
   def overlaps(self, item):
     "True if any part of the assignment is concurrent with any part of the item."
-    return (    self.starts_before_slot(item.start, item.length.length)
-            and self.finishes_after_slot(item.start, item.length.length))
+    return (    None not in (self.startMin, item.startMin)
+            and self.startMin < item.endMin and item.startMin < self.endMin)
 
   def overlaps_room_assignment(self, other):
     "True if any part of the assignment is concurrent with the other assignment."
-    return (    self.starts_before_slot(other.toSlot, 0)
-            and self.finishes_after_slot(other.fromSlot, 0))
+    return (    None not in (self.startMin, other.startMin)
+            and self.startMin < other.endMin and other.startMin < self.endMin)
 
   def slots(self):
     "Return a queryset of the slots this assignment occupies"
+    if self.startMin is not None:
+      return day_slots_between(self.startMin, self.endMin)
     return Slot.objects.filter(day=self.fromSlot.day, start__gte=self.fromSlot.start, start__lt=self.toSlot.start+self.toLength.length)
 
   @classmethod
@@ -1135,7 +1409,7 @@ class RoomCapacity(models.Model):
     return None
 
 
-class Room(models.Model):
+class Room(AvailabilityMixin, models.Model):
   """
   A Room is where a programme item can take place.
   Every item is in some room somewhere, although we
@@ -1211,29 +1485,6 @@ class Room(models.Model):
   def as_xml(self):
    return render_to_string('xml/room.xml', { "r": self } )
 
-  def always_available(self):
-    """
-    Return true if there are no slots where the room is not available.
-    If there are no slots listed, then it's a con preference whether that
-    means "always available" or never available".
-    """
-    return self.availability.count() == 0 and ConInfoBool.objects.no_avail_means_always_avail()
-
-  def never_available(self):
-    """
-    Return true if there are no slots listed, and that should be interpreted
-    as 'never available'.
-    """
-    return self.availability.count() == 0 and not ConInfoBool.objects.no_avail_means_always_avail()
-
-  def available_for(self, item):
-    """
-    Return true if the item falls entirely within one of the room's periods of
-    availability. If the room has NO availability listed, that might be a problem,
-    or it might mean it's always available - con preference.
-    """
-    return self.always_available() or avail_for_slots(self.availability.all(), item.slots())
-
   def items(self, slot=None):
     """
     Returns the list of items that are scheduled in this room. If Slot is specified,
@@ -1241,6 +1492,10 @@ class Room(models.Model):
     """
     return slot.items(self) if slot else Item.objects.filter(room=self)
 
+  def items_between(self, start, end):
+    "Returns a queryset of the items on in this room at any time from start to end, in slot_minute() terms."
+    return Item.objects.filter(room=self, startMin__lt=end, endMin__gt=start)
+
   def items_public(self, slot=None):
     """
     Returns the list of items that are scheduled in this room, filtered to just the public
@@ -1288,7 +1543,7 @@ class Room(models.Model):
     else:
       return ['visible', 'isDefault', 'isUndefined', 'canClash', 'edit', 'remove']
 
-class Person(models.Model):
+class Person(AvailabilityMixin, models.Model):
   """
   A Person is someone who is a candidate for being scheduled on
   one or more Items. Different from Users, who are the people who
@@ -1388,30 +1643,6 @@ class Person(models.Model):
   def as_xml(self):
     return render_to_string('xml/person.xml', { "p": self } )
 
-  def always_available(self):
-    """
-    Return true if there are no slots where the person is not available.
-    If there are no slots listed, then it's a con preference whether that
-    means "always available" or never available".
-    """
-    return self.availability.count() == 0 and ConInfoBool.objects.no_avail_means_always_avail()
-
-  def never_available(self):
-    """
-    Return true if there are no slots listed, and that should be interpreted
-    as 'never available'.
-    """
-    return self.availability.count() == 0 and not ConInfoBool.objects.no_avail_means_always_avail()
-
-  def available_for(self, item):
-    """
-    Return true if the item falls entirely within one of the person's periods of
-    availability. If the person has NO availability listed, that might be a problem,
-    or it might mean it's always available - con preference.
-    """
-    return self.always_available() or avail_for_slots(self.availability.all(), item.slots())
-
-
   def scheduled_items(self):
     "Returns the list of items this person is on"
     return [ i for i in ItemPerson.objects.filter(person=self) ]
@@ -1454,6 +1685,7 @@ class Person(models.Model):
 
   def save(self, *args, **kwargs):
     prev = Person.objects.get(id = self.id) if self.id is not None else None
+    self.changed_unlogged = unlogged_change(prev, self, self.log_map())
     super(Person, self).save(*args, **kwargs)
     model_cmp(prev, self, self.log_map())
 
@@ -1556,6 +1788,10 @@ class Item(models.Model):
                                   help_text="Indicates whether Tech have suitably processed any media requirements for the item")
   follows = models.ForeignKey('self', null=True, blank=True,
                               help_text="If this item must always immediately follow another item in the same room (e.g. setup, item, tear down), select the preceding item here")
+  startMin = models.IntegerField(null=True, blank=True, editable=False,
+                                 help_text="When the item starts, as slot_minute(). Kept up to date from start, for range queries. Empty if the item's on the undefined day.")
+  endMin = models.IntegerField(null=True, blank=True, editable=False,
+                               help_text="When the item finishes, as slot_minute(). Kept up to date from start and length.")
   objects = models.Manager()
   scheduled = ScheduledManager()
   unscheduled = UnscheduledManager()
@@ -1564,6 +1800,7 @@ class Item(models.Model):
     ordering = [ 'title', 'shortname' ]
     verbose_name = 'item'
     verbose_name_plural = 'items'
+    index_together = [ [ 'room', 'startMin', 'endMin' ], [ 'startMin', 'endMin' ] ]
 
   @classmethod
   def rower(cls, request):
@@ -1594,8 +1831,17 @@ class Item(models.Model):
   def log_map(self):
     return item_log_map
 
+  def period(self):
+    "Return the (startMin, endMin) the item should have, from its start and length."
+    if self.start is None or self.start.day.isUndefined:
+      return (None, None)
+    start = slot_minute(self.start)
+    return (start, start + self.length.length)
+
   def save(self, *args, **kwargs):
     prev = Item.objects.get(id = self.id) if self.id is not None else None
+    (self.startMin, self.endMin) = self.period()
+    self.changed_unlogged = unlogged_change(prev, self, self.log_map(), derived=('startMin', 'endMin'))
     super(Item, self).save(*args, **kwargs)
     model_cmp(prev, self, self.log_map())
 
@@ -1622,16 +1868,19 @@ class Item(models.Model):
     return render_to_string('xml/item.xml', { "i": self } )
 
   def slots(self):
-    "Return a queryset of the slots this item occupies"
+    "Return the slots this item occupies, reusing those loaded by a GridMatrix if there are any."
+    slots = getattr(self, '_slots', None)
+    if slots is not None:
+      return slots
+    if self.startMin is not None:
+      return day_slots_between(self.startMin, self.endMin)
     return Slot.objects.filter(day=self.start.day, start__gte=self.start.start, start__lt=self.start.start+self.length.length)
 
   def overlaps(self, other):
     "Returns true if this item overlaps another item"
-    if (self == other):
+    if self == other or self.startMin is None or other.startMin is None:
       return False
-    return (    self.start.day == other.start.day
-            and self.start.start < (other.start.start + other.length.length)
-            and other.start.start < (self.start.start + self.length.length))
+    return self.startMin < other.endMin and other.startMin < self.endMin
 
   def kit_item_assignments(self):
     "Return all the KitItemAssignments for this item"
@@ -1641,19 +1890,27 @@ class Item(models.Model):
     "Return all the KitRoomAssignments for this item's room"
     return self.room.kit_room_assignments()
 
+  def kit_satisfaction(self):
+    "Returns the KitSatisfaction for this item, reusing one from KitSatisfaction.for_items() if there is one."
+    sat = getattr(self, '_kit_satisfaction', None)
+    return sat if sat is not None else KitSatisfaction(self)
+
   def satisfies_kit_requests(self):
     "Returns true if the kit assigned to this item satisfies all the item's requests"
-    return KitSatisfaction(self).satisfied
+    return self.kit_satisfaction().satisfied
 
   def satisfies_kit_requests_yesno(self):
     "Returns true if the kit assigned to this item satisfies all the item's requests"
-    return "Yes" if KitSatisfaction(self).satisfied else "No"
+    return "Yes" if self.kit_satisfaction().satisfied else "No"
 
   def has_unsatisfied_kit_requests(self):
     return not self.satisfies_kit_requests()
 
   def itempeople(self):
     "Give access to the ItemPerson objects, rather than the Person objects that people gives."
+    itempeople = getattr(self, '_itempeople', None)
+    if itempeople is not None:
+      return itempeople
     return ItemPerson.objects.filter(item = self)
 
   def people_public(self):
@@ -1733,6 +1990,7 @@ class ItemPerson(models.Model):
 
   def save(self, *args, **kwargs):
     prev = ItemPerson.objects.get(id = self.id) if self.id is not None else None
+    self.changed_unlogged = unlogged_change(prev, self, self.log_map())
     super(ItemPerson, self).save(*args, **kwargs)
     model_cmp(prev, self, self.log_map())
 
@@ -1784,6 +2042,8 @@ class Check(models.Model):
                             help_text="Used to identify the code to load and run, and how to render the results")
   result = models.ForeignKey(CheckResult, default=CheckResult.objects.find_default,
                              help_text="The kind of result returned by the check")
+  lastBuilt = models.DateTimeField(null=True, blank=True,
+                                   help_text="When the check's problems were last worked out from scratch. Empty if they never have been.")
 
   def __unicode__(self):
     return self.name
@@ -1791,6 +2051,192 @@ class Check(models.Model):
     return reverse('show_check_detail', kwargs={"pk": self.id})
 
 
+class Problem(models.Model):
+  """
+  A Problem is one result of a Check, kept so that the checks page doesn't have to
+  work everything out again each time. See problems.py for how they're kept up to date.
+  """
+  check = models.ForeignKey(Check,
+                            help_text="The check that found the problem")
+  subject = models.CharField(max_length=48, db_index=True,
+                             help_text="The person, room, item or kit thing the problem is filed under, as kind:id")
+  refs = models.CharField(max_length=255,
+                          help_text="The objects the problem is about, as a list of kind:id")
+
+  def __unicode__(self):
+    return u"%s: %s" % (self.check, self.refs)
+
+
+class StaleSubject(models.Model):
+  """
+  A StaleSubject notes that something has changed since its Problems were worked out,
+  so they need working out again before they're next shown.
+  """
+  subject = models.CharField(max_length=48,
+                             help_text="What has changed, as kind:id")
+
+  def __unicode__(self):
+    return self.subject
+
+
+def latest_change():
+  "The id of the newest ChangeLog entry, or 0 if there isn't one."
+  return (list(ChangeLog.objects.order_by('-id').values_list('id', flat=True)[:1]) or [ 0 ])[0]
+
+class ProgrammeChanges(object):
+  """
+  The items, people and ItemPersons that the ChangeLog says have changed or
+  been deleted between two of its ids. A change to an ItemPerson counts as a
+  change to its item and person too. The log only has an ItemPerson's id, so
+  if one's been deleted or moved to another item, there's no telling which
+  item it was on, and reload is set.
+  """
+  def __init__(self):
+    self.items = set()
+    self.deleted = set()
+    self.people = set()
+    self.deleted_people = set()
+    self.itempeople = set()
+    self.deleted_itempeople = set()
+    self.reload = False
+
+def change_version():
+  """
+  The version that deltas are given from and up to: the newest ChangeLog id,
+  and the count of changes that ChangeLog doesn't describe (see
+  ProgrammeCounter), as "id.count".
+  """
+  unlogged = (list(ProgrammeCounter.objects.values_list('unlogged', flat=True)[:1]) or [ 0 ])[0]
+  return "%d.%d" % (latest_change(), unlogged)
+
+def parse_change_version(version):
+  """
+  Return (ChangeLog id, unlogged count) for a change_version(). A plain
+  ChangeLog id, with no count, gives None for the count. Raises ValueError
+  if it's neither.
+  """
+  parts = unicode(version).split('.')
+  if len(parts) > 2:
+    raise ValueError("Not a version: %s" % (version,))
+  log_id = max(int(parts[0]), 0)
+  unlogged = int(parts[1]) if len(parts) == 2 else None
+  return (log_id, unlogged)
+
+def changes_between(since, upto):
+  """
+  Return the ProgrammeChanges between two change_version()s: those for the
+  ChangeLog entries after since, up to and including upto. If anything that
+  ChangeLog doesn't describe has changed in between (or since doesn't say),
+  reload is set.
+  """
+  (since_id, since_unlogged) = parse_change_version(since)
+  (upto_id, upto_unlogged) = parse_change_version(upto)
+  changes = ProgrammeChanges()
+  changes.reload = since_unlogged is None or since_unlogged != upto_unlogged
+  logs = ChangeLog.objects.filter(id__gt=since_id, id__lte=upto_id).values_list('log_id', 'field')
+  for (log_id, field) in logs:
+    if field == 'ideleted':
+      changes.deleted.add(log_id)
+    elif field in item_log_map:
+      changes.items.add(log_id)
+    elif field == 'pdeleted':
+      changes.deleted_people.add(log_id)
+    elif field in person_log_map:
+      changes.people.add(log_id)
+    elif field == 'ipdeleted':
+      changes.deleted_itempeople.add(log_id)
+      changes.reload = True
+    elif field in itemperson_log_map:
+      changes.itempeople.add(log_id)
+      changes.reload = changes.reload or field == 'ipitem'
+  changes.itempeople -= changes.deleted_itempeople
+  if changes.itempeople:
+    found = ItemPerson.objects.filter(id__in=list(changes.itempeople)).values_list('id', 'item', 'person')
+    changes.items.update([ iid for (ipid, iid, pid) in found ])
+    changes.people.update([ pid for (ipid, iid, pid) in found ])
+    changes.reload = changes.reload or len(found) < len(changes.itempeople)
+  changes.items -= changes.deleted
+  changes.people -= changes.deleted_people
+  return changes
+
+class ProgrammeCounter(models.Model):
+  """
+  A count of changes to the programme - rooms, slots, tags, con info and so
+  on, as well as items and people - kept as a single row. Together with the
+  newest ChangeLog, which catches the changes made by update(), it says
+  whether anything has changed since a page was last fetched. See
+  programme_version().
+
+  unlogged counts just the changes that ChangeLog can't describe - anything
+  other than saving or deleting an item, person or ItemPerson, or a save
+  that changes a field their log maps don't cover - so a delta can tell when
+  it's missing something. See change_version().
+  """
+  count = models.IntegerField(default=0)
+  unlogged = models.IntegerField(default=0)
+  stamp = models.DateTimeField(auto_now=True)
+
+  def __unicode__(self):
+    return u"%d at %s" % (self.count, self.stamp)
+
+def programme_version():
+  """
+  Return (version, when) for the programme as it now is. The version is a
+  string that changes whenever anything in the programme does, and when is
+  the time of the latest change, or None if there's been none yet.
+  """
+  (log_id, log_stamp) = (list(ChangeLog.objects.order_by('-id').values_list('id', 'stamp')[:1]) or [ (0, None) ])[0]
+  (count, count_stamp) = (list(ProgrammeCounter.objects.values_list('count', 'stamp')[:1]) or [ (0, None) ])[0]
+  stamps = [ s for s in (log_stamp, count_stamp) if s is not None ]
+  return ("%d.%d" % (log_id, count), max(stamps) if stamps else None)
+
+
+JobStatus = (
+  ( 'queued',  'Queued' ),
+  ( 'running', 'Running' ),
+  ( 'done',    'Done' ),
+  ( 'failed',  'Failed' ),
+)
+
+class Job(models.Model):
+  """
+  A Job is a file - a PDF, or an export - being made in the background by the
+  runjobs command. Jobs are keyed by what's being made and the
+  programme_version() it's made from, so everyone who asks for the same thing
+  while the programme stays the same shares one Job, and one file.
+  """
+  key = models.CharField(max_length=128, unique=True,
+                         help_text="What's being made, and from which version of the programme")
+  kind = models.SlugField(max_length=32,
+                          help_text="What's being made; one of the artifacts in jobs.py")
+  private = models.BooleanField(default=False,
+                                help_text="True if the file has private information in it")
+  status = models.CharField(max_length=8, choices=JobStatus, default='queued',
+                            help_text="How far the job has got")
+  progress = models.IntegerField(default=0,
+                                 help_text="How much of the job is done, as a percentage")
+  path = models.CharField(max_length=255, blank=True,
+                          help_text="Where the file is, once it's done")
+  error = models.TextField(blank=True,
+                           help_text="What went wrong, if the job failed")
+  created = models.DateTimeField(auto_now_add=True)
+  touched = models.DateTimeField(null=True, blank=True,
+                                 help_text="When the worker running the job last said it was still at it")
+  finished = models.DateTimeField(null=True, blank=True)
+
+  def __unicode__(self):
+    return u"%s (%s)" % (self.key, self.status)
+
+  def as_dict(self):
+    "The job's state, for the client that's waiting for it."
+    return { "id":       self.id,
+             "kind":     self.kind,
+             "status":   self.status,
+             "progress": self.progress,
+             "error":    self.error,
+             "url":      reverse('job_file', kwargs={ "pk": self.id }) if self.status == 'done' else None }
+
+
 NameOrder = (
   ( 'Last', 'Last, First, Middle, Badge'),
   ( 'First', 'First, Middle, Last, Badge' ),
@@ -1858,6 +2304,102 @@ def create_user_profile(sender, instance, created, **kwargs):
 # Register the signal handler against the User object
 post_save.connect(create_user_profile, sender=User, dispatch_uid="create_user_profile")
 
+def forget_avail_mask(sender, instance, action, reverse, model, **kwargs):
+  """
+  Drop the cached availability masks when an availability list changes. When
+  it's changed from the slot's side (slot.person_set.add(...)), instance is
+  the Slot, and the people, rooms or kit affected are model, so it's the
+  masks of those that are out of date.
+  """
+  if action in ('post_add', 'post_remove', 'post_clear'):
+    owner = model if reverse else instance.__class__
+    avail_generation[owner] = avail_generation.get(owner, 0) + 1
+    if not reverse:
+      instance._avail_mask = None
+
+for model in (Person, Room, KitThing):
+  m2m_changed.connect(forget_avail_mask, sender=model.availability.through,
+                      dispatch_uid="forget_avail_mask_%s" % (model.__name__,))
+
+def keep_minutes(sender, instance, raw=False, **kwargs):
+  """
+  Keep startMin and endMin up to date on the items and room assignments that
+  depend on a slot, length or day that's been changed. Fixtures skip save(),
+  so items and room assignments loaded from them are brought up to date here.
+  """
+  item_related = ('start__day', 'length')
+  room_related = ('fromSlot__day', 'toSlot__day', 'toLength')
+  try:
+    if sender is Item:
+      if raw:
+        refresh_minutes(Item.objects.filter(id=instance.id).select_related(*item_related), log=False)
+      return
+    if sender in (KitRoomAssignment, BundleRoomAssignment):
+      if raw:
+        refresh_minutes(sender.objects.filter(id=instance.id).select_related(*room_related), log=False)
+      return
+    if sender is Slot:
+      items = Q(start=instance)
+      assigned = Q(fromSlot=instance) | Q(toSlot=instance)
+    elif sender is SlotLength:
+      items = Q(length=instance)
+      assigned = Q(toLength=instance)
+    else:
+      items = Q(start__day=instance)
+      assigned = Q(fromSlot__day=instance) | Q(toSlot__day=instance)
+    refresh_minutes(Item.objects.filter(items).select_related(*item_related))
+    for model in (KitRoomAssignment, BundleRoomAssignment):
+      refresh_minutes(model.objects.filter(assigned).select_related(*room_related))
+  except ObjectDoesNotExist:
+    # Part way through loading a fixture, the slot or day may not be there
+    # yet. It'll be caught when that's loaded.
+    if not raw:
+      raise
+
+for model in (Item, KitRoomAssignment, BundleRoomAssignment, Slot, SlotLength, ConDay):
+  post_save.connect(keep_minutes, sender=model, dispatch_uid="keep_minutes_%s" % (model.__name__,))
+
+def note_item_moving(sender, instance, raw=False, **kwargs):
+  "Before an item's saved, forget the items of the grids it was in."
+  if not raw and instance.id is not None:
+    for (start, end) in Item.objects.filter(id=instance.id).values_list('startMin', 'endMin'):
+      if start is not None:
+        forget_grid_items(start, end)
+
+def note_item_moved(sender, instance, raw=False, **kwargs):
+  "After an item's saved or deleted, forget the items of the grids it's in."
+  if raw:
+    # keep_minutes() works out a fixture's times after this is connected, so
+    # the instance doesn't have them.
+    forget_grid_items()
+  elif instance.startMin is not None:
+    forget_grid_items(instance.startMin, instance.endMin)
+
+def note_grid_change(sender, instance, raw=False, **kwargs):
+  "Slots, lengths and days move items without saving them, so forget the items of all the grids."
+  forget_grid_items()
+
+def note_grid_slots(sender, instance, action, reverse, pk_set, **kwargs):
+  "Forget the items of grids whose slots have changed."
+  if action in ('post_add', 'post_remove', 'post_clear'):
+    if not reverse:
+      cache.delete(grid_items_key(instance.id))
+    else:
+      forget_grid_items()
+
+pre_save.connect(note_item_moving, sender=Item, dispatch_uid="grid_items_moving")
+post_save.connect(note_item_moved, sender=Item, dispatch_uid="grid_items_moved")
+post_delete.connect(note_item_moved, sender=Item, dispatch_uid="grid_items_deleted")
+for model in (Slot, SlotLength, ConDay):
+  post_save.connect(note_grid_change, sender=model, dispatch_uid="grid_items_%s" % (model.__name__,))
+  post_delete.connect(note_grid_change, sender=model, dispatch_uid="grid_items_deleted_%s" % (model.__name__,))
+m2m_changed.connect(note_grid_slots, sender=Grid.slots.through, dispatch_uid="grid_items_slots")
+
+# problems.py keeps the stored Problems up to date, connecting its own signal
+# handlers. It needs the models above, so it's imported last - by its full name,
+# since it may be the module that caused this one to be imported.
+import streampunk.problems
+
 
 # Outstanding things that need thinking about:
 # - Item Moves. Add when we need that.
@@ -1865,4 +2407,29 @@ post_save.connect(create_user_profile, sender=User, dispatch_uid="create_user_pr
 # Things that need something better than the admin interface:
 # The slot form: need to be able to enter a time, and have that converted to mins.
 
-
+# Bookkeeping that doesn't change what the programme looks like.
+unversioned = ('ChangeLog', 'ProgrammeCounter', 'Problem', 'StaleSubject', 'Check', 'CheckResult',
+               'UserProfile', 'PersonList', 'Job')
+
+# The models whose saves and deletes ChangeLog describes, well enough for a
+# delta. Changes to their many-to-many fields, such as an item's tags, aren't,
+# nor are changes to any field their log maps don't cover; their save()s set
+# changed_unlogged when there's one of those.
+logged = ('Item', 'Person', 'ItemPerson')
+
+def note_version(sender, action=None, instance=None, **kwargs):
+  "Count a change to anything in the programme, for programme_version() and change_version()."
+  if sender._meta.app_label != 'streampunk' or sender._meta.object_name in unversioned:
+    return
+  if action is not None and not action.startswith('post_'):
+    return
+  described = (action is None and sender._meta.object_name in logged
+               and not getattr(instance, 'changed_unlogged', False))
+  unlogged = 0 if described else 1
+  if not ProgrammeCounter.objects.update(count=models.F('count') + 1, unlogged=models.F('unlogged') + unlogged,
+                                         stamp=datetime.now()):
+    ProgrammeCounter(count=1, unlogged=unlogged).save()
+
+post_save.connect(note_version, dispatch_uid="programme_version_save")
+post_delete.connect(note_version, dispatch_uid="programme_version_delete")
+m2m_changed.connect(note_version, dispatch_uid="programme_version_m2m")
@@ -0,0 +1,162 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Moving a batch of items to new rooms and start slots at once, for the drag
+grid.
+
+Saving each item in turn costs several queries per item - fetching it again
+to log the changes, a ChangeLog row per change, and the problem store's and
+grid cache's signal handlers. Here, the items are moved with one update() per
+(room, slot, length), their changes are logged with one bulk_create(), and
+the problem store and grid cache are told about the lot in one go, since
+update() doesn't send any signals.
+"""
+
+from django.db import transaction
+
+from .models import Item, ItemPerson, Room, Slot, ChangeLog, get_current_username, forget_grid_items
+from .problems import Scope, mark
+from .snapshot import ProgrammeSnapshot
+from .checks import room_clashes, person_clashes
+from .checks.runner import needs_of
+
+def load_moves(data, lock=False):
+  """
+  Check a list of { "item": id, "room": id, "start": id } moves. Returns
+  (moves, errors), where moves is a list of (item, room, slot) and errors a
+  list of what was wrong. If an item is moved more than once, the last move
+  wins. With lock set, the items' rows are locked until the transaction ends,
+  so nobody else can move them between their being read and written.
+  """
+  if not isinstance(data, (list, tuple)):
+    return ([], [ u'Expected a list of moves' ])
+  wanted = []
+  errors = []
+  for (n, move) in enumerate(data):
+    try:
+      wanted.append((int(move['item']), int(move['room']), int(move['start'])))
+    except (KeyError, TypeError, ValueError):
+      errors.append(u'Move %d needs an item, room and start' % (n,))
+  if errors:
+    return ([], errors)
+
+  items = Item.objects.select_related('start__day', 'room', 'length')
+  if lock:
+    items = items.select_for_update()
+  items = items.in_bulk([ w[0] for w in wanted ])
+  rooms = Room.objects.in_bulk([ w[1] for w in wanted ])
+  slots = Slot.objects.select_related('day').in_bulk([ w[2] for w in wanted ])
+  latest = {}
+  for (iid, rid, sid) in wanted:
+    if iid not in items:
+      errors.append(u'No such item: %d' % (iid,))
+    elif rid not in rooms:
+      errors.append(u'No such room: %d' % (rid,))
+    elif sid not in slots:
+      errors.append(u'No such slot: %d' % (sid,))
+    else:
+      latest[iid] = (items[iid], rooms[rid], slots[sid])
+  if errors:
+    return ([], errors)
+  return ([ latest[iid] for iid in sorted(latest.keys()) ], [])
+
+def write_moves(moves):
+  """
+  Move each item to its room and slot, in whatever transaction the caller has
+  going. Moves that don't change anything are skipped. Returns (moved,
+  windows): the items that moved, with their new room, start and times, and
+  the times whose grids need forgetting once the moves are committed.
+  """
+  username = get_current_username()
+  logs = []
+  groups = {}
+  subjects = set()
+  windows = []
+  moved = []
+  for (item, room, slot) in moves:
+    if item.room_id == room.id and item.start_id == slot.id:
+      continue
+    # What Item.save() would log, and mark as stale, before and after.
+    if item.start_id != slot.id:
+      logs.append(ChangeLog(log_id=item.id, username=username, field='istart',
+                            old_val=unicode(item.start), new_val=unicode(slot)))
+    if item.room_id != room.id:
+      logs.append(ChangeLog(log_id=item.id, username=username, field='iroom',
+                            old_val=unicode(item.room), new_val=unicode(room)))
+    subjects.update([ "item:%d" % (item.id,), "room:%d" % (item.room_id,), "room:%d" % (room.id,) ])
+    if item.startMin is not None:
+      windows.append((item.startMin, item.endMin))
+
+    item.room = room
+    item.start = slot
+    (item.startMin, item.endMin) = item.period()
+    if item.startMin is not None:
+      windows.append((item.startMin, item.endMin))
+    groups.setdefault((room.id, slot.id, item.startMin, item.endMin), []).append(item.id)
+    moved.append(item)
+
+  if moved:
+    for ((rid, sid, start, end), ids) in groups.items():
+      Item.objects.filter(id__in=ids).update(room=rid, start=sid, startMin=start, endMin=end)
+    ChangeLog.objects.bulk_create(logs)
+    mark(subjects)
+  return (moved, windows)
+
+def forget_windows(windows):
+  if windows:
+    forget_grid_items(min([ w[0] for w in windows ]), max([ w[1] for w in windows ]))
+
+def move_items(data):
+  """
+  Check a list of moves, as load_moves() does, and make them, in one
+  transaction, with the items locked from when they're read. Returns (moved,
+  errors); if there are any errors, nothing is moved.
+  """
+  with transaction.commit_on_success():
+    (moves, errors) = load_moves(data, lock=True)
+    if errors:
+      return ([], errors)
+    (moved, windows) = write_moves(moves)
+  forget_windows(windows)
+  return (moved, [])
+
+def clashes_for(items):
+  """
+  Return the room and person clashes of the items, as (item, other, room or
+  person) tuples, the same as the checks give them. Only the items' rooms and
+  people are loaded to find them.
+  """
+  if not items:
+    return []
+  ids = set([ i.id for i in items ])
+  subjects = [ "item:%d" % (iid,) for iid in ids ]
+  subjects.extend([ "room:%d" % (i.room_id,) for i in items ])
+  subjects.extend([ "person:%d" % (pid,) for pid in
+                    ItemPerson.objects.filter(item__in=ids).values_list('person', flat=True) ])
+  scope = Scope(subjects)
+  # Parent rooms too, for clashes between a room and its sub-rooms.
+  parents = dict(Room.objects.values_list('id', 'parent'))
+  for rid in list(scope.rooms):
+    while parents.get(rid) and parents[rid] not in scope.rooms:
+      rid = parents[rid]
+      scope.rooms.add(rid)
+
+  modules = (room_clashes, person_clashes)
+  snapshot = ProgrammeSnapshot(scope, needs=needs_of(modules))
+  found = []
+  for module in modules:
+    found.extend([ p for p in module.find_problems(snapshot) if p[0].id in ids ])
+  return found
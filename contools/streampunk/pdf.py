@@ -13,7 +13,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from reportlab.pdfgen import canvas
+import os
+import shutil
+import tempfile
+from multiprocessing import cpu_count
+
+from django.conf import settings
+
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.lib import colors
 from reportlab.lib.units import inch, cm
 from reportlab.lib.pagesizes import A4, landscape
@@ -21,6 +28,15 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_LEFT, TA_CENTER
 from reportlab.platypus import SimpleDocTemplate, Spacer, Paragraph, TableStyle, Table, PageBreak
 
+# PyPDF2 is only needed to render big documents in parallel, by joining up
+# the pieces. Without it, they're rendered in one go.
+try:
+  from PyPDF2 import PdfFileMerger
+except ImportError:
+  PdfFileMerger = None
+
+from .pool import worker_pool, can_fork
+
 A4L = landscape(A4)
 
 class StreampunkPdf(object):
@@ -32,11 +48,12 @@ class StreampunkPdf(object):
   def __init__(self, response, logo, borders=0):
     """
     Response is the HttpResponse to the Django view. Logo is the name of
-    the file we should use to whack the Con's logo onto official publications.
+    the file we should use to whack the Con's logo onto official publications;
+    if there's no such file, the logo's left off.
     If borders is true, we'll see the bounding boxes of text, for debugging.
     """
     self.response = response
-    self.logo = logo
+    self.logo = logo if logo and os.path.exists(logo) else None
 
     # Set up some fonts and respective sizes. The leading is how much
     # vertical space a line of text takes, for the font. This is necessary
@@ -54,60 +71,72 @@ class StreampunkPdf(object):
     self.drinks_font_size = 20
     self.drinks_leading = self.drinks_font_size * 2
 
+    # The styles are the same for every document, so they're only set up
+    # once per process (for each value of borders).
+    if borders not in self.stylesheets:
+      self.stylesheets[borders] = self.make_styles(borders)
+    self.styles = self.stylesheets[borders]
+
+  # The style sheets made so far, by borders.
+  stylesheets = {}
+
+  def make_styles(self, borders):
+    "Return a style sheet with our own styles added, drawing their bounding boxes if borders is set."
     # Grab Platypus's default styles, and create a few more.
     # Mainly, we're changing the font style/size, but we'll
     # also create a red bounding box if borders was non-zero.
 
-    self.styles = getSampleStyleSheet()
+    styles = getSampleStyleSheet()
 
-    self.styles.add(ParagraphStyle(name='CardName',
+    styles.add(ParagraphStyle(name='CardName',
                           fontName=self.header_font,
                           fontSize=self.card_name_font_size,
                           borderWidth=borders,
                           borderColor=colors.red,
                           leading=self.card_name_leading))
 
-    self.styles.add(ParagraphStyle(name='CardMod',
+    styles.add(ParagraphStyle(name='CardMod',
                           fontName=self.header_font,
                           fontSize=self.card_mod_font_size,
                           borderWidth=borders,
                           borderColor=colors.red,
                           leading=self.card_mod_leading))
 
-    self.styles.add(ParagraphStyle(name='DrinksData',
+    styles.add(ParagraphStyle(name='DrinksData',
                           fontName=self.row_font,
                           fontSize=self.drinks_font_size,
                           borderWidth=borders,
                           borderColor=colors.red,
                           leading=self.drinks_leading))
 
-    self.styles.add(ParagraphStyle(name='DrinksHeading',
+    styles.add(ParagraphStyle(name='DrinksHeading',
                           fontName=self.header_font,
                           fontSize=self.drinks_font_size,
                           borderWidth=borders,
                           borderColor=colors.red,
                           leading=self.drinks_leading))
+    return styles
+
+  # The widths of the strings measured so far, by (font, size, text). The
+  # metrics come from the fonts, so they're the same for every document.
+  widths = {}
 
-  def textWidth(self, text, style, canv=None, filename='dummy.pdf', pagesize=A4):
+  def textWidth(self, text, style, canv=None):
     "How wide is this text, for a given style?"
-    # We need an instance of the Canvas, in order to determine the width. Create
-    # one if we haven't been given one. XXX we should really write to a temporary
-    # file object that doesn't get created.
-    if canv==None:
-      canv = canvas.Canvas(filename, pagesize)
-    return canv.stringWidth(text, style.fontName, style.fontSize)
-
-  def maxTextWidth(self, texts, style, canv=None, filename='dummy.pdf', pagesize=A4):
+    # Measuring doesn't need a canvas: the canvas just asks pdfmetrics. canv
+    # is only here for callers that still pass one.
+    key = (style.fontName, style.fontSize, text)
+    width = self.widths.get(key)
+    if width is None:
+      if len(self.widths) > 10000:
+        # Don't let a long-running process collect every string it's seen.
+        self.widths.clear()
+      width = self.widths[key] = stringWidth(text, style.fontName, style.fontSize)
+    return width
+
+  def maxTextWidth(self, texts, style, canv=None):
     "Determine the width of the widest of the strings in texts, using the given style."
-    # We create a canvas if we don't have one. XXX Shouldn't really give a filename,
-    # but a temporary file object that doesn't emit output.
-    if canv==None:
-      canv = canvas.Canvas(filename, pagesize)
-    max = 0
-    for text in texts:
-      width = self.textWidth(text, style, canv)
-      max = width if max < width else max
-    return max
+    return max([ self.textWidth(text, style) for text in texts ] or [ 0 ])
 
   def begin_namecards(self):
     "Prepare to emit one or more namecards."
@@ -142,7 +171,8 @@ class StreampunkPdf(object):
       midline = A4L[1] / 2
       canv.line(0, midline, A4L[0], midline)
       # Put the con's logo along the bottom.
-      canv.drawImage(image=doc.streampunk_pdf.logo, x=20, y=20)
+      if doc.streampunk_pdf.logo:
+        canv.drawImage(image=doc.streampunk_pdf.logo, x=20, y=20)
       canv.restoreState()
 
     # Tell Platypus to generate the document, using our page template for each page.
@@ -270,7 +300,8 @@ class StreampunkPdf(object):
       "Draw the con logo on every page."
       canv.saveState()
       # Include the con's logo at the bottom of the page.
-      canv.drawImage(image=doc.streampunk_pdf.logo, x=20, y=20)
+      if doc.streampunk_pdf.logo:
+        canv.drawImage(image=doc.streampunk_pdf.logo, x=20, y=20)
       canv.restoreState()
     # Generate the PDF, putting the con logo on each page.
     self.doc.build(self.story, onFirstPage=drinksform_template, onLaterPages=drinksform_template)
@@ -296,3 +327,94 @@ class StreampunkPdf(object):
     self.story.append(Table(data, style=self.tstyle, colWidths=[ start_width, None ]))
     self.story.append(PageBreak())
 
+
+# ----------------------------------------------------------------------------
+# Rendering a document in parallel
+# ----------------------------------------------------------------------------
+
+# For each kind of document that can be split up, the StreampunkPdf methods
+# that start it, add a page to it, and finish it. Each page stands alone,
+# so the document can be cut anywhere.
+documents = {
+  'namecards':    ('begin_namecards', 'namecard', 'end_namecards'),
+  'drinks_forms': ('begin_drinks_forms', 'drinksform', 'end_drinks_forms'),
+}
+
+def default_workers():
+  return getattr(settings, 'STREAMPUNK_PDF_WORKERS', None) or cpu_count()
+
+def render_serial(out, logo, kind, entries):
+  "Render the whole document to out, in this process. Each entry is the keyword arguments for one page."
+  (begin, add, end) = documents[kind]
+  pdf = StreampunkPdf(out, logo)
+  getattr(pdf, begin)()
+  for entry in entries:
+    getattr(pdf, add)(**entry)
+  getattr(pdf, end)()
+
+def _render_in_worker(batch):
+  # Each batch goes to a file of its own, in the parent's directory, rather
+  # than back through the pipe, so that neither process holds all of them in
+  # memory.
+  (where, logo, kind, entries) = batch
+  (fd, path) = tempfile.mkstemp(dir=where, suffix='.pdf')
+  out = os.fdopen(fd, 'wb')
+  try:
+    try:
+      render_serial(out, logo, kind, entries)
+    finally:
+      out.close()
+  except Exception:
+    os.remove(path)
+    raise
+  return path
+
+def render_document(out, logo, kind, entries, workers=None, batch_size=100, progress=None):
+  """
+  Render the document to out. The entries are split into batches of
+  batch_size pages, which are rendered in a pool of worker processes and
+  joined up in order. With one batch, one worker, or no PyPDF2, or when
+  called from a thread other than the main one (see pool.py), it's all
+  rendered in this process. The entries must already have everything the
+  pages need, since the workers don't touch the database; each batch of
+  them is sent to the worker that renders it.
+
+  If given, progress is called with the fraction of the batches done, as
+  each is finished. The batches are written to a temporary directory, which
+  is removed afterwards, along with anything left in it by a batch that
+  failed or was abandoned.
+  """
+  entries = list(entries)
+  batches = [ entries[n:n + batch_size] for n in range(0, len(entries), batch_size) ]
+  workers = min(workers or default_workers(), len(batches))
+  if workers <= 1 or PdfFileMerger is None or not can_fork():
+    render_serial(out, logo, kind, entries)
+    return
+
+  where = tempfile.mkdtemp()
+  pool = worker_pool(workers)
+  pieces = []
+  try:
+    try:
+      for piece in pool.imap(_render_in_worker, [ (where, logo, kind, batch) for batch in batches ]):
+        pieces.append(piece)
+        if progress:
+          progress(float(len(pieces)) / len(batches))
+      pool.close()
+    except:
+      # Don't wait for the batches still to come.
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+    # The merger's given the batches' paths, not open files: it copies the
+    # whole of an open file into memory, but reads a path's as it goes.
+    merger = PdfFileMerger()
+    try:
+      for piece in pieces:
+        merger.append(piece)
+      merger.write(out)
+    finally:
+      merger.close()
+  finally:
+    shutil.rmtree(where, ignore_errors=True)
@@ -0,0 +1,52 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Pools of worker processes, for the checks and the printed forms.
+
+The workers are forked, so they start with copies of this process's
+database connections; they drop those as they start, and mustn't use the
+database. Forking a process that has other threads running isn't safe, so
+anything that might be run from a threaded web server's request handlers
+should check can_fork() first, and do the work itself if not.
+"""
+
+import threading
+from multiprocessing import Pool
+
+from django.db import connections
+
+def can_fork():
+  "True if it's safe to start worker processes from here."
+  return isinstance(threading.current_thread(), threading._MainThread)
+
+def forget_connections():
+  # The worker has a copy of the parent's database connections. Drop them
+  # without closing them, since closing would close the parent's too.
+  for conn in connections.all():
+    conn.connection = None
+
+def _start_worker(initializer, initargs):
+  forget_connections()
+  if initializer is not None:
+    initializer(*initargs)
+
+def worker_pool(workers, initializer=None, initargs=()):
+  """
+  Return a Pool of worker processes, each of which drops its database
+  connections and then calls initializer(*initargs), if given. The
+  initargs are handed over as the workers are forked, not pickled.
+  """
+  return Pool(workers, initializer=_start_worker, initargs=(initializer, initargs))
@@ -0,0 +1,83 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The printed forms - name cards, drinks forms and door listings - written
+to any file-like object, whether that's a response or a file being made by
+a background job. pdf.py knows nothing of the database; this loads what it
+needs.
+"""
+
+from .models import Item, ItemPerson, ConInfoString
+from .pdf import StreampunkPdf, render_document
+
+def people_by_item(items, **kwargs):
+  """
+  Return [ (item, itempeople) ] for the items, in order, with the item's
+  start, day and room, and each ItemPerson's person and role, loaded in two
+  queries. kwargs filter the ItemPersons.
+  """
+  items = list(items.select_related('start__day', 'room'))
+  on = dict((i.id, []) for i in items)
+  ips = ItemPerson.objects.filter(item__in=on.keys(), **kwargs).select_related('person', 'role').order_by('id')
+  for ip in ips:
+    on[ip.item_id].append(ip)
+  return [ (i, on[i.id]) for i in items ]
+
+def write_namecards(out, items, progress=None):
+  "Write namecards for the selected items."
+  cards = [ { "slot": item.start.startText, "room": item.room.name, "title": item.title,
+              "name": ip.person.as_badge(), "is_mod": ip.role.is_moderator() }
+            for (item, ips) in people_by_item(items, role__namecard=True) for ip in ips ]
+  render_document(out, ConInfoString.objects.con_logo_image_file(), 'namecards', cards, progress=progress)
+
+def drinks_forms(items):
+  "What goes on the drinks forms for the items - one for each, even if nobody on it gets a drink."
+  return [ { "slot": unicode(item.start), "room": item.room.name, "title": item.title,
+             "people": [ (ip.person.as_badge(), ip.role.is_moderator()) for ip in ips ] }
+           for (item, ips) in people_by_item(items, role__drink=True) ]
+
+def write_drinks_forms(out, items, progress=None):
+  "Write drinks forms for the selected items."
+  render_document(out, ConInfoString.objects.con_logo_image_file(), 'drinks_forms', drinks_forms(items), progress=progress)
+
+def items_by_day_and_room(rooms, days, items=None):
+  """
+  Return [ (day, room, items) ] for each of the days, and each of the rooms
+  within it, with the items that start in the room on the day, in order of
+  their start times. items defaults to the visible ones. The items come from
+  one query, with their start and day, for door listings and anything else
+  that's printed per room.
+  """
+  rooms = list(rooms)
+  days = list(days)
+  if items is None:
+    items = Item.objects.filter(visible=True)
+  items = items.filter(room__in=[ r.id for r in rooms ],
+                       start__day__in=[ d.id for d in days ]).select_related('start__day').order_by('startMin', 'title')
+  by_id = dict((r.id, r) for r in rooms)
+  found = {}
+  for i in items:
+    i.room = by_id[i.room_id]
+    found.setdefault((i.start.day_id, i.room_id), []).append(i)
+  return [ (day, room, found.get((day.id, room.id), [])) for day in days for room in rooms ]
+
+def write_door_listings(out, rooms, days):
+  "Write door listings for the given rooms and days."
+  pdf = StreampunkPdf(out, ConInfoString.objects.con_logo_image_file())
+  pdf.begin_door_listings()
+  for (day, room, items) in items_by_day_and_room(rooms, days):
+    pdf.door_listing(day.name, room.name, [ (i.title, i.start.startText) for i in items ])
+  pdf.end_door_listings()
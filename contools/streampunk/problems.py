@@ -0,0 +1,307 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The stored results of the checks.
+
+Working out a check from scratch means loading the whole programme, but a
+typical edit only changes one item. So each check's problems are kept as
+Problem rows, each filed under a subject - a person, room, item or kit thing -
+chosen so that the problem can only change when something to do with its
+subject changes. The check module's subject() function says which; by
+default, the problem is its own subject.
+
+When something is saved or deleted, the signal handlers at the bottom of this
+file note the subjects it touches as StaleSubjects. Before the problems are
+shown, refresh() works the checks out again for just those subjects, from a
+ProgrammeSnapshot narrowed down to them, and replaces their problems.
+rebuild() works checks out from scratch.
+
+Nothing is noted until some check has been built. Changes that don't go
+through save() and delete() - loaddata, or update() on a queryset - aren't
+seen either, so rebuild after those.
+"""
+
+import time
+from datetime import datetime
+
+from django.db import transaction
+from django.db.models import get_model
+from django.db.models.signals import pre_save, post_save, pre_delete, m2m_changed
+
+from .models import Check, Problem, StaleSubject
+from .models import Item, ItemPerson, Person, Room, KitThing, KitBundle, KitRequest
+from .models import KitItemAssignment, KitRoomAssignment
+from .models import BundleItemAssignment, BundleRoomAssignment
+from .checks.base import CheckOutput
+from .checks.runner import run_checks, check_module, needs_of
+from .snapshot import ProgrammeSnapshot
+
+def ref(obj):
+  "Return the kind:id for a model instance."
+  return "%s:%d" % (obj._meta.module_name, obj.id)
+
+def encode(problem):
+  "Return a problem - one object, or a tuple of them - as a string of kind:ids."
+  objs = problem if isinstance(problem, tuple) else (problem,)
+  return " ".join([ ref(obj) for obj in objs ])
+
+def subject_of(module, problem):
+  subject = getattr(module, 'subject', None)
+  return subject(problem) if subject else problem
+
+def chunks(seq, size=500):
+  "Split a list up, to keep IN clauses to a size every database can take."
+  seq = list(seq)
+  for n in range(0, len(seq), size):
+    yield seq[n:n+size]
+
+class Scope(object):
+  """
+  The subjects whose problems are to be worked out again, as sets of ids.
+  Kit bundles aren't subjects, but changing one affects its things.
+  """
+  kinds = ('item', 'person', 'room', 'kitthing', 'kitbundle')
+
+  def __init__(self, subjects=()):
+    self.items = set()
+    self.people = set()
+    self.rooms = set()
+    self.things = set()
+    self.bundles = set()
+    self.by_kind = { 'item':      self.items,
+                     'person':    self.people,
+                     'room':      self.rooms,
+                     'kitthing':  self.things,
+                     'kitbundle': self.bundles }
+    for s in subjects:
+      (kind, oid) = s.split(':')
+      self.by_kind[kind].add(int(oid))
+
+  def covers(self, obj):
+    "True if the object is one of the subjects."
+    return obj.id in self.by_kind.get(obj._meta.module_name, ())
+
+  def subjects(self):
+    return [ "%s:%d" % (kind, oid) for kind in self.kinds[:-1] for oid in self.by_kind[kind] ]
+
+  def expand(self):
+    """
+    Return a new Scope of everything whose problems might have changed, given
+    that the subjects in this one have: an item's people, room and kit; a
+    room's items and kit; a bundle's things; and for a kit thing, the items
+    that use it or are in rooms that hold it, as their kit satisfaction might
+    change. Rooms bring their parent rooms along, for room clashes.
+    """
+    bundle_things = KitBundle.things.through.objects
+    wide = Scope()
+    wide.items.update(self.items)
+    wide.people.update(self.people)
+    wide.rooms.update(self.rooms)
+    wide.things.update(self.things)
+    wide.things.update(bundle_things.filter(kitbundle__in=self.bundles).values_list('kitthing', flat=True))
+
+    # Whatever uses or holds the kit.
+    holding = bundle_things.filter(kitthing__in=wide.things).values('kitbundle')
+    kit_rooms = set(self.rooms)
+    kit_rooms.update(KitRoomAssignment.objects.filter(thing__in=wide.things).values_list('room', flat=True))
+    kit_rooms.update(BundleRoomAssignment.objects.filter(bundle__in=holding).values_list('room', flat=True))
+    wide.items.update(KitItemAssignment.objects.filter(thing__in=wide.things).values_list('item', flat=True))
+    wide.items.update(BundleItemAssignment.objects.filter(bundle__in=holding).values_list('item', flat=True))
+    wide.items.update(Item.objects.filter(room__in=kit_rooms).values_list('id', flat=True))
+
+    # What the items and rooms have.
+    wide.people.update(ItemPerson.objects.filter(item__in=self.items).values_list('person', flat=True))
+    wide.rooms.update(Item.objects.filter(id__in=self.items).values_list('room', flat=True))
+    wide.things.update(KitItemAssignment.objects.filter(item__in=self.items).values_list('thing', flat=True))
+    wide.things.update(KitRoomAssignment.objects.filter(room__in=self.rooms).values_list('thing', flat=True))
+    bundles = set(BundleItemAssignment.objects.filter(item__in=self.items).values_list('bundle', flat=True))
+    bundles.update(BundleRoomAssignment.objects.filter(room__in=self.rooms).values_list('bundle', flat=True))
+    wide.things.update(bundle_things.filter(kitbundle__in=bundles).values_list('kitthing', flat=True))
+
+    parents = dict(Room.objects.values_list('id', 'parent'))
+    for rid in list(wide.rooms):
+      while parents.get(rid) and parents[rid] not in wide.rooms:
+        rid = parents[rid]
+        wide.rooms.add(rid)
+    return wide
+
+def store(check, module, problems):
+  Problem.objects.bulk_create([ Problem(check=check, subject=ref(subject_of(module, p)), refs=encode(p))
+                                for p in problems ])
+
+def rebuild(checks, snapshot=None, workers=None):
+  "Work the checks out from scratch, replacing their stored problems. Returns their CheckOutputs."
+  outputs = run_checks(checks, snapshot=snapshot, workers=workers)
+  now = datetime.now()
+  with transaction.commit_on_success():
+    # Lock the checks' rows, as refresh() does, so the two take turns.
+    list(Check.objects.select_for_update().filter(id__in=[ output.check.id for output in outputs ]))
+    for output in outputs:
+      check = output.check
+      Problem.objects.filter(check=check).delete()
+      store(check, check_module(check), output.things)
+      Check.objects.filter(id=check.id).update(lastBuilt=now)
+      check.lastBuilt = now
+  return outputs
+
+def refresh():
+  """
+  Work out the problems of everything that's been marked as stale, for all
+  the checks that have been built, and then forget the marks.
+
+  It's all done in one transaction, holding a lock on the built checks' rows,
+  so that two requests refreshing at once take turns rather than both
+  replacing the same problems. Only the marks that were read are forgotten;
+  any made meanwhile are left for the next refresh.
+  """
+  with transaction.commit_on_success():
+    built = list(Check.objects.select_for_update().filter(lastBuilt__isnull=False).order_by('id'))
+    marks = list(StaleSubject.objects.values_list('id', 'subject'))
+    if not marks:
+      return
+    if built:
+      scope = Scope([ s for (_, s) in marks ]).expand()
+      modules = [ check_module(check) for check in built ]
+      snapshot = ProgrammeSnapshot(scope, needs=needs_of(modules))
+      stale = scope.subjects()
+      for (check, module) in zip(built, modules):
+        found = [ p for p in module.find_problems(snapshot) if scope.covers(subject_of(module, p)) ]
+        for chunk in chunks(stale):
+          Problem.objects.filter(check=check, subject__in=chunk).delete()
+        store(check, module, found)
+    for chunk in chunks([ mid for (mid, _) in marks ]):
+      StaleSubject.objects.filter(id__in=chunk).delete()
+
+def load(check):
+  "Return the stored problems of a check, in the same form as the check gives them."
+  rows = [ refs.split() for refs in Problem.objects.filter(check=check).order_by('id').values_list('refs', flat=True) ]
+  wanted = {}
+  for refs in rows:
+    for r in refs:
+      (kind, oid) = r.split(':')
+      wanted.setdefault(kind, set()).add(int(oid))
+  objs = {}
+  for (kind, ids) in wanted.items():
+    model = get_model('streampunk', kind)
+    for chunk in chunks(ids):
+      for obj in model.objects.in_bulk(chunk).values():
+        objs[ref(obj)] = obj
+  tuples = check.result.name == 'Mixed Tuple'
+  problems = []
+  for refs in rows:
+    # Skip anything that's been deleted since.
+    if all([ r in objs for r in refs ]):
+      found = tuple([ objs[r] for r in refs ])
+      problems.append(found if tuples else found[0])
+  return problems
+
+def results(checks):
+  """
+  Return CheckOutputs for the checks from their stored problems, bringing them
+  up to date first, and building any that haven't been built yet.
+  """
+  refresh()
+  checks = list(checks)
+  unbuilt = [ c for c in checks if c.lastBuilt is None ]
+  built = dict([ (output.check.id, output) for output in rebuild(unbuilt) ]) if unbuilt else {}
+  outputs = []
+  for check in checks:
+    if check.id in built:
+      outputs.append(built[check.id])
+    else:
+      started = time.time()
+      problems = load(check)
+      outputs.append(CheckOutput(check, problems, time.time() - started))
+  return outputs
+
+
+# What each kind of object is attached to, that its problems are filed under,
+# as (kind, attribute) pairs.
+attached = {
+  Item:                 [ ('item', 'id'), ('room', 'room_id') ],
+  ItemPerson:           [ ('item', 'item_id'), ('person', 'person_id') ],
+  KitItemAssignment:    [ ('item', 'item_id'), ('kitthing', 'thing_id') ],
+  BundleItemAssignment: [ ('item', 'item_id'), ('kitbundle', 'bundle_id') ],
+  KitRoomAssignment:    [ ('room', 'room_id'), ('kitthing', 'thing_id') ],
+  BundleRoomAssignment: [ ('room', 'room_id'), ('kitbundle', 'bundle_id') ],
+  Person:               [ ('person', 'id') ],
+  Room:                 [ ('room', 'id'), ('room', 'parent_id') ],
+  KitThing:             [ ('kitthing', 'id') ],
+  KitBundle:            [ ('kitbundle', 'id') ],
+}
+
+def store_active():
+  "True if any check has been built, so there are stored problems to keep up to date."
+  return Check.objects.filter(lastBuilt__isnull=False).exists()
+
+def add_marks(subjects):
+  subjects = set([ s for s in subjects if s.split(':')[0] in Scope.kinds ])
+  StaleSubject.objects.bulk_create([ StaleSubject(subject=s) for s in subjects ])
+
+def mark(subjects):
+  "Note that the subjects' problems need working out again."
+  if store_active():
+    add_marks(subjects)
+
+def attached_to(sender, instance):
+  return [ "%s:%d" % (kind, getattr(instance, attr))
+           for (kind, attr) in attached[sender] if getattr(instance, attr) is not None ]
+
+def note_before_save(sender, instance, raw=False, **kwargs):
+  "What an object was attached to before a change is affected, as well as what it's attached to after."
+  if raw or instance.id is None or not store_active():
+    return
+  try:
+    add_marks(attached_to(sender, sender.objects.get(id=instance.id)))
+  except sender.DoesNotExist:
+    pass
+
+def note_save(sender, instance, raw=False, **kwargs):
+  if not raw:
+    mark(attached_to(sender, instance))
+
+def note_delete(sender, instance, **kwargs):
+  mark(attached_to(sender, instance))
+
+def note_room_delete(sender, instance, **kwargs):
+  "A room's items are moved to the undefined room before it's deleted."
+  mark([ "room:%d" % (Room.objects.find_undefined().id,) ])
+
+def note_kitrequest(sender, instance, raw=False, **kwargs):
+  "Changing a kit request affects the items that made it."
+  if not raw and instance.id is not None:
+    mark([ "item:%d" % (iid,) for iid in instance.item_set.values_list('id', flat=True) ])
+
+def note_m2m(sender, instance, action, model, pk_set, **kwargs):
+  "Adding to or removing from a list affects both the object with the list and the objects in it."
+  if action not in ('post_add', 'post_remove', 'pre_clear') or not store_active():
+    return
+  if action == 'pre_clear':
+    pk_set = sender.objects.filter(**{ instance._meta.module_name: instance }).values_list(model._meta.module_name, flat=True)
+  add_marks([ ref(instance) ] + [ "%s:%d" % (model._meta.module_name, pk) for pk in pk_set ])
+
+for (model, attrs) in attached.items():
+  name = model.__name__
+  if [ attr for (kind, attr) in attrs if attr != 'id' ]:
+    pre_save.connect(note_before_save, sender=model, dispatch_uid="problems_before_save_%s" % (name,))
+  post_save.connect(note_save, sender=model, dispatch_uid="problems_save_%s" % (name,))
+  pre_delete.connect(note_delete, sender=model, dispatch_uid="problems_delete_%s" % (name,))
+pre_delete.connect(note_room_delete, sender=Room, dispatch_uid="problems_room_delete")
+post_save.connect(note_kitrequest, sender=KitRequest, dispatch_uid="problems_save_KitRequest")
+pre_delete.connect(note_kitrequest, sender=KitRequest, dispatch_uid="problems_delete_KitRequest")
+for through in (Person.availability.through, Room.availability.through, KitThing.availability.through,
+                Item.kitRequests.through, KitBundle.things.through):
+  m2m_changed.connect(note_m2m, sender=through, dispatch_uid="problems_m2m_%s" % (through.__name__,))
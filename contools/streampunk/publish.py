@@ -0,0 +1,222 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The public programme, written out as static files that a web server can
+serve without touching Django: the grids, a page per item and per person,
+the door listings, the KonOpas JavaScript and the XML dump.
+
+Each file is laid out under the directory at the path of the page it's a
+copy of - /streampunk/item/12/ becomes streampunk/item/12/index.html - so
+the links between the pages still work. Files are written to a temporary
+name and renamed into place, so the web server never sends half of one.
+
+A manifest in the directory records the change_version() that the last
+build got up to. The next build only renders the item and person pages that
+ChangeLog says have changed since (and the ones linked to them), along with
+the grids and the whole-programme files, which are redone whenever anything
+has. Rooms, slots, tags and the con info aren't in ChangeLog, so if the
+version says any of those have changed - or a fingerprint of them, kept in
+the manifest too, differs - everything is rendered again.
+"""
+
+import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.urlresolvers import reverse, resolve
+from django.test.client import RequestFactory
+from django.utils import simplejson
+
+from .models import Grid, Room, Slot, SlotLength, ConDay, Tag, Item, ItemPerson
+from .models import ItemKind, ConInfoString, ConInfoInt, ConInfoBool
+from .models import change_version, changes_between
+from .xmldump import xml_dump
+from .konopas import konopas_js
+from .exceptions import PublishException
+
+MANIFEST = '.publish.json'
+
+# What the pages show besides items and people, that ChangeLog doesn't cover.
+shared_models = [ Grid, Room, Slot, SlotLength, ConDay, Tag, ItemKind, ConInfoString, ConInfoInt, ConInfoBool ]
+
+def shared_fingerprint():
+  "A hash of everything in shared_models, which changes if any of it does."
+  digest = hashlib.md5()
+  for model in shared_models:
+    digest.update(repr(list(model.objects.order_by('id').values_list())))
+  return digest.hexdigest()
+
+def public_items():
+  "The ids of the items on the public programme."
+  return set(Item.scheduled.filter(visible=True, room__visible=True).values_list('id', flat=True))
+
+def public_people(items):
+  "The ids of the people publicly on the items."
+  return set(ItemPerson.objects.filter(visible=True, item__in=list(items)).values_list('person', flat=True))
+
+def page_path(url):
+  "Where a page's copy goes, relative to the directory."
+  return os.path.join(url.strip('/'), 'index.html')
+
+def write_atomically(root, path, pieces):
+  "Write the pieces to root/path, via a temporary file in the same directory."
+  full = os.path.join(root, path)
+  if not os.path.isdir(os.path.dirname(full)):
+    os.makedirs(os.path.dirname(full))
+  (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(full), suffix='.tmp')
+  out = os.fdopen(fd, 'wb')
+  try:
+    for piece in pieces:
+      out.write(piece.encode('utf-8') if isinstance(piece, unicode) else piece)
+  finally:
+    out.close()
+  os.chmod(tmp, 0644)
+  os.rename(tmp, full)
+
+def write_gzipped(root, path):
+  "Write a gzipped copy of root/path alongside it, for servers that can send it as it is."
+  full = os.path.join(root, path)
+  (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(full), suffix='.tmp')
+  os.close(fd)
+  out = gzip.open(tmp, 'wb')
+  out.write(open(full, 'rb').read())
+  out.close()
+  os.chmod(tmp, 0644)
+  os.rename(tmp, full + '.gz')
+
+class Publisher(object):
+  """
+  Renders the public pages, as someone who isn't logged in sees them, and
+  writes them under root. written lists what's been written, and removed
+  what's been taken away.
+  """
+  def __init__(self, root):
+    self.root = root
+    self.factory = RequestFactory()
+    self.user = AnonymousUser()
+    self.written = []
+    self.removed = []
+
+  def render(self, url):
+    "Return the content of the page at url."
+    request = self.factory.get(url)
+    request.user = self.user
+    request.session = {}
+    match = resolve(url)
+    response = match.func(request, *match.args, **match.kwargs)
+    if response.status_code != 200:
+      raise PublishException("%s gave a %d" % (url, response.status_code))
+    if hasattr(response, 'render'):
+      response.render()
+    if response.streaming:
+      return response.streaming_content
+    return [ response.content ]
+
+  def write(self, path, pieces):
+    write_atomically(self.root, path, pieces)
+    self.written.append(path)
+
+  def page(self, url, path=None):
+    self.write(path or page_path(url), self.render(url))
+
+  def remove(self, url):
+    path = page_path(url)
+    full = os.path.join(self.root, path)
+    if os.path.exists(full):
+      shutil.rmtree(os.path.dirname(full))
+      self.removed.append(path)
+
+  def item_url(self, iid):
+    return reverse('show_item_detail', kwargs={ "pk": iid })
+
+  def person_url(self, pid):
+    return reverse('show_person_detail', kwargs={ "pk": pid })
+
+  def whole_programme(self):
+    "Write the grids and the files made from the whole programme."
+    self.page(reverse('list_grids'))
+    for grid in Grid.objects.order_by('id'):
+      self.page(reverse('show_grid', kwargs={ "gr": grid.id }))
+    self.page(reverse('door_listings'), os.path.join(reverse('door_listings').strip('/'), 'door_listings.pdf'))
+    xml_dir = reverse('xml_dump').strip('/')
+    self.write(os.path.join(xml_dir, 'streampunk.xml'), xml_dump(False))
+    self.page(reverse('xml_dtd'), os.path.join(xml_dir, 'streampunk.dtd'))
+    self.page(reverse('xml_xsl'), os.path.join(xml_dir, 'streampunk.xsl'))
+    konopas = os.path.join(reverse('konopas').strip('/'), 'konopas.js')
+    self.write(konopas, [ konopas_js() ])
+    write_gzipped(self.root, konopas)
+
+def read_manifest(root):
+  path = os.path.join(root, MANIFEST)
+  if not os.path.exists(path):
+    return None
+  return simplejson.load(open(path))
+
+def publish(root, everything=False):
+  """
+  Bring the static copy of the public programme in root up to date, or
+  write all of it if everything is set. Returns the Publisher, which says
+  what was written and removed.
+  """
+  if not os.path.isdir(root):
+    os.makedirs(root)
+  publisher = Publisher(root)
+  manifest = read_manifest(root) or { "version": 0, "shared": None, "items": [], "people": [] }
+  upto = change_version()
+  fingerprint = shared_fingerprint()
+  items = public_items()
+  people = public_people(items)
+  gone_items = set(manifest['items']) - items
+  gone_people = set(manifest['people']) - people
+
+  full = everything or manifest['shared'] != fingerprint
+  if not full:
+    changes = changes_between(manifest['version'], upto)
+    full = changes.reload
+  if full:
+    (dirty_items, dirty_people) = (items, people)
+  else:
+    # An item's page lists its people, and a person's their items.
+    dirty_items = set(changes.items)
+    dirty_people = set(changes.people)
+    dirty_people.update(ItemPerson.objects.filter(visible=True, item__in=list(changes.items)).values_list('person', flat=True))
+    dirty_items.update(ItemPerson.objects.filter(visible=True, person__in=list(changes.people)).values_list('item', flat=True))
+    # And anything that's only just been made public.
+    dirty_items = (dirty_items & items) | (items - set(manifest['items']))
+    dirty_people = (dirty_people & people) | (people - set(manifest['people']))
+    if not (dirty_items or dirty_people or gone_items or gone_people):
+      # Nothing public has changed, so the rest can stay as it is.
+      return publisher
+
+  for iid in sorted(dirty_items):
+    publisher.page(publisher.item_url(iid))
+  for pid in sorted(dirty_people):
+    publisher.page(publisher.person_url(pid))
+  for iid in sorted(gone_items):
+    publisher.remove(publisher.item_url(iid))
+  for pid in sorted(gone_people):
+    publisher.remove(publisher.person_url(pid))
+  publisher.whole_programme()
+
+  # The manifest goes last, so a build that fails part way is done again.
+  write_atomically(root, MANIFEST, [ simplejson.dumps({ "version": upto,
+                                                        "shared":  fingerprint,
+                                                        "items":   sorted(items),
+                                                        "people":  sorted(people) }) ])
+  return publisher
@@ -21,7 +21,7 @@ from django.forms import widgets
 
 from rest_framework import serializers, permissions
 
-from .models import Item, Room, Person, Slot, SlotLength, Grid
+from .models import Item, Room, Person, Slot, SlotLength
 
 class ReadOnly(permissions.BasePermission):
   "Don't allow write access via these serializers."
@@ -65,11 +65,14 @@ class GridItemSerializer(serializers.ModelSerializer):
     read_only_fields = ('id', 'title', 'length')
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
-class GridSerializer(serializers.ModelSerializer):
+class GridSerializer(serializers.Serializer):
+  "Serializes a GridMatrix, so that the grid's items, slots and people come from what it's loaded."
+  id = serializers.IntegerField(source='grid.id', read_only=True)
+  name = serializers.CharField(source='grid.name', read_only=True)
+  gridOrder = serializers.IntegerField(source='grid.gridOrder', read_only=True)
   slots = GridSlotSerializer(many=True, source='slots', read_only=True, required=False)
-  items = GridItemSerializer(many=True, read_only=True, required=False)
+  items = GridItemSerializer(many=True, source='items', read_only=True, required=False)
   class Meta:
-    model = Grid
     permission_classes = (ReadOnly,)
 
 
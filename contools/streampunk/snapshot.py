@@ -0,0 +1,173 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A snapshot of the whole programme, for the checks to work from.
+"""
+
+from django.db.models import Q
+
+from .models import Slot, SlotLength, Room, Item, Person, ItemPerson
+from .models import KitThing, KitBundle, KitSatisfaction
+from .models import KitItemAssignment, KitRoomAssignment
+from .models import BundleItemAssignment, BundleRoomAssignment
+from .availability import Availability
+
+# The parts a snapshot can load, and the other parts each one needs.
+parts = {
+  'items':            (),
+  'people':           (),
+  'itempeople':       ('items', 'people'),
+  'kit':              ('items',),
+  'availability':     (),
+  'kit_satisfaction': ('items',),
+}
+
+def with_requirements(needs):
+  "Return the set of parts needed to load the parts in needs, or all of them if needs is None."
+  if needs is None:
+    return set(parts.keys())
+  found = set()
+  todo = list(needs)
+  while todo:
+    part = todo.pop()
+    if part not in found:
+      found.add(part)
+      todo.extend(parts[part])
+  return found
+
+class ProgrammeSnapshot(object):
+  """
+  Everything the checks need to know about the programme, loaded in one go,
+  with the related objects linked up in memory so that working through them
+  doesn't go back to the database. The checks only read from a snapshot, so
+  one can be shared between all of them, including across processes.
+
+  Given a scope (a problems.Scope), only the part of the programme needed to
+  check the items, people, rooms and kit things in the scope is loaded: all the
+  items of the people, all the items in the rooms and their sub-rooms, and all
+  the uses of the kit. The checks will find a partial set of problems for
+  anything else, so their results must be narrowed down to the scope.
+
+  Given needs, a list of the parts above, only those parts (and the ones they
+  depend on) are loaded. Each check module says which it needs, so a check
+  that only looks at people doesn't load the items and kit as well. The rooms
+  are always there.
+  """
+  def __init__(self, scope=None, needs=None):
+    needs = with_requirements(needs)
+    self.undefined_slot = Slot.objects.find_undefined().id
+    self.undefined_length = SlotLength.objects.find_undefined().id
+    self.undefined_room = Room.objects.find_undefined().id
+
+    self.rooms = list(Room.objects.all())
+    rooms = dict((r.id, r) for r in self.rooms)
+
+    if scope is None:
+      item_qs = Item.objects.all()
+      person_qs = Person.objects.all()
+      ip_qs = ItemPerson.objects.all()
+      kia_qs = KitItemAssignment.objects.all()
+      bia_qs = BundleItemAssignment.objects.all()
+      kra_qs = KitRoomAssignment.objects.all()
+      bra_qs = BundleRoomAssignment.objects.all()
+    else:
+      family = self.with_subrooms(scope.rooms)
+      bundles = KitBundle.things.through.objects.filter(kitthing__in=scope.things).values('kitbundle')
+      item_qs = Item.objects.filter(  Q(id__in=scope.items)
+                                    | Q(room__in=family)
+                                    | Q(id__in=ItemPerson.objects.filter(person__in=scope.people).values('item'))
+                                    | Q(id__in=KitItemAssignment.objects.filter(thing__in=scope.things).values('item'))
+                                    | Q(id__in=BundleItemAssignment.objects.filter(bundle__in=bundles).values('item')))
+      person_qs = Person.objects.filter(  Q(id__in=scope.people)
+                                        | Q(id__in=ItemPerson.objects.filter(item__in=item_qs).values('person')))
+      ip_qs = ItemPerson.objects.filter(item__in=item_qs)
+      kia_qs = KitItemAssignment.objects.filter(item__in=item_qs)
+      bia_qs = BundleItemAssignment.objects.filter(item__in=item_qs)
+      kra_qs = KitRoomAssignment.objects.filter(Q(thing__in=scope.things) | Q(room__in=family))
+      bra_qs = BundleRoomAssignment.objects.filter(Q(bundle__in=bundles) | Q(room__in=family))
+
+    if 'items' in needs:
+      self.items = list(item_qs.select_related('start__day', 'length'))
+      for i in self.items:
+        i.room = rooms[i.room_id]
+      items = dict((i.id, i) for i in self.items)
+      self.scheduled_items = [ i for i in self.items if self.is_scheduled(i) ]
+      self.unscheduled_items = [ i for i in self.items if not self.is_scheduled(i) ]
+      self.scheduled_ids = set([ i.id for i in self.scheduled_items ])
+
+    if 'people' in needs:
+      self.people = list(person_qs)
+      people = dict((p.id, p) for p in self.people)
+
+    if 'itempeople' in needs:
+      self.itempeople = list(ip_qs.select_related('role'))
+      self.people_on = dict((i.id, []) for i in self.items)
+      for ip in self.itempeople:
+        ip.item = items[ip.item_id]
+        ip.person = people[ip.person_id]
+        self.people_on[ip.item_id].append(ip)
+
+    if 'kit' in needs:
+      self.things = list(KitThing.objects.all())
+      things = dict((t.id, t) for t in self.things)
+      self.bundle_things = {}
+      for (bid, tid) in KitBundle.things.through.objects.values_list('kitbundle', 'kitthing'):
+        self.bundle_things.setdefault(bid, []).append(things[tid])
+      self.kit_item_assignments = list(kia_qs)
+      for a in self.kit_item_assignments:
+        a.item = items[a.item_id]
+        a.thing = things[a.thing_id]
+      self.bundle_item_assignments = list(bia_qs)
+      for a in self.bundle_item_assignments:
+        a.item = items[a.item_id]
+      room_related = ('fromSlot__day', 'toSlot__day', 'toLength')
+      self.kit_room_assignments = list(kra_qs.select_related(*room_related))
+      for a in self.kit_room_assignments:
+        a.room = rooms[a.room_id]
+        a.thing = things[a.thing_id]
+      self.bundle_room_assignments = list(bra_qs.select_related(*room_related))
+      for a in self.bundle_room_assignments:
+        a.room = rooms[a.room_id]
+
+    if 'availability' in needs:
+      self.availability = Availability()
+      self.person_masks = self.availability.masks(Person, None if scope is None else person_qs)
+      self.room_masks = self.availability.masks(Room)
+      self.thing_masks = self.availability.masks(KitThing)
+
+    if 'kit_satisfaction' in needs:
+      self.kit_satisfaction = KitSatisfaction.for_items(self.items)
+
+  def is_scheduled(self, item):
+    "True if the item has a day/time, a length and a room - as Item.scheduled."
+    return (    item.start_id != self.undefined_slot
+            and item.length_id != self.undefined_length
+            and item.room_id != self.undefined_room)
+
+  def with_subrooms(self, rids):
+    "Return the ids of the rooms, and of all their sub-rooms, sub-sub-rooms, etc."
+    children = {}
+    for r in self.rooms:
+      if r.parent_id:
+        children.setdefault(r.parent_id, []).append(r.id)
+    found = set()
+    todo = list(rids)
+    while todo:
+      rid = todo.pop()
+      if rid not in found:
+        found.add(rid)
+        todo.extend(children.get(rid, []))
+    return found
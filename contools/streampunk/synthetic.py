@@ -0,0 +1,306 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Generates made-up conventions, for seeing how things scale.
+
+The demo data is a handful of items and people; a big con has tens of
+thousands of items. ConGenerator fills the database with a con of any size,
+built on the days and slots that are already there: rooms (some divided into
+sub-rooms), people with availability, items laid out in the rooms, the
+people on them, tags, kit, bundles and kit requests. The same seed always
+gives the same con.
+
+Everything's added with bulk inserts, so there are no ChangeLog entries for
+it, and the checks' stored problems are marked as needing a rebuild.
+"""
+
+import random
+
+from .models import Slot, SlotLength, Room, Person, Item, ItemPerson, ItemKind, Tag
+from .models import KitThing, KitBundle, KitKind, KitRequest
+from .models import KitItemAssignment, BundleItemAssignment, BundleRoomAssignment
+from .models import Check, slot_minute, forget_grid_items
+
+first_names = [ 'Alex', 'Sam', 'Jo', 'Chris', 'Pat', 'Robin', 'Kim', 'Lee', 'Morgan', 'Ash',
+                'Charlie', 'Jamie', 'Terry', 'Frankie', 'Nic', 'Val', 'Mel', 'Toni', 'Jules', 'Rowan' ]
+last_names = [ 'Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson', 'Johnson', 'Davies',
+               'Robinson', 'Wright', 'Thompson', 'Evans', 'Walker', 'White', 'Roberts', 'Green',
+               'Hall', 'Wood', 'Jackson', 'Clarke' ]
+topics = [ 'Dragons', 'Starships', 'Time Travel', 'Robots', 'Vampires', 'Space Opera', 'Steampunk',
+           'Fandom', 'Comics', 'Filk', 'Costuming', 'Gaming', 'Hard SF', 'Fairy Tales', 'Zombies',
+           'Aliens', 'Worldbuilding', 'Publishing', 'Art', 'Science' ]
+formats = [ '%s: a panel', 'The future of %s', '%s for beginners', 'Why %s matter', '%s workshop',
+            'Reading: %s', '%s quiz', 'Is %s dead?' ]
+
+def field_defaults(model):
+  """
+  Work out the model's callable defaults once, so that creating many instances
+  doesn't look each one up again.
+  """
+  return dict([ (f.attname, f.get_default()) for f in model._meta.fields
+                if f.has_default() and callable(f.default) ])
+
+def bulk(model, objs):
+  "bulk_create, in batches small enough for any database's limit on query parameters."
+  size = max(1, 900 // len(model._meta.fields))
+  for n in range(0, len(objs), size):
+    model.objects.bulk_create(objs[n:n+size])
+
+def last_id(model):
+  found = model.objects.order_by('-id').values_list('id', flat=True)[:1]
+  return found[0] if found else 0
+
+def bulk_ids(model, objs):
+  "Bulk-create the objects, and return their new ids, in the same order."
+  before = last_id(model)
+  bulk(model, objs)
+  return list(model.objects.filter(id__gt=before).order_by('id').values_list('id', flat=True))
+
+class ConGenerator(object):
+  # Preset sizes for the makecon command.
+  sizes = {
+    'small':  dict(items=500,   people=200,  rooms=12,  things=60,   bundles=8),
+    'medium': dict(items=5000,  people=1500, rooms=60,  things=300,  bundles=40),
+    'large':  dict(items=20000, people=5000, rooms=240, things=1200, bundles=150),
+  }
+
+  def __init__(self, seed=0, items=500, people=200, rooms=12, things=60, bundles=8, prefix='Gen'):
+    self.random = random.Random(seed)
+    self.num_items = items
+    self.num_people = people
+    self.num_rooms = rooms
+    self.num_things = things
+    self.num_bundles = bundles
+    self.prefix = prefix
+
+  def generate(self):
+    "Add the con to the database. Returns a dict of how many of each thing were added."
+    self.load_layout()
+    self.made = {}
+    self.make_rooms()
+    self.make_people()
+    self.make_items()
+    self.make_itempeople()
+    self.make_tags()
+    self.make_kit()
+    # None of this went through save(), so the stored problems and the grids'
+    # cached items don't know about it.
+    Check.objects.update(lastBuilt=None)
+    forget_grid_items()
+    return self.made
+
+  def load_layout(self):
+    "The days and slots to use, and the lengths items can be."
+    self.days = []
+    day_slots = {}
+    slots = Slot.objects.filter(isUndefined=False, day__isUndefined=False).select_related('day', 'length')
+    for slot in slots.order_by('day__date', 'start'):
+      if slot.day_id not in day_slots:
+        day_slots[slot.day_id] = []
+        self.days.append(day_slots[slot.day_id])
+      day_slots[slot.day_id].append(slot)
+    self.slots = [ slot for day in self.days for slot in day ]
+    self.lengths = list(SlotLength.objects.filter(isUndefined=False, length__gt=0).order_by('length'))
+
+  def availability(self, through, owner, oid, slots):
+    return [ through(**{ owner: oid, 'slot_id': s.id }) for s in slots ]
+
+  def available_slots(self, gaps):
+    "Some of the days, and most of the slots in them."
+    days = [ d for d in self.days if self.random.random() < 0.8 ] or [ self.random.choice(self.days) ]
+    return [ s for d in days for s in d if self.random.random() >= gaps ]
+
+  def make_rooms(self):
+    """
+    Rooms, in groups of six: a hall that can be used whole or divided into its
+    two sub-rooms, then three ordinary rooms.
+    """
+    rooms = [ Room(name="%s room %d" % (self.prefix, n), gridOrder=n, canClash=True, visible=True)
+              for n in range(self.num_rooms) ]
+    self.room_ids = bulk_ids(Room, rooms)
+    self.halls = {}
+    for n in range(0, len(self.room_ids) - 2, 6):
+      hall = self.room_ids[n]
+      self.halls[hall] = self.room_ids[n+1:n+3]
+      Room.objects.filter(id__in=self.halls[hall]).update(parent=hall)
+    through = Room.availability.through
+    avail = []
+    for rid in self.room_ids:
+      avail.extend(self.availability(through, 'room_id', rid, self.available_slots(0.02)))
+    bulk(through, avail)
+    self.made['rooms'] = len(self.room_ids)
+
+  def make_people(self):
+    defaults = field_defaults(Person)
+    people = []
+    for n in range(self.num_people):
+      first = self.random.choice(first_names)
+      last = self.random.choice(last_names)
+      people.append(Person(firstName=first, lastName="%s %d" % (last, n),
+                           email="%s.%s%d@example.com" % (first.lower(), last.lower(), n) if self.random.random() < 0.9 else '',
+                           memnum=n + 1 if self.random.random() < 0.95 else -1,
+                           complete='Yes' if self.random.random() < 0.6 else 'No',
+                           **defaults))
+    self.person_ids = bulk_ids(Person, people)
+    through = Person.availability.through
+    avail = []
+    for pid in self.person_ids:
+      if self.random.random() < 0.9:
+        avail.extend(self.availability(through, 'person_id', pid, self.available_slots(0.1)))
+    bulk(through, avail)
+    self.made['people'] = len(self.person_ids)
+
+  def fill_day(self, day):
+    "Yield (start slot, length) for a run of items through the day, with some gaps."
+    ends = day[-1].start + day[-1].length.length
+    n = 0
+    while n < len(day):
+      if self.random.random() < 0.15:
+        n += 1
+        continue
+      start = day[n]
+      length = self.random.choice(self.lengths[:2] * 3 + self.lengths)
+      if start.start + length.length > ends:
+        break
+      yield (start, length)
+      while n < len(day) and day[n].start < start.start + length.length:
+        n += 1
+
+  def make_items(self):
+    "Lay the items out in the rooms, day by day. Any that don't fit are left unscheduled."
+    defaults = field_defaults(Item)
+    kinds = list(ItemKind.objects.filter(isUndefined=False)) or list(ItemKind.objects.all())
+    places = []
+    halls_by_part = dict([ (part, hall) for (hall, parts) in self.halls.items() for part in parts ])
+    pairs = [ (d, rid) for d in range(len(self.days)) for rid in self.room_ids ]
+    self.random.shuffle(pairs)
+    whole = {}
+    for (d, rid) in pairs:
+      if len(places) >= self.num_items:
+        break
+      # A divided hall is used either whole or as its parts, on any one day.
+      hall = halls_by_part.get(rid, rid)
+      if hall in self.halls:
+        if (hall, d) not in whole:
+          whole[(hall, d)] = self.random.random() < 0.5
+        if whole[(hall, d)] != (rid == hall):
+          continue
+      for (start, length) in self.fill_day(self.days[d]):
+        minute = slot_minute(start)
+        places.append((start.id, length.id, rid, minute, minute + length.length))
+
+    places = places[:self.num_items]
+    unscheduled = (Slot.objects.find_undefined().id, SlotLength.objects.find_undefined().id,
+                   Room.objects.find_undefined().id, None, None)
+    places.extend([ unscheduled ] * (self.num_items - len(places)))
+    items = []
+    for (n, (start, length, room, startMin, endMin)) in enumerate(places):
+      title = self.random.choice(formats) % (self.random.choice(topics),)
+      values = dict(defaults)
+      values.update(start_id=start, length_id=length, room_id=room, kind_id=self.random.choice(kinds).id,
+                    startMin=startMin, endMin=endMin)
+      items.append(Item(title=title, shortname="%s %d" % (self.prefix, n),
+                        blurb="%s. A made-up item, number %d." % (title, n),
+                        gophers=-1 if self.random.random() < 0.05 else self.random.randint(0, 3),
+                        complete='Yes' if self.random.random() < 0.7 else 'No',
+                        **values))
+    self.item_ids = bulk_ids(Item, items)
+    self.scheduled_ids = [ iid for (iid, place) in zip(self.item_ids, places) if place != unscheduled ]
+    self.made['items'] = len(self.item_ids)
+    self.made['scheduled'] = len(self.scheduled_ids)
+
+  def make_itempeople(self):
+    "One to five people on most items, with some people much busier than others."
+    defaults = field_defaults(ItemPerson)
+    ips = []
+    for iid in self.item_ids:
+      if self.random.random() < 0.05:
+        continue
+      count = min(self.random.randint(1, 5), len(self.person_ids))
+      chosen = set()
+      while len(chosen) < count:
+        chosen.add(self.person_ids[int(len(self.person_ids) * self.random.random() ** 2)])
+      ips.extend([ ItemPerson(item_id=iid, person_id=pid, **defaults) for pid in chosen ])
+    bulk(ItemPerson, ips)
+    self.made['itempeople'] = len(ips)
+
+  def make_tags(self):
+    tag_ids = bulk_ids(Tag, [ Tag(name="%s %s" % (self.prefix, t)) for t in topics ])
+    through = Item.tags.through
+    rows = []
+    for iid in self.item_ids:
+      for tid in self.random.sample(tag_ids, self.random.randint(0, 3)):
+        rows.append(through(item_id=iid, tag_id=tid))
+    bulk(through, rows)
+    self.made['tags'] = len(tag_ids)
+
+  def make_kit(self):
+    """
+    Kit things, some grouped into bundles that stay in a room for the whole
+    con, and the rest assigned to items. Some items ask for kit, too.
+    """
+    defaults = field_defaults(KitThing)
+    kinds = list(KitKind.objects.filter(isUndefined=False)) or list(KitKind.objects.all())
+    things = [ KitThing(name="%s kit %d" % (self.prefix, n), kind_id=self.random.choice(kinds).id,
+                        count=self.random.randint(1, 4), **defaults)
+               for n in range(self.num_things) ]
+    thing_ids = bulk_ids(KitThing, things)
+    through = KitThing.availability.through
+    avail = []
+    for tid in thing_ids:
+      avail.extend(self.availability(through, 'kitthing_id', tid, self.slots))
+    bulk(through, avail)
+
+    defaults = field_defaults(KitBundle)
+    bundle_ids = bulk_ids(KitBundle, [ KitBundle(name="%s bundle %d" % (self.prefix, n), **defaults)
+                                       for n in range(self.num_bundles) ])
+    loose = list(thing_ids)
+    self.random.shuffle(loose)
+    through = KitBundle.things.through
+    rows = []
+    for bid in bundle_ids:
+      for n in range(min(self.random.randint(2, 6), len(loose))):
+        rows.append(through(kitbundle_id=bid, kitthing_id=loose.pop()))
+    bulk(through, rows)
+
+    first = self.slots[0]
+    last = self.slots[-1]
+    rooms = list(self.room_ids)
+    self.random.shuffle(rooms)
+    bulk(BundleRoomAssignment, [ BundleRoomAssignment(bundle_id=bid, room_id=rid, fromSlot=first,
+                                                      toSlot=last, toLength=last.length,
+                                                      startMin=slot_minute(first),
+                                                      endMin=slot_minute(last) + last.length.length)
+                                 for (bid, rid) in zip(bundle_ids, rooms) ])
+
+    # Loose things go on an item each; the odd bundle is borrowed by an item, too.
+    scheduled = list(self.scheduled_ids)
+    self.random.shuffle(scheduled)
+    bulk(KitItemAssignment, [ KitItemAssignment(item_id=iid, thing_id=tid)
+                              for (tid, iid) in zip(loose, scheduled) ])
+    bulk(BundleItemAssignment, [ BundleItemAssignment(item_id=self.random.choice(scheduled), bundle_id=bid)
+                                 for bid in bundle_ids if scheduled and self.random.random() < 0.2 ])
+
+    defaults = field_defaults(KitRequest)
+    askers = [ iid for iid in self.scheduled_ids if self.random.random() < 0.2 ]
+    requests = [ KitRequest(kind_id=self.random.choice(kinds).id, count=self.random.randint(1, 2), **defaults)
+                 for iid in askers ]
+    request_ids = bulk_ids(KitRequest, requests)
+    through = Item.kitRequests.through
+    bulk(through, [ through(item_id=iid, kitrequest_id=rid) for (iid, rid) in zip(askers, request_ids) ])
+    self.made['kitthings'] = len(thing_ids)
+    self.made['kitbundles'] = len(bundle_ids)
+    self.made['kitrequests'] = len(request_ids)
@@ -92,9 +92,13 @@ class Tabler:
       t.paginate(page=1, per_page=len(data))
     return t
 
+def tabler_excludes(mcls, request, extra_exclude=[]):
+  "The columns that make_tabler() leaves out of mcls's table, for this request."
+  exclude = mcls.tabler_exclude(request)
+  return extra_exclude if exclude == None else exclude + extra_exclude
+
 def make_tabler(mcls, tcls, request, qs, prefix=None, empty=None, extra_exclude=[]):
   rower = mcls.rower(request)
-  exclude = mcls.tabler_exclude(request)
-  exclude = extra_exclude if exclude == None else exclude + extra_exclude
+  exclude = tabler_excludes(mcls, request, extra_exclude)
   tbl = Tabler(tcls, rower, empty_text=empty)
   return tbl.table(qs, request=request, prefix=prefix, exclude=exclude)
@@ -19,13 +19,21 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.test.client import Client
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 from django.utils.html import escape
 from django.core.exceptions import ValidationError
 from django.core import mail
+from django.db import connection
+from django.utils import simplejson
 
 from .models import Grid, Gender, Slot, SlotLength, Room
 from .models import SlotLength, ConDay, ConInfoBool, ConInfoInt, ConInfoString
@@ -37,8 +45,15 @@ from .models import KitThing, KitRequest, KitBundle, KitRole, KitDepartment
 from .models import KitKind, KitStatus, RoomCapacity, KitSource, KitBasis
 from .models import KitRoomAssignment, KitItemAssignment, KitSatisfaction
 from .models import BundleItemAssignment, BundleRoomAssignment
-from .models import Check, CheckResult
+from .models import Check, CheckResult, StaleSubject, ChangeLog, slot_minute, latest_change, change_version
 from .forms import PersonForm
+from .gridmatrix import GridMatrix
+from .xmldump import xml_dump
+from .publish import publish
+from .pdf import StreampunkPdf, render_document
+from .jobs import claim_job, run_job
+from .models import Job
+from .printing import items_by_day_and_room, drinks_forms
 from .exceptions import DeleteNeededObjectException, DeleteUndefException, DeleteDefaultException
 from .testutils import itemdict, persondict, kitreqdict, kitthingdict, kitbundledict
 from .testutils import default_person, default_item, default_itemperson
@@ -2415,6 +2430,294 @@ class test_overlaps(AuthTest):
     self.assertTrue(disco.overlaps(ceilidh))
     self.assertTrue(ceilidh.overlaps(disco))
 
+  def test_item_minutes(self):
+    "Items keep their start and end, in minutes, up to date."
+    # Loading the fixtures doesn't go through save(), but they're filled in anyway.
+    for i in Item.objects.all():
+      self.assertEqual((i.startMin, i.endMin), i.period())
+    self.assertEqual(Item.objects.filter(startMin=None).exclude(start__day__isUndefined=True).count(), 0)
+    for kra in KitRoomAssignment.objects.all():
+      self.assertEqual((kra.startMin, kra.endMin), kra.period())
+    for bra in BundleRoomAssignment.objects.all():
+      self.assertEqual((bra.startMin, bra.endMin), bra.period())
+
+    # Changing the slot the disco's in moves the disco, too.
+    disco = self.get_disco()
+    slot = disco.start
+    slot.start += 30
+    slot.save()
+    disco = self.get_disco()
+    self.assertEqual(disco.startMin, slot_minute(slot))
+    self.assertEqual(disco.endMin, slot_minute(slot) + disco.length.length)
+    self.assertTrue(disco in disco.room.items_between(disco.startMin, disco.startMin + 1))
+    self.assertFalse(disco in disco.room.items_between(disco.endMin, disco.endMin + 60))
+
+  def test_item_minutes_logged(self):
+    "Items moved by a change to their slot are logged, and their problems marked, as if they'd been saved."
+    from .problems import rebuild
+    rebuild([ Check.objects.get(name='Kit clashes') ], workers=1)
+    disco = self.get_disco()
+    logs = latest_change()
+    slot = disco.start
+    slot.start += 30
+    slot.save()
+    self.assertTrue(ChangeLog.objects.filter(id__gt=logs, log_id=disco.id, field='istart').exists())
+    subjects = set(StaleSubject.objects.values_list('subject', flat=True))
+    self.assertTrue("item:%d" % (disco.id,) in subjects)
+    self.assertTrue("room:%d" % (disco.room_id,) in subjects)
+
+  def test_past_midnight(self):
+    "An item that runs past midnight is on in the first slots of the next day."
+    disco = self.get_disco()
+    friday = Slot.objects.filter(day__name='Friday').order_by('-start')[0]
+    saturday = ConDay.objects.get(name='Saturday')
+    # A slot that's early on Saturday morning, but after Friday's last slot.
+    late = Slot(start=friday.start - 24 * 60 + 30, day=saturday, startText='Late', slotText='Late', order=999)
+    late.save()
+    disco.start = friday
+    disco.length = SlotLength.objects.get(length=120)
+    disco.save()
+    self.assertTrue(disco in late.items())
+    self.assertTrue(disco in late.items(disco.room))
+    self.assertTrue(late in disco.slots())
+    self.assertTrue(friday in disco.slots())
+    self.assertTrue(disco in disco.room.items_between(slot_minute(late), slot_minute(late) + 1))
+    # Something in that slot clashes with the disco.
+    ceilidh = self.get_ceilidh()
+    ceilidh.start = late
+    ceilidh.save()
+    self.assertTrue(disco.overlaps(ceilidh))
+    self.assertTrue(ceilidh.overlaps(disco))
+
+# =========================================================
+
+class test_clashes(AuthTest):
+  "Clash checks."
+  fixtures = [ 'demo_data' ]
+
+  PeopleClashes = "People clashes"
+  RoomClashes = "Room clashes"
+
+  def setUp(self):
+    self.mkroot()
+    self.client = Client()
+    self.logged_in_okay = self.client.login(username='congod', password='xxx')
+
+  def tearDown(self):
+    self.client.logout()
+    self.zaproot()
+
+  def get_closingceremony(self):
+    return Item.objects.get(shortname='closing ceremony')
+
+  def test_person_clash(self):
+    "Moving an item on top of another with the same people should be a clash."
+    opening = self.get_openingceremony()
+    closing = self.get_closingceremony()
+    check_lists_item(self, self.PeopleClashes, closing, False)
+
+    closing.start = opening.start
+    closing.save()
+    check_lists_item(self, self.PeopleClashes, closing, True)
+    check_lists_item(self, self.PeopleClashes, opening, True)
+
+    # Finishing as the other starts isn't a clash.
+    closing.start = Slot.objects.get(day=opening.start.day, start=opening.start.start + 60)
+    closing.save()
+    check_lists_item(self, self.PeopleClashes, closing, False)
+
+  def add_room_clash_check(self):
+    Check(name=self.RoomClashes, module='room_clashes', description='Items in the same room at the same time',
+          result=CheckResult.objects.get(name='Mixed Tuple')).save()
+
+  def test_room_clash(self):
+    "Items in the same room at the same time clash."
+    self.add_room_clash_check()
+    # The Friday first-timers and stewards are both in Programme 2 at 7pm.
+    firsttimers = Item.objects.get(shortname='First timers 1')
+    stewards = Item.objects.get(shortname='Stewards 1')
+    self.assertEqual(firsttimers.room, stewards.room)
+    check_lists_item(self, self.RoomClashes, firsttimers, True)
+
+    stewards.start = Slot.objects.get(day=firsttimers.start.day, start=firsttimers.start.start + 60)
+    stewards.save()
+    check_lists_item(self, self.RoomClashes, firsttimers, False)
+
+  def test_room_clash_parent(self):
+    "An item in a room clashes with items in the room's sub-rooms."
+    self.add_room_clash_check()
+    disco = self.get_disco()
+    tolkien = self.get_tolkien()
+    video = self.get_video()
+    tolkien.room = video
+    tolkien.start = disco.start
+    tolkien.save()
+    check_lists_item(self, self.RoomClashes, tolkien, False)
+
+    # Make the video room part of the main hall.
+    video.parent = self.get_mainhall()
+    video.save()
+    check_lists_item(self, self.RoomClashes, tolkien, True)
+    check_lists_item(self, self.RoomClashes, disco, True)
+
+  def test_kit_clash(self):
+    "Kit in one room while it's on an item elsewhere clashes, whether assigned directly or in a bundle."
+    from .checks import kit_clashes
+    check = Check.objects.get(name='Kit clashes')
+    firsttimers = Item.objects.get(shortname='First timers 1')
+    greenroom = self.get_greenroomkit()
+    kia = KitItemAssignment.objects.get(item=firsttimers, thing=self.get_greenroomproj())
+    bia = BundleItemAssignment.objects.get(item=firsttimers, bundle=greenroom)
+    bra = BundleRoomAssignment.objects.get(bundle=greenroom)
+    # Having the same thing directly and in a bundle on the one item is fine.
+    self.assertEqual(kit_clashes.run_check(check).things, [])
+
+    # Move the item into the period when the bundle is assigned to another room.
+    firsttimers.start = bra.fromSlot
+    firsttimers.save()
+    things = kit_clashes.run_check(check).things
+    self.assertTrue((bra, kia, self.get_greenroomproj()) in things)
+    self.assertTrue((bra, bia, self.get_greenroomscr()) in things)
+    self.assertFalse((kia, bia, self.get_greenroomproj()) in things)
+
+  def test_kit_clash_same_room(self):
+    "The same thing assigned twice to the one room at the same time clashes."
+    from .checks import kit_clashes
+    check = Check.objects.get(name='Kit clashes')
+    disco = self.get_disco()
+    proj = KitThing(name='Proj2', kind=self.get_proj(), count=2, coordinator='Bob')
+    proj.save()
+    first = KitRoomAssignment(room=disco.room, thing=proj,
+                              fromSlot=disco.start, toSlot=disco.start, toLength=disco.length)
+    first.save()
+    self.assertEqual([ t for t in kit_clashes.run_check(check).things if t[2] == proj ], [])
+
+    second = KitRoomAssignment(room=disco.room, thing=proj,
+                               fromSlot=disco.start, toSlot=disco.start, toLength=disco.length)
+    second.save()
+    things = kit_clashes.run_check(check).things
+    self.assertTrue((first, second, proj) in things)
+    self.assertTrue((second, first, proj) in things)
+
+# =========================================================
+
+class test_check_runner(AuthTest):
+  "Running checks over a shared snapshot."
+  fixtures = [ 'demo_data' ]
+
+  def test_runner_matches_run_check(self):
+    "Every check gives the same answer from the runner as when run on its own."
+    from .checks.runner import run_checks, check_module
+    checks = list(Check.objects.order_by('name'))
+    outputs = run_checks(checks, workers=1)
+    self.assertEqual(len(outputs), len(checks))
+    for (check, output) in zip(checks, outputs):
+      self.assertEqual(output.check, check)
+      self.assertTrue(output.elapsed >= 0)
+      alone = check_module(check).run_check(check)
+      self.assertEqual(len(output.things), alone.count)
+
+  def test_snapshot_needs(self):
+    "A check only loads the parts of the programme it needs."
+    from .checks import no_email
+    from .snapshot import ProgrammeSnapshot
+    with CaptureQueriesContext(connection) as full:
+      ProgrammeSnapshot()
+    with CaptureQueriesContext(connection) as people:
+      snapshot = ProgrammeSnapshot(needs=no_email.needs)
+    self.assertTrue(len(people) < len(full))
+    self.assertFalse(hasattr(snapshot, 'items'))
+    self.assertEqual(no_email.find_problems(snapshot), no_email.find_problems(ProgrammeSnapshot()))
+
+  def test_no_fork_in_thread(self):
+    "The runner only starts worker processes from the main thread."
+    import threading
+    from .pool import can_fork
+    self.assertTrue(can_fork())
+    found = []
+    thread = threading.Thread(target=lambda: found.append(can_fork()))
+    thread.start()
+    thread.join()
+    self.assertEqual(found, [ False ])
+
+  def test_runchecks_command(self):
+    "The runchecks command gives the problems as JSON, and fails if there are any."
+    from StringIO import StringIO
+    from django.core.management import call_command
+    from django.core.management.base import CommandError
+    from django.utils import simplejson
+    out = StringIO()
+    call_command('runchecks', 'person_clashes', workers=1, stdout=out, stderr=StringIO())
+    result = simplejson.loads(out.getvalue())
+    self.assertEqual([ c['module'] for c in result['checks'] ], [ 'person_clashes' ])
+    self.assertEqual(result['checks'][0]['count'], 0)
+
+    opening = self.get_openingceremony()
+    closing = Item.objects.get(shortname='closing ceremony')
+    closing.start = opening.start
+    closing.save()
+    out = StringIO()
+    # Older Djangos turn the CommandError into an exit.
+    self.assertRaises((CommandError, SystemExit), call_command, 'runchecks', 'person_clashes',
+                      workers=1, stdout=out, stderr=StringIO())
+    problems = simplejson.loads(out.getvalue())['checks'][0]['problems']
+    self.assertTrue([ { "kind": "item", "id": closing.id, "name": unicode(closing) },
+                      { "kind": "item", "id": opening.id, "name": unicode(opening) } ]
+                    in [ p[:2] for p in problems ])
+
+    self.assertRaises((CommandError, SystemExit), call_command, 'runchecks', 'no_such_check',
+                      stdout=StringIO(), stderr=StringIO())
+
+# =========================================================
+
+class test_problem_store(AuthTest):
+  "Keeping the checks' problems up to date as the programme changes."
+  fixtures = [ 'demo_data' ]
+
+  def assertStoredMatchesFresh(self, checks):
+    from .checks.runner import run_checks
+    from .problems import results, encode
+    stored = results(checks)
+    fresh = run_checks(checks, workers=1)
+    for (s, f) in zip(stored, fresh):
+      self.assertEqual(sorted([ encode(p) for p in s.things ]),
+                       sorted([ encode(p) for p in f.things ]), s.check.name)
+
+  def test_nothing_noted_until_built(self):
+    "Until a check has been built, saving things doesn't note anything."
+    disco = self.get_disco()
+    disco.room = self.get_video()
+    disco.save()
+    self.assertEqual(StaleSubject.objects.count(), 0)
+
+  def test_incremental_matches_rebuild(self):
+    "After changes, the stored problems are the same as working everything out again."
+    from .problems import rebuild
+    checks = list(Check.objects.order_by('name'))
+    rebuild(checks, workers=1)
+    self.assertStoredMatchesFresh(checks)
+
+    # Clash the closing ceremony with the opening one.
+    opening = self.get_openingceremony()
+    closing = Item.objects.get(shortname='closing ceremony')
+    closing.start = opening.start
+    closing.save()
+    self.assertTrue(StaleSubject.objects.count() > 0)
+    self.assertStoredMatchesFresh(checks)
+    self.assertEqual(StaleSubject.objects.count(), 0)
+
+    # Move a room under another, and put someone on an item they're not around for.
+    video = self.get_video()
+    video.parent = self.get_mainhall()
+    video.save()
+    ItemPerson(item=self.get_ceilidh(), person=self.get_xander()).save()
+    self.assertStoredMatchesFresh(checks)
+
+    # Take some kit out of a bundle, and delete an item with a clash.
+    self.get_greenroomkit().things.remove(self.get_greenroomproj())
+    opening.delete()
+    self.assertStoredMatchesFresh(checks)
+
 # =========================================================
 
 class test_satisfaction(AuthTest):
@@ -2656,6 +2959,43 @@ class test_satisfaction(AuthTest):
     # Check indirectly
     check_lists_item(self, self.ItemsWithUnsatisfiedKitReqs, disco, True)
 
+  def test_bundle_satisfies_by_kind(self):
+    "Things in a room's bundle count towards requests for their kind."
+    disco = self.get_disco()
+    mics = KitKind.objects.get(name='Microphone')
+    # The main hall kit has 6 stage mics and 2 roving mics, so 7 is enough.
+    self.add_req_to_item(default_kitrequest({ "count": 7, "kind": mics.id }), disco)
+    ks = KitSatisfaction(disco)
+    self.assertTrue(ks.satisfied)
+    self.assertEqual(ks.requested, 7)
+    self.assertEqual(ks.provided, 7)
+    self.assertEqual(ks.missing, 0)
+
+  def test_for_items(self):
+    "Working out satisfaction in bulk gives the same answers as one at a time."
+    disco = self.get_disco()
+    self.add_req_to_item(self.req_proj(3), disco)
+    sats = KitSatisfaction.for_items(Item.objects.all())
+    self.assertEqual(len(sats), Item.objects.count())
+    for ks in sats:
+      single = KitSatisfaction(Item.objects.get(id=ks.item.id))
+      self.assertEqual(ks.satisfied, single.satisfied)
+      self.assertEqual(ks.requestMap, single.requestMap)
+      self.assertEqual(ks.totalMap, single.totalMap)
+      self.assertEqual(ks.missingMap, single.missingMap)
+      # The item remembers it, too.
+      self.assertEqual(ks.item.satisfies_kit_requests(), single.satisfied)
+
+  def test_list_only_shown_kit(self):
+    "The item lists only work out kit when they show the kit column."
+    kit_tables = ('streampunk_kititemassignment', 'streampunk_kitroomassignment')
+    for (name, shown) in (('list_items', False), ('list_items_tech', True)):
+      with CaptureQueriesContext(connection) as context:
+        self.response = self.client.get(reverse(name))
+      self.status_okay()
+      queried = [ q['sql'] for q in context.captured_queries if any([ t in q['sql'] for t in kit_tables ]) ]
+      self.assertEqual(bool(queried), shown)
+
 class test_kitreq_listings(AuthTest):
   "Check the listing of kit requests"
 
@@ -2964,6 +3304,45 @@ class test_person_availability(AuthTest):
       buffy.availability.add(s)
     self.assertFalse(buffy.available_for(disco))
 
+  def test_check_agrees(self):
+    "The bulk availability check finds the same people as available_for()."
+    from .checks import person_not_avail
+    # Xander is only available on Saturday, so can't do the Friday ceilidh.
+    ceilidh = self.get_ceilidh()
+    xander = self.get_xander()
+    ItemPerson(item=ceilidh, person=xander).save()
+    expected = set([ (ip.item.id, ip.person.id) for ip in ItemPerson.objects.filter(item__in=Item.scheduled.all(),
+                                                                                    role__canClash=True)
+                                                if not ip.person.available_for(ip.item) ])
+    self.assertTrue((ceilidh.id, xander.id) in expected)
+    found = person_not_avail.run_check(Check.objects.get(name='People unavailable')).things
+    self.assertEqual(set([ (i.id, p.id) for (i, p) in found ]), expected)
+
+  def test_changed_from_slot_side(self):
+    "Availability changed from the slot's side isn't hidden by the cached mask."
+    disco = self.get_disco()
+    buffy = self.get_buffy()
+    buffy.availability.add(self.get_morning())
+    self.assertFalse(buffy.available_for(disco))
+    for s in disco.slots():
+      s.person_set.add(buffy)
+    self.assertTrue(buffy.available_for(disco))
+    disco.slots()[0].person_set.clear()
+    self.assertFalse(buffy.available_for(disco))
+
+  def test_slot_order_is_unique(self):
+    "Availability is kept by slot order, so two slots can't share one, nor have a negative one."
+    morning = self.get_morning()
+    slot = Slot(start=morning.start, length=morning.length, day=morning.day,
+                startText='Dup', slotText='Dup', order=morning.order)
+    with self.assertRaises(ValidationError):
+      slot.full_clean()
+    slot.order = -1
+    with self.assertRaises(ValidationError):
+      slot.full_clean()
+    slot.order = Slot.objects.order_by('-order')[0].order + 1
+    slot.full_clean()
+
 # =========================================================
 
 class test_kit_availability(AuthTest):
@@ -3397,6 +3776,325 @@ class test_grids(AuthTest):
     self.assertTrue(dawn in cabaret.people_public())
     self.assertFalse(dawn in ceilidh.people_public())
 
+  def test_grid_matrix(self):
+    "The grid matrix has the same items in each cell as the slots do, merging slots where it can."
+    disco = self.get_disco()
+    grid = disco.start.grid_set.first()
+    matrix = GridMatrix(grid)
+    grid_slots = [ s.id for s in matrix.slots ]
+    for (r, cells) in matrix.by_room:
+      # Each room's cells cover the grid's slots, in order, once each.
+      self.assertEqual([ s.id for c in cells for s in c.slots ], grid_slots)
+      for c in cells:
+        for s in c.slots:
+          self.assertEqual(set([ i.id for i in c.items ]), set([ i.id for i in s.items(r) ]))
+    # The disco gets a single cell for the part of it that's in the grid.
+    cell = matrix.cell(disco.room, disco.start)
+    self.assertEqual([ i.id for i in cell.items ], [ disco.id ])
+    self.assertEqual([ s.id for s in cell.slots ], [ s.id for s in disco.slots() if s.id in grid_slots ])
+    # Drawn the other way round, each slot's row has the cells starting there.
+    for (s, cells) in matrix.by_slot:
+      for c in cells:
+        self.assertEqual(c.slot, s)
+    self.assertEqual(sum([ len(cells) for (s, cells) in matrix.by_slot ]),
+                     sum([ len(cells) for (r, cells) in matrix.by_room ]))
+
+  def test_grid_item_cache(self):
+    "A grid's items are cached, until an item in the grid's time window changes."
+    disco = self.get_disco()
+    grid = disco.start.grid_set.first()
+    on = set([ i.id for s in grid.slots.all() for i in s.items() ])
+    self.assertEqual(set(grid.item_ids()), on)
+    self.assertTrue(disco in grid.items())
+    with self.assertNumQueries(0):
+      grid.item_ids()
+
+    # Move the disco to another day, out of the grid.
+    days = [ s.day_id for s in grid.slots.all() ]
+    elsewhere = Slot.objects.filter(isUndefined=False, day__isUndefined=False).exclude(day__in=days)[0]
+    disco.start = elsewhere
+    disco.save()
+    self.assertFalse(disco in grid.items())
+    for other in elsewhere.grid_set.all():
+      self.assertTrue(disco in other.items())
+
+    # And back again, to be deleted.
+    disco.start = grid.slots.all()[0]
+    disco.save()
+    self.assertTrue(disco in grid.items())
+    disco_id = disco.id
+    disco.delete()
+    self.assertFalse(disco_id in grid.item_ids())
+
+    # Taking a slot out of the grid takes its items with it.
+    slot = grid.slots.all()[0]
+    grid.item_ids()
+    grid.slots.remove(slot)
+    self.assertEqual(set(grid.item_ids()), set([ i.id for s in grid.slots.all() for i in s.items() ]))
+
+  def grid_page_queries(self, grid):
+    "Fetch the grid's page, and return how many queries it took."
+    with CaptureQueriesContext(connection) as context:
+      self.response = self.client.get(reverse('show_grid', args=[int(grid.id)]))
+    self.status_okay()
+    return len(context)
+
+  def test_grid_queries(self):
+    "Drawing a grid takes the same number of queries, however much is in it."
+    disco = self.get_disco()
+    grid = disco.start.grid_set.first()
+    before = self.grid_page_queries(grid)
+    for p in [ self.get_buffy(), self.get_giles(), self.get_dawn() ]:
+      if not ItemPerson.objects.filter(item=disco, person=p).exists():
+        ItemPerson(item=disco, person=p).save()
+    for (n, s) in enumerate(grid.slots.all()):
+      item = Item(title='Extra item %d' % (n,), start=s, room=self.get_mainhall())
+      item.save()
+      ItemPerson(item=item, person=self.get_buffy()).save()
+    self.assertEqual(self.grid_page_queries(grid), before)
+    self.has_link_to('show_item_detail', args=[int(item.id)])
+
+class test_grid_moves(AuthTest):
+  "Moving several items at once, from the drag grid."
+  fixtures = [ 'demo_data' ]
+
+  def setUp(self):
+    self.mkroot()
+    self.client = Client()
+    self.logged_in_okay = self.client.login(username='congod', password='xxx')
+
+  def tearDown(self):
+    self.client.logout()
+    self.zaproot()
+
+  def move(self, grid, moves):
+    self.response = self.client.post(reverse('api_grid_moves', args=[int(grid.id)]),
+                                     simplejson.dumps({ "moves": moves }),
+                                     content_type='application/json', HTTP_ACCEPT='application/json')
+    return simplejson.loads(self.response.content)
+
+  def test_moves(self):
+    "Moves are applied and logged, and come back with the grid and the clashes they cause."
+    opening = self.get_openingceremony()
+    closing = Item.objects.get(shortname='closing ceremony')
+    grid = opening.start.grid_set.first()
+    logs = ChangeLog.objects.filter(log_id=closing.id, field='istart').count()
+
+    # Moving the opening ceremony to where it already is does nothing.
+    data = self.move(grid, [ { "item": opening.id, "room": opening.room.id, "start": opening.start.id },
+                             { "item": closing.id, "room": opening.room.id, "start": opening.start.id } ])
+    self.status_okay()
+    self.assertEqual(data['moved'], [ closing.id ])
+    closing = Item.objects.get(id=closing.id)
+    self.assertEqual(closing.room, opening.room)
+    self.assertEqual(closing.start, opening.start)
+    self.assertEqual((closing.startMin, closing.endMin), closing.period())
+    self.assertEqual(ChangeLog.objects.filter(log_id=closing.id, field='istart').count(), logs + 1)
+    self.assertTrue(closing.id in [ i['id'] for i in data['grid']['items'] ])
+    # They share people as well as the room.
+    clashes = [ c for c in data['clashes'] if c['item'] == closing.id and c['with'] == opening.id ]
+    self.assertTrue([ c for c in clashes if 'person' in c ])
+
+  def test_bad_moves(self):
+    "Nothing is moved if any of the moves is wrong."
+    disco = self.get_disco()
+    grid = disco.start.grid_set.first()
+    data = self.move(grid, [ { "item": disco.id, "room": self.get_mainhall().id, "start": disco.start.id },
+                             { "item": 0, "room": disco.room.id, "start": disco.start.id } ])
+    self.assertEqual(self.response.status_code, 400)
+    self.assertTrue(data['non_field_errors'])
+    self.assertEqual(Item.objects.get(id=disco.id).room, disco.room)
+
+class test_api_queries(AuthTest):
+  "The API's query counts don't grow with the number of items, people or rooms."
+  fixtures = [ 'demo_data' ]
+
+  def setUp(self):
+    self.mkroot()
+    self.client = Client()
+    self.logged_in_okay = self.client.login(username='congod', password='xxx')
+
+  def tearDown(self):
+    self.client.logout()
+    self.zaproot()
+
+  def queries(self, url):
+    "Fetch the url, and return how many queries it took."
+    with CaptureQueriesContext(connection) as context:
+      self.response = self.client.get(url, HTTP_ACCEPT='application/json')
+    self.status_okay()
+    return len(context)
+
+  def add_items(self, slots):
+    "Add an item with a couple of people to each slot."
+    for (n, s) in enumerate(slots):
+      item = Item(title='Extra item %d' % (n,), start=s, room=self.get_mainhall())
+      item.save()
+      for p in [ self.get_buffy(), self.get_giles() ]:
+        ItemPerson(item=item, person=p).save()
+
+  def test_grid_api(self):
+    grid = self.get_disco().start.grid_set.first()
+    url = reverse('api_grid', args=[int(grid.id)])
+    before = self.queries(url)
+    self.add_items(grid.slots.all())
+    self.assertEqual(self.queries(url), before)
+    self.assertEqual(len(simplejson.loads(self.response.content)['items']), len(grid.item_ids()))
+
+  def test_slot_items_api(self):
+    disco = self.get_disco()
+    url = reverse('api_slot_items', args=[int(disco.start.id)])
+    before = self.queries(url)
+    self.add_items([ disco.start ] * 3)
+    self.assertEqual(self.queries(url), before)
+    found = simplejson.loads(self.response.content)
+    self.assertEqual(len(found), len(disco.start.items()))
+    for i in found:
+      if i['id'] == disco.id:
+        self.assertEqual([ s['id'] for s in i['slots'] ], [ s.id for s in disco.slots() ])
+
+  def test_rooms_api(self):
+    url = reverse('api_rooms')
+    before = self.queries(url)
+    for n in range(3):
+      Room(name='Extra room %d' % (n,)).save()
+    self.assertEqual(self.queries(url), before)
+
+class test_conditional_get(AuthTest):
+  "Polled pages answer with a 304 until the programme changes."
+  fixtures = [ 'demo_data' ]
+
+  def setUp(self):
+    self.mkroot()
+    self.client = Client()
+    self.logged_in_okay = self.client.login(username='congod', password='xxx')
+
+  def tearDown(self):
+    self.client.logout()
+    self.zaproot()
+
+  def fetch(self, url, client=None, **headers):
+    self.response = (client or self.client).get(url, HTTP_ACCEPT='application/json', **headers)
+    return self.response
+
+  def urls(self):
+    grid = self.get_disco().start.grid_set.first()
+    return [ reverse('konopas'), reverse('xml_dump'), reverse('api_rooms'),
+             reverse('api_grid', args=[int(grid.id)]),
+             reverse('api_item', args=[int(self.get_disco().id)]),
+             reverse('api_slot_items', args=[int(self.get_disco().start.id)]) ]
+
+  def test_not_modified(self):
+    # Two queries for the version; logged in, two more for the session and user.
+    for (client, queries) in [ (Client(), 2), (self.client, 4) ]:
+      for url in self.urls():
+        etag = self.fetch(url, client)['ETag']
+        self.status_okay()
+        with self.assertNumQueries(queries):
+          self.fetch(url, client, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(self.response.status_code, 304)
+        self.fetch(url, client, HTTP_IF_MODIFIED_SINCE=self.response['Last-Modified'])
+        self.assertEqual(self.response.status_code, 304)
+
+  def test_private_etag(self):
+    "Someone who can see private details doesn't get the public copy, and vice versa."
+    public = Client()
+    for url in self.urls():
+      etag = self.fetch(url, public)['ETag']
+      self.assertNotEqual(self.fetch(url)['ETag'], etag)
+      self.assertEqual(self.fetch(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+  def test_changes(self):
+    "Changes the ChangeLog doesn't record still change the version."
+    url = reverse('konopas')
+    etag = self.fetch(url)['ETag']
+    room = self.get_mainhall()
+    room.name = 'Great Hall'
+    room.save()
+    self.assertEqual(self.fetch(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+    etag = self.response['ETag']
+    disco = self.get_disco()
+    disco.tags.add(self.get_books())
+    self.assertEqual(self.fetch(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+class test_change_feed(AuthTest):
+  "The feed of changed items, for keeping a drag grid up to date."
+  fixtures = [ 'demo_data' ]
+
+  def changes(self, since=None):
+    params = { "since": since } if since is not None else {}
+    self.response = self.client.get(reverse('api_changes'), params, HTTP_ACCEPT='application/json')
+    self.status_okay()
+    return simplejson.loads(self.response.content)
+
+  def test_changes(self):
+    version = self.changes()['version']
+    self.assertEqual(self.changes(version)['items'], [])
+
+    disco = self.get_disco()
+    disco.room = self.get_mainhall()
+    disco.save()
+    ItemPerson(item=self.get_bidsession(), person=self.get_buffy()).save()
+    cabaret_id = self.get_cabaret().id
+    self.get_cabaret().delete()
+    found = self.changes(version)
+    self.assertEqual(set([ i['id'] for i in found['items'] ]), set([ disco.id, self.get_bidsession().id ]))
+    self.assertEqual(found['deleted'], [ cabaret_id ])
+    self.assertFalse(found['reload'])
+    moved = [ i for i in found['items'] if i['id'] == disco.id ][0]
+    self.assertEqual(moved['room'], self.get_mainhall().id)
+
+    # Taking someone off an item doesn't say which item.
+    version = found['version']
+    ItemPerson.objects.filter(item=self.get_bidsession(), person=self.get_buffy())[0].delete()
+    self.assertTrue(self.changes(version)['reload'])
+
+    # Nor does tagging an item, which isn't in the ChangeLog at all.
+    version = self.changes()['version']
+    self.assertFalse(self.changes(version)['reload'])
+    self.get_disco().tags.add(self.get_books())
+    self.assertTrue(self.changes(version)['reload'])
+
+  def test_role_changes(self):
+    "Changing someone's role or status on an item sends the item again."
+    ip = ItemPerson.objects.all()[0]
+    version = self.changes()['version']
+    ip.role = PersonRole.objects.exclude(id=ip.role_id)[0]
+    ip.save()
+    found = self.changes(version)
+    self.assertEqual([ i['id'] for i in found['items'] ], [ ip.item_id ])
+    self.assertFalse(found['reload'])
+
+    version = found['version']
+    ip.status = PersonStatus.objects.exclude(id=ip.status_id)[0]
+    ip.save()
+    found = self.changes(version)
+    self.assertEqual([ i['id'] for i in found['items'] ], [ ip.item_id ])
+    self.assertFalse(found['reload'])
+
+  def test_grid_changes(self):
+    "Asked about one grid, the feed only sends the items on it, and says which have moved off it."
+    disco = self.get_disco()
+    grid = disco.start.grid_set.first()
+    version = self.changes()['version']
+    disco.room = self.get_mainhall()
+    disco.save()
+    self.response = self.client.get(reverse('api_changes'), { "since": version, "grid": grid.id },
+                                    HTTP_ACCEPT='application/json')
+    self.status_okay()
+    found = simplejson.loads(self.response.content)
+    self.assertEqual([ i['id'] for i in found['items'] ], [ disco.id ])
+    self.assertEqual(found['elsewhere'], [])
+
+    other = Slot.objects.exclude(day__in=grid.slots.values('day')).exclude(day__isUndefined=True).order_by('start')[0]
+    disco.start = other
+    disco.save()
+    self.response = self.client.get(reverse('api_changes'), { "since": version, "grid": grid.id },
+                                    HTTP_ACCEPT='application/json')
+    found = simplejson.loads(self.response.content)
+    self.assertEqual(found['items'], [])
+    self.assertEqual(found['elsewhere'], [ disco.id ])
+
 class test_grids_public(NonauthTest):
   "Test what the templates retrieve, for grids."
   fixtures = [ 'demo_data' ]
@@ -3582,47 +4280,50 @@ class test_xml_public(NonauthTest):
   def setUp(self):
     self.client = Client()
 
+  def fetch_xml(self):
+    "The dump is streamed, so gather it up."
+    self.response = self.client.get(reverse('xml_dump'))
+    self.status_okay()
+    self.content = ''.join(self.response.streaming_content)
+
   def test_rooms(self):
     "Check all the visible rooms are listed."
 
-    self.response = self.client.get(reverse('xml_dump'))
-    self.status_okay()
+    self.fetch_xml()
     for room in Room.objects.filter(visible=True):
-      self.assertTrue(room.name in self.response.content)
+      self.assertTrue(room.name in self.content)
     for room in Room.objects.exclude(visible=True):
-      self.assertFalse(room.name in self.response.content)
+      self.assertFalse(room.name in self.content)
 
   def test_people(self):
     "Check all the people are listed, by badge name."
 
-    self.response = self.client.get(reverse('xml_dump'))
-    self.status_okay()
+    self.fetch_xml()
     for person in Person.objects.all():
       if person.as_name() != person.as_badge():
         # If their name doesn't match their badge, we shouldn't see their name.
-        self.assertFalse(person.as_name() in self.response.content)
-      self.assertTrue(person.as_badge() in self.response.content)
+        self.assertFalse(person.as_name() in self.content)
+      self.assertTrue(person.as_badge() in self.content)
 
   def test_items(self):
     "Check all the visible items are listed, if they're in a visible room."
 
-    self.response = self.client.get(reverse('xml_dump'))
-    self.status_okay()
+    self.fetch_xml()
     for item in Item.scheduled.filter(visible=True):
-      self.assertTrue(escape(item.title) in self.response.content)
-      self.assertTrue(escape(item.shortname) in self.response.content)
+      self.assertTrue(escape(item.title) in self.content)
+      self.assertTrue(escape(item.shortname) in self.content)
     for item in Item.scheduled.exclude(visible=True):
       # Checking item is omitted as item is not visible
-      self.assertFalse(escape(item.title) in self.response.content)
-      self.assertFalse(escape(item.shortname) in self.response.content)
+      self.assertFalse(escape(item.title) in self.content)
+      self.assertFalse(escape(item.shortname) in self.content)
     for item in Item.scheduled.exclude(room__visible=True):
       # Checking item is omitted as item's room is not visible
-      self.assertFalse(escape(item.title) in self.response.content)
-      self.assertFalse(escape(item.shortname) in self.response.content)
+      self.assertFalse(escape(item.title) in self.content)
+      self.assertFalse(escape(item.shortname) in self.content)
     for item in Item.unscheduled.all():
       # Checking item is omitted as item is not scheduled
-      self.assertFalse(escape(item.title) in self.response.content)
-      self.assertFalse(escape(item.shortname) in self.response.content)
+      self.assertFalse(escape(item.title) in self.content)
+      self.assertFalse(escape(item.shortname) in self.content)
 
 
 class test_xml(AuthTest):
@@ -3639,6 +4340,12 @@ class test_xml(AuthTest):
     self.client.logout()
     self.zaproot()
 
+  def fetch_xml(self):
+    "The dump is streamed, so gather it up."
+    self.response = self.client.get(reverse('xml_dump'))
+    self.status_okay()
+    self.content = ''.join(self.response.streaming_content)
+
   def test_rooms(self):
     "Check all the rooms are listed."
 
@@ -3659,33 +4366,30 @@ class test_xml(AuthTest):
     empty_video.save()
     video.capacities.add(empty_video)
 
-    self.response = self.client.get(reverse('xml_dump'))
-    self.status_okay()
+    self.fetch_xml()
     for room in Room.objects.all():
-      self.assertTrue(room.name in self.response.content)
+      self.assertTrue(room.name in self.content)
       for cap in room.capacities.all():
-        self.assertTrue(cap.as_xml() in self.response.content)
+        self.assertTrue(cap.as_xml() in self.content)
 
   def test_people(self):
     "Check all the people are listed."
 
-    self.response = self.client.get(reverse('xml_dump'))
-    self.status_okay()
+    self.fetch_xml()
     for person in Person.objects.all():
-      self.assertTrue(person.as_name() in self.response.content)
-      self.assertTrue(person.as_badge() in self.response.content)
+      self.assertTrue(person.as_name() in self.content)
+      self.assertTrue(person.as_badge() in self.content)
 
   def test_items(self):
     "Check the scheduled items are listed, and the unscheduled ones are not."
 
-    self.response = self.client.get(reverse('xml_dump'))
-    self.status_okay()
+    self.fetch_xml()
     for item in Item.scheduled.all():
-      self.assertTrue(escape(item.title) in self.response.content)
-      self.assertTrue(escape(item.shortname) in self.response.content)
+      self.assertTrue(escape(item.title) in self.content)
+      self.assertTrue(escape(item.shortname) in self.content)
     for item in Item.unscheduled.all():
-      self.assertFalse(escape(item.title) in self.response.content)
-      self.assertFalse(escape(item.shortname) in self.response.content)
+      self.assertFalse(escape(item.title) in self.content)
+      self.assertFalse(escape(item.shortname) in self.content)
 
   def test_kit(self):
     "Check that kit turns up in the XML dump."
@@ -3699,15 +4403,389 @@ class test_xml(AuthTest):
     for bra in BundleRoomAssignment.objects.all():
       assigned_to_items += bra.bundle.things_all()
     assigned_things = assigned_to_items + assigned_to_rooms
-    self.response = self.client.get(reverse('xml_dump'))
-    self.status_okay()
+    self.fetch_xml()
     for kt in KitThing.objects.all():
       if kt in assigned_things:
-        self.assertTrue(kt.as_xml() in self.response.content)
+        self.assertTrue(kt.as_xml() in self.content)
       else:
-        self.assertFalse(kt.as_xml() in self.response.content)
+        self.assertFalse(kt.as_xml() in self.content)
     for kr in KitRequest.objects.all():
-      self.assertTrue(kr.as_xml() in self.response.content)
+      self.assertTrue(kr.as_xml() in self.content)
+
+  def test_queries(self):
+    "The dump takes the same number of queries, however much is in it."
+    def queries():
+      with CaptureQueriesContext(connection) as context:
+        list(xml_dump(True))
+      return len(context)
+    before = queries()
+    disco = self.get_disco()
+    for n in range(3):
+      item = Item(title='Extra item %d' % (n,), start=disco.start, room=disco.room)
+      item.save()
+      item.tags.add(self.get_books())
+      ItemPerson(item=item, person=self.get_buffy()).save()
+      KitItemAssignment(item=item, thing=self.get_greenroomproj()).save()
+    self.assertEqual(queries(), before)
+
+  def test_since(self):
+    "A delta has just what's changed, and says what's gone."
+    since = change_version()
+    self.assertTrue('version="%s"' % (since,) in ''.join(xml_dump(False)))
+    disco = self.get_disco()
+    disco.title = 'Silent Disco'
+    disco.save()
+    ceilidh_id = self.get_ceilidh().id
+    self.get_ceilidh().delete()
+    self.response = self.client.get(reverse('xml_dump'), { 'since': since })
+    self.status_okay()
+    content = ''.join(self.response.streaming_content)
+    self.assertTrue('Silent Disco' in content)
+    self.assertFalse(self.get_cabaret().title in content)
+    self.assertTrue('<deleted_item id="item%d" />' % (ceilidh_id,) in content)
+    self.assertTrue('since="%s"' % (since,) in content)
+    self.assertTrue('reload="False"' in content)
+    self.assertEqual(self.client.get(reverse('xml_dump'), { 'since': 'x' }).status_code, 400)
+
+    # Renaming a room isn't in the ChangeLog, so the delta can't be trusted.
+    since = change_version()
+    room = self.get_mainhall()
+    room.name = 'Great Hall'
+    room.save()
+    self.assertTrue('reload="True"' in ''.join(xml_dump(False, since)))
+
+  def test_since_kind_and_role(self):
+    "Changing an item's kind, or someone's role on it, puts the item in the delta."
+    since = change_version()
+    disco = self.get_disco()
+    disco.kind = ItemKind.objects.exclude(id=disco.kind_id)[0]
+    disco.save()
+    delta = ''.join(xml_dump(False, since))
+    self.assertTrue('<item id="item%d"' % (disco.id,) in delta)
+    self.assertTrue('kind="%s"' % (disco.kind,) in delta)
+    self.assertTrue('reload="False"' in delta)
+
+    since = change_version()
+    ip = ItemPerson.objects.filter(item__visible=True, visible=True)[0]
+    ip.role = PersonRole.objects.exclude(id=ip.role_id)[0]
+    ip.save()
+    delta = ''.join(xml_dump(False, since))
+    self.assertTrue('<item id="item%d"' % (ip.item_id,) in delta)
+    self.assertTrue('role="%s"' % (ip.role,) in delta)
+    self.assertTrue('reload="False"' in delta)
+
+class test_konopas(NonauthTest):
+  "The KonOpas export."
+  fixtures = [ 'demo_data' ]
+
+  def fetch(self):
+    self.response = self.client.get(reverse('konopas'))
+    self.status_okay()
+    (program, rest) = self.response.content.split(';\n\nvar people = ')
+    (people, version) = rest.split(';\n\nvar program_version = ')
+    self.version = simplejson.loads(version.rstrip(';\n'))
+    return (simplejson.loads(program[len('var program = '):]), simplejson.loads(people))
+
+  def test_program(self):
+    (program, people) = self.fetch()
+    self.assertEqual(set([ int(i['id']) for i in program ]),
+                     set(Item.scheduled.filter(visible=True).values_list('id', flat=True)))
+    disco = [ i for i in program if i['id'] == unicode(self.get_disco().id) ][0]
+    self.assertEqual(disco['title'], self.get_disco().title)
+    self.assertEqual(disco['date'], self.get_disco().start.day.date.isoformat())
+    self.assertEqual(len(disco['time']), 5)
+    ids = set([ i['id'] for i in program ])
+    for p in people:
+      for iid in p['prog']:
+        self.assertTrue(iid in ids)
+    self.assertEqual(len(people), Person.objects.count())
+
+  def test_cached(self):
+    "The export is only written again when the programme changes."
+    self.fetch()
+    with self.assertNumQueries(2):
+      self.fetch()
+    disco = self.get_disco()
+    disco.title = 'Silent Disco'
+    disco.save()
+    (program, people) = self.fetch()
+    self.assertTrue('Silent Disco' in [ i['title'] for i in program ])
+
+  def test_since(self):
+    "A delta has just the changed items and people, and the deleted ones' ids."
+    self.fetch()
+    since = self.version
+    self.assertEqual(since, change_version())
+    disco = self.get_disco()
+    disco.title = 'Silent Disco'
+    disco.save()
+    ceilidh_id = self.get_ceilidh().id
+    self.get_ceilidh().delete()
+    self.response = self.client.get(reverse('konopas'), { 'since': since })
+    self.status_okay()
+    delta = simplejson.loads(self.response.content)
+    self.assertEqual([ i['title'] for i in delta['program'] ], [ 'Silent Disco' ])
+    self.assertEqual(delta['people'], [])
+    self.assertEqual(delta['deleted']['program'], [ ceilidh_id ])
+    self.assertFalse(delta['reload'])
+
+    self.response = self.client.get(reverse('konopas'), { 'since': delta['version'] })
+    delta = simplejson.loads(self.response.content)
+    self.assertEqual(delta['program'], [])
+    self.assertEqual(delta['deleted']['program'], [])
+
+  def test_since_links(self):
+    "Changing someone's links, or an item's kind, puts them in the delta."
+    self.fetch()
+    since = self.version
+    buffy = self.get_buffy()
+    buffy.url = 'http://example.com/buffy'
+    buffy.save()
+    disco = self.get_disco()
+    disco.kind = ItemKind.objects.exclude(id=disco.kind_id)[0]
+    disco.save()
+    self.response = self.client.get(reverse('konopas'), { 'since': since })
+    self.status_okay()
+    delta = simplejson.loads(self.response.content)
+    self.assertEqual([ p['id'] for p in delta['people'] ], [ unicode(buffy.id) ])
+    self.assertTrue(unicode(disco.id) in [ i['id'] for i in delta['program'] ])
+    self.assertFalse(delta['reload'])
+
+  def test_generations(self):
+    "Writing a new version keeps the one before it, for anyone still reading that."
+    import gzip
+    from cStringIO import StringIO
+    from .konopas import konopas_file, rewrite_konopas_file
+    root = tempfile.mkdtemp()
+    try:
+      with override_settings(STREAMPUNK_EXPORT_DIR=root):
+        first = konopas_file(('1.0', None))
+        os.utime(first, (1, 1))
+        second = konopas_file(('2.0', None))
+        os.utime(second, (2, 2))
+        third = konopas_file(('3.0', None))
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+        self.assertTrue(os.path.exists(third))
+        # Someone still wanting the first gets it written again.
+        content = rewrite_konopas_file(('1.0', None))
+        self.assertEqual(open(first, 'rb').read(), content)
+        self.assertTrue(gzip.GzipFile(fileobj=StringIO(content)).read().startswith('var program = '))
+    finally:
+      shutil.rmtree(root)
+
+class test_pdfs(AuthTest):
+  "The printed forms."
+  fixtures = [ 'demo_data' ]
+
+  def setUp(self):
+    self.mkroot()
+    self.client = Client()
+    self.logged_in_okay = self.client.login(username='congod', password='xxx')
+
+  def tearDown(self):
+    self.client.logout()
+    self.zaproot()
+
+  def fetch_pdf(self, name):
+    with CaptureQueriesContext(connection) as context:
+      self.response = self.client.get(reverse(name))
+    self.status_okay()
+    self.assertEqual(self.response['Content-Type'], 'application/pdf')
+    content = ''.join(self.response.streaming_content)
+    self.assertTrue(content.startswith('%PDF'))
+    self.assertEqual(int(self.response['Content-Length']), len(content))
+    return len(context)
+
+  def test_queries(self):
+    "The forms take the same number of queries, however many items there are."
+    before = [ self.fetch_pdf('drinks_forms'), self.fetch_pdf('name_cards') ]
+    disco = self.get_disco()
+    for n in range(3):
+      item = Item(title='Extra item %d' % (n,), start=disco.start, room=disco.room, visible=True)
+      item.save()
+      ItemPerson(item=item, person=self.get_buffy(), role=self.get_panellist()).save()
+    self.assertEqual([ self.fetch_pdf('drinks_forms'), self.fetch_pdf('name_cards') ], before)
+
+  def test_drinks_form_nobody(self):
+    "An item with nobody getting a drink still gets its drinks form."
+    disco = self.get_disco()
+    item = Item(title='Dry Run', start=disco.start, room=disco.room, visible=True)
+    item.save()
+    self.assertEqual([ (f['title'], f['people']) for f in drinks_forms(Item.objects.filter(id=item.id)) ],
+                     [ ('Dry Run', []) ])
+    self.response = self.client.get(reverse('drinks_form_for_item', args=[int(item.id)]))
+    self.status_okay()
+    self.assertTrue(''.join(self.response.streaming_content).startswith('%PDF'))
+
+  def test_door_listings(self):
+    "Door listings take the same number of queries, however many rooms and days there are."
+    before = self.fetch_pdf('door_listings')
+    for n in range(3):
+      Room(name='Extra room %d' % (n,), visible=True).save()
+    self.assertEqual(self.fetch_pdf('door_listings'), before)
+
+  def test_items_by_day_and_room(self):
+    disco = self.get_disco()
+    rooms = Room.objects.filter(visible=True)
+    days = ConDay.objects.filter(visible=True)
+    with self.assertNumQueries(3):
+      found = items_by_day_and_room(rooms, days)
+    self.assertEqual(len(found), rooms.count() * days.count())
+    for (day, room, items) in found:
+      self.assertEqual(disco in items, day == disco.start.day and room == disco.room)
+      self.assertEqual([ i.startMin for i in items ], sorted([ i.startMin for i in items ]))
+
+  def test_batches(self):
+    "A document rendered in batches is still one document."
+    from cStringIO import StringIO
+    forms = [ { "slot": "Friday 10:00", "room": "Room %d" % (n,), "title": "Item %d" % (n,),
+                "people": [ ("Buffy", True), ("Giles", False) ] } for n in range(5) ]
+    out = StringIO()
+    render_document(out, None, 'drinks_forms', forms, workers=2, batch_size=2)
+    self.assertTrue(out.getvalue().startswith('%PDF'))
+
+  def test_failed_batches(self):
+    "A batch that fails leaves no files behind, from it or any of the others."
+    from cStringIO import StringIO
+    forms = [ { "slot": "Friday 10:00", "room": "Room %d" % (n,), "title": "Item %d" % (n,),
+                "people": [] } for n in range(4) ] + [ {} ]
+    where = tempfile.mkdtemp()
+    (tempdir, tempfile.tempdir) = (tempfile.tempdir, where)
+    try:
+      self.assertRaises(TypeError, render_document, StringIO(), None, 'drinks_forms', forms, workers=2, batch_size=2)
+      self.assertEqual(os.listdir(where), [])
+    finally:
+      tempfile.tempdir = tempdir
+      shutil.rmtree(where)
+
+  def test_text_widths(self):
+    "Widths are measured once, and remembered."
+    pdf = StreampunkPdf(None, None)
+    style = pdf.styles['DrinksData']
+    widest = pdf.maxTextWidth([ '9:00', '10:00', '10:00' ], style)
+    self.assertTrue(widest > pdf.textWidth('9:00', style) > 0)
+    self.assertEqual(StreampunkPdf.widths[(style.fontName, style.fontSize, '10:00')], widest)
+    self.assertTrue(StreampunkPdf(None, None).styles is pdf.styles)
+
+class test_jobs(AuthTest):
+  "Making the big files in the background."
+  fixtures = [ 'demo_data' ]
+
+  def setUp(self):
+    self.mkroot()
+    self.client = Client()
+    self.logged_in_okay = self.client.login(username='congod', password='xxx')
+    self.root = tempfile.mkdtemp()
+    self.settings_override = override_settings(STREAMPUNK_EXPORT_DIR=self.root)
+    self.settings_override.enable()
+
+  def tearDown(self):
+    self.settings_override.disable()
+    shutil.rmtree(self.root)
+    self.client.logout()
+    self.zaproot()
+
+  def start(self, kind):
+    self.response = self.client.post(reverse('api_jobs', kwargs={ "kind": kind }))
+    self.status_okay()
+    return simplejson.loads(self.response.content)
+
+  def test_shared(self):
+    "Asking twice for the same thing gets the same job, until the programme changes."
+    job = self.start('door_listings')
+    self.assertEqual(job['status'], 'queued')
+    self.assertEqual(self.start('door_listings')['id'], job['id'])
+    disco = self.get_disco()
+    disco.title = 'Silent Disco'
+    disco.save()
+    self.assertNotEqual(self.start('door_listings')['id'], job['id'])
+
+  def test_run(self):
+    job = self.start('door_listings')
+    self.assertEqual(run_job(claim_job()).status, 'done')
+    self.assertEqual(claim_job(), None)
+    self.response = self.client.get(reverse('api_job', kwargs={ "pk": job['id'] }))
+    job = simplejson.loads(self.response.content)
+    self.assertEqual(job['progress'], 100)
+    self.response = self.client.get(job['url'])
+    self.status_okay()
+    self.assertTrue(''.join(self.response.streaming_content).startswith('%PDF'))
+
+  def test_stale(self):
+    "A job whose worker has gone quiet is queued again."
+    job = self.start('door_listings')
+    self.assertEqual(claim_job().id, job['id'])
+    self.assertEqual(claim_job(), None)
+    Job.objects.filter(id=job['id']).update(touched=datetime.now() - timedelta(hours=1))
+    self.assertEqual(self.start('door_listings')['status'], 'queued')
+    self.assertEqual(run_job(claim_job()).status, 'done')
+
+  def test_direct(self):
+    "The waiting page offers the file directly, if no worker gets to it."
+    self.response = self.client.get(reverse('make_artifact', kwargs={ "kind": "door_listings" }))
+    self.status_okay()
+    self.assertContains(self.response, reverse('door_listings'))
+
+  def test_unknown(self):
+    self.response = self.client.post(reverse('api_jobs', kwargs={ "kind": "nonesuch" }))
+    self.assertEqual(self.response.status_code, 404)
+
+class test_publish(NonauthTest):
+  "The static copy of the public programme."
+  fixtures = [ 'demo_data' ]
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def item_page(self, item):
+    return os.path.join(reverse('show_item_detail', kwargs={ "pk": item.id }).strip('/'), 'index.html')
+
+  def test_publish(self):
+    publisher = publish(self.root)
+    disco = self.get_disco()
+    self.assertTrue(self.item_page(disco) in publisher.written)
+    for path in publisher.written:
+      self.assertTrue(os.path.exists(os.path.join(self.root, path)))
+    grid = Grid.objects.all()[0]
+    page = open(os.path.join(self.root, reverse('show_grid', kwargs={ "gr": grid.id }).strip('/'), 'index.html')).read()
+    self.assertTrue('<html' in page)
+    xml = open(os.path.join(self.root, reverse('xml_dump').strip('/'), 'streampunk.xml')).read()
+    self.assertTrue(disco.title in xml)
+
+  def test_only_changes(self):
+    "A second build only writes what's changed."
+    publish(self.root)
+    self.assertEqual(publish(self.root).written, [])
+
+    disco = self.get_disco()
+    disco.title = 'Silent Disco'
+    disco.save()
+    publisher = publish(self.root)
+    self.assertTrue(self.item_page(disco) in publisher.written)
+    self.assertFalse(self.item_page(self.get_cabaret()) in publisher.written)
+    self.assertTrue('Silent Disco' in open(os.path.join(self.root, self.item_page(disco))).read())
+
+    cabaret = self.get_cabaret()
+    cabaret.visible = False
+    cabaret.save()
+    publisher = publish(self.root)
+    self.assertTrue(self.item_page(cabaret) in publisher.removed)
+    self.assertFalse(os.path.exists(os.path.join(self.root, self.item_page(cabaret))))
+
+  def test_kind_changed(self):
+    "Changing an item's kind writes its page again."
+    publish(self.root)
+    disco = self.get_disco()
+    disco.kind = ItemKind.objects.exclude(id=disco.kind_id)[0]
+    disco.save()
+    publisher = publish(self.root)
+    self.assertTrue(self.item_page(disco) in publisher.written)
+    self.assertFalse(self.item_page(self.get_cabaret()) in publisher.written)
+    self.assertTrue('<td>%s</td>' % (escape(disco.kind),) in open(os.path.join(self.root, self.item_page(disco))).read())
 
 class test_unicode_and_urls(AuthTest):
   "Prod the unicode/get-abs-url methods of classes where that's not normally exercised."
@@ -4943,6 +6021,18 @@ class test_fill_slot(AuthTest):
     # And it must have a mention of the Disco, because this page should be including all items.
     self.assertTrue('Disco' in self.response.content)
 
+  def test_form_marks_clashes(self):
+    "Items that would clash with what's already in the slot are marked."
+
+    disco = self.get_disco()
+    bidsession = self.get_bidsession()
+    args=[int(disco.room.id), int(disco.start.id)]
+    self.response = self.client.get(reverse('fill_slot_sched', args=args))
+    self.status_okay()
+    self.assertTrue('%s (clashes)' % (bidsession.title,) in self.response.content)
+    # Moving the disco onto itself isn't a clash.
+    self.assertFalse('%s (clashes)' % (disco.title,) in self.response.content)
+
   def test_post_form(self):
     "Check that we can move items here, by posting to this form."
 
@@ -5031,3 +6121,30 @@ class test_fill_slot(AuthTest):
 # 	XML Dump
 # 
 # 404 templates
+
+class test_synthetic(StreampunkTest):
+  "Generating made-up cons."
+
+  def test_generate(self):
+    "A generated con has what was asked for, and its rooms don't clash."
+    from .synthetic import ConGenerator
+    from .timeline import RoomOccupancy
+    made = ConGenerator(seed=1, items=200, people=50, rooms=12, things=20, bundles=3).generate()
+    self.assertEqual(made['items'], 200)
+    self.assertEqual(made['people'], 50)
+    self.assertEqual(made['rooms'], 12)
+    self.assertEqual(Item.objects.filter(shortname__startswith='Gen ').count(), 200)
+    self.assertTrue(made['scheduled'] > 0)
+    self.assertEqual(Item.scheduled.filter(shortname__startswith='Gen ').count(), made['scheduled'])
+    self.assertEqual(Room.objects.filter(name__startswith='Gen ', parent__isnull=False).count(), 4)
+    self.assertEqual(list(RoomOccupancy.build().clashes()), [])
+
+  def test_seeded(self):
+    "The same seed makes the same con."
+    from .synthetic import ConGenerator
+    ConGenerator(seed=2, items=30, people=10, rooms=6, prefix='One').generate()
+    ConGenerator(seed=2, items=30, people=10, rooms=6, prefix='Two').generate()
+    one = Item.objects.filter(shortname__startswith='One ').order_by('id')
+    two = Item.objects.filter(shortname__startswith='Two ').order_by('id')
+    self.assertEqual([ (i.title, i.start_id, i.length_id) for i in one ],
+                     [ (i.title, i.start_id, i.length_id) for i in two ])
@@ -0,0 +1,225 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Interval helpers for finding things that happen at the same time.
+
+An interval is a (start, end, thing) tuple. Start and end can be anything
+that compares sensibly - minutes, or (day, minutes) tuples - and intervals
+are half-open, so an item that finishes at 8pm doesn't overlap one that
+starts at 8pm. That matches Item.overlaps().
+"""
+
+import heapq
+from bisect import bisect_left
+
+from .models import Item, Room, KitBundle, slot_minute
+from .models import KitItemAssignment, KitRoomAssignment
+from .models import BundleItemAssignment, BundleRoomAssignment
+
+def item_period(item):
+  "Return the (start, end) of a scheduled item, comparable across days - its startMin and endMin."
+  return (item.startMin, item.endMin)
+
+def overlapping_pairs(intervals):
+  """
+  Yield (thingx, thingy) for every pair of intervals that overlap, once per pair.
+  Sweeps the intervals in start order, keeping a heap of the ones still running,
+  so the cost is O(n log n) plus the number of overlaps found.
+  """
+  active = []
+  ordered = sorted(intervals, key=lambda i: (i[0], i[1]))
+  for seq, (start, end, thing) in enumerate(ordered):
+    while active and active[0][0] <= start:
+      heapq.heappop(active)
+    for (_, _, other) in active:
+      yield (other, thing)
+    heapq.heappush(active, (end, seq, thing))
+
+class RoomOccupancy(object):
+  """
+  An index of the scheduled items in each room, for answering "what's already
+  in this room at this time?" Items are kept in start order per room, by their
+  startMin, so each lookup is a bisection rather than a scan, and items that
+  run past midnight clash with those early the next day. A booking in a room also
+  counts against the room's parents, so booking the whole of a divisible hall
+  clashes with anything booked in one of its sub-rooms (and vice versa), while
+  two sub-rooms of the same hall don't clash with each other.
+  """
+  def __init__(self, items, rooms):
+    self.rooms = dict((r.id, r) for r in rooms)
+    self.own = {}           # items booked in exactly this room
+    self.within = {}        # items booked in this room or any sub-room
+    for item in items:
+      if item.startMin is None:
+        continue
+      interval = (item.startMin, item.endMin, item)
+      self.own.setdefault(item.room_id, []).append(interval)
+      for rid in [ item.room_id ] + self.ancestors(item.room_id):
+        self.within.setdefault(rid, []).append(interval)
+    for index in (self.own, self.within):
+      for key, intervals in index.items():
+        intervals.sort(key=lambda i: (i[0], i[1]))
+        index[key] = (intervals,
+                      [ i[0] for i in intervals ],
+                      max(i[1] - i[0] for i in intervals))
+
+  @classmethod
+  def build(cls, snapshot=None):
+    "Build the index for all the scheduled items, from the database or a ProgrammeSnapshot."
+    if snapshot is not None:
+      return cls(snapshot.scheduled_items, snapshot.rooms)
+    return cls(Item.scheduled.all(), Room.objects.all())
+
+  def ancestors(self, rid):
+    "Return the ids of the room's parent, grandparent, etc."
+    found = []
+    room = self.rooms.get(rid)
+    while room is not None and room.parent_id and room.parent_id not in found and room.parent_id != rid:
+      found.append(room.parent_id)
+      room = self.rooms.get(room.parent_id)
+    return found
+
+  def _search(self, index, key, start, end):
+    entry = index.get(key)
+    if entry is None:
+      return []
+    intervals, starts, longest = entry
+    # Nothing that starts before start-longest can still be running at start.
+    lo = bisect_left(starts, start - longest)
+    hi = bisect_left(starts, end)
+    return [ i[2] for i in intervals[lo:hi] if i[1] > start ]
+
+  def overlapping(self, room, start, end, exclude=None):
+    """
+    Return the items that would clash with something in the room between
+    start and end (in slot_minute() terms). exclude is an item to ignore,
+    typically the one being moved.
+    """
+    rid = getattr(room, 'id', room)
+    found = self._search(self.within, rid, start, end)
+    for aid in self.ancestors(rid):
+      found.extend(self._search(self.own, aid, start, end))
+    exclude_id = getattr(exclude, 'id', exclude)
+    return [ i for i in found if i.id != exclude_id ]
+
+  def would_clash(self, item, room, slot):
+    "Returns true if moving the item to this room and slot would clash with anything."
+    start = slot_minute(slot)
+    return len(self.overlapping(room, start, start + item.length.length, exclude=item)) > 0
+
+  def clashes(self):
+    """
+    Yield (itemx, itemy, room) for each pair of items that clash in a
+    clashable room, in both orders. For a clash between a room and one of
+    its sub-rooms, the room reported is the parent.
+    """
+    for rid, (intervals, _, _) in self.own.items():
+      room = self.rooms[rid]
+      if room.canClash:
+        for (itemx, itemy) in overlapping_pairs(intervals):
+          yield (itemx, itemy, room)
+          yield (itemy, itemx, room)
+      for aid in self.ancestors(rid):
+        parent = self.rooms[aid]
+        if not parent.canClash:
+          continue
+        for (start, end, itemy) in intervals:
+          for itemx in self._search(self.own, aid, start, end):
+            yield (itemx, itemy, parent)
+            yield (itemy, itemx, parent)
+
+class KitOccupancy(object):
+  """
+  A timeline of when each KitThing is in use, whether assigned directly or as
+  part of a bundle, to an item or to a room. Times are the startMin and endMin
+  of the items and room assignments, so those that run over several days are
+  handled.
+  """
+  def __init__(self):
+    self.things = {}
+    self.uses = {}
+
+  def add(self, thing, start, end, assignment, room_id, item_id=None):
+    "Record that the thing is in use from start to end by this assignment."
+    if start is None:
+      # On the undefined day, so not in use at any particular time.
+      return
+    self.things[thing.id] = thing
+    self.uses.setdefault(thing.id, []).append((start, end, (assignment, room_id, item_id)))
+
+  @classmethod
+  def build(cls, snapshot=None):
+    """
+    Build the timeline from all kit and bundle assignments, either in a handful
+    of queries, or from a ProgrammeSnapshot. Only scheduled items count.
+    """
+    if snapshot is not None:
+      scheduled = snapshot.scheduled_ids
+      kias = [ a for a in snapshot.kit_item_assignments if a.item_id in scheduled ]
+      bias = [ a for a in snapshot.bundle_item_assignments if a.item_id in scheduled ]
+      kras = snapshot.kit_room_assignments
+      bras = snapshot.bundle_room_assignments
+      bundle_things = snapshot.bundle_things
+    else:
+      scheduled = Item.scheduled.all()
+      kias = KitItemAssignment.objects.filter(item__in=scheduled).select_related('thing', 'item')
+      bias = BundleItemAssignment.objects.filter(item__in=scheduled).select_related('item')
+      kras = KitRoomAssignment.objects.select_related('thing')
+      bras = BundleRoomAssignment.objects.all()
+      bundle_things = dict((b.id, list(b.things.all())) for b in KitBundle.objects.prefetch_related('things'))
+
+    occ = cls()
+    for a in kias:
+      occ.add(a.thing, a.item.startMin, a.item.endMin, a, a.item.room_id, a.item_id)
+    for a in bias:
+      for thing in bundle_things.get(a.bundle_id, []):
+        occ.add(thing, a.item.startMin, a.item.endMin, a, a.item.room_id, a.item_id)
+    for a in kras:
+      occ.add(a.thing, a.startMin, a.endMin, a, a.room_id)
+    for a in bras:
+      for thing in bundle_things.get(a.bundle_id, []):
+        occ.add(thing, a.startMin, a.endMin, a, a.room_id)
+    return occ
+
+  def clashes(self, thing=None):
+    """
+    Yield (assignmentx, assignmenty, thing) for each pair of concurrent uses
+    of the same thing. Item/item and room/room clashes come out in both
+    orders; room/item clashes come out as (room assignment, item assignment).
+    Using a thing in a room and on an item in that same room isn't a clash,
+    nor is using it twice on the same item, but assigning it to the same room
+    twice over the same period is.
+    """
+    tids = [ getattr(thing, 'id', thing) ] if thing is not None else self.uses.keys()
+    for tid in tids:
+      kit = self.things.get(tid)
+      for (x, y) in overlapping_pairs(self.uses.get(tid, [])):
+        (ax, roomx, itemx) = x
+        (ay, roomy, itemy) = y
+        if itemx is not None and itemy is not None:
+          if itemx != itemy:
+            yield (ax, ay, kit)
+            yield (ay, ax, kit)
+        elif itemx is None and itemy is None:
+          if type(ax) != type(ay) or ax.id != ay.id:
+            yield (ax, ay, kit)
+            yield (ay, ax, kit)
+        elif roomx == roomy:
+          continue
+        elif itemx is None:
+          yield (ax, ay, kit)
+        else:
+          yield (ay, ax, kit)
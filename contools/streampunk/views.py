@@ -13,13 +13,19 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import time
+import gzip
+import tempfile
+from cStringIO import StringIO
 from datetime import datetime, date
 
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, Http404, StreamingHttpResponse, HttpResponseBadRequest
 from django.core.urlresolvers import reverse
+from django.core.servers.basehttp import FileWrapper
 from django.core.mail import send_mail, EmailMultiAlternatives
 from django.template import RequestContext
-from django.shortcuts import render_to_response, redirect
+from django.shortcuts import render_to_response, redirect, get_object_or_404
 from django.template.loader import render_to_string
 from django.views.generic import DeleteView, DetailView, UpdateView, CreateView, ListView
 from django.forms.models import modelformset_factory
@@ -27,6 +33,10 @@ from django.contrib.auth.decorators import permission_required, login_required
 from django.db.models import Count, Sum
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
+from django.utils.decorators import method_decorator
+from django.utils.cache import patch_vary_headers
+from django.utils import simplejson
 
 from django_tables2 import RequestConfig
 from reportlab.pdfgen import canvas
@@ -46,7 +56,8 @@ from .tables import ItemPersonTable, KitBundleTable
 from .models import Item, Person, Room, Tag, ItemPerson, Grid, Slot, ConDay, ConInfoString, Check
 from .models import KitThing, KitBundle, KitItemAssignment, KitRoomAssignment, KitRequest, PersonList
 from .models import UserProfile, ItemKind, RoomCapacity, Gender, ConInfoBool, ConInfoInt, KitSatisfaction
-from .models import BundleRoomAssignment, BundleItemAssignment
+from .models import BundleRoomAssignment, BundleItemAssignment, programme_version
+from .models import change_version, parse_change_version, changes_between, Job
 from .forms import KitThingForm, KitBundleForm, KitRequestForm
 from .forms import ItemPersonForm, ItemTagForm, PersonTagForm, ItemForm, PersonForm
 from .forms import TagForm, RoomForm, CheckModelFormSet
@@ -55,10 +66,16 @@ from .forms import BundleItemAssignmentForm, BundleRoomAssignmentForm
 from .forms import KitItemAssignmentForm, KitRoomAssignmentForm
 from .forms import EmailForm, PersonListForm, UserProfileForm, UserProfileFullForm
 from .auth import add_con_groups
-from .tabler import Rower, Tabler, make_tabler
-from .pdf import StreampunkPdf
+from .tabler import Rower, Tabler, make_tabler, tabler_excludes
+from .printing import write_namecards, write_drinks_forms, write_door_listings
+from .problems import rebuild, results
 
 from .serializers import GridSerializer, GridItemSerializer, GridRoomSerializer
+from .gridmatrix import GridMatrix, fill_slots
+from .moves import move_items, clashes_for
+from .xmldump import xml_dump as dump_xml
+from .konopas import konopas_file, rewrite_konopas_file, konopas_delta
+from .jobs import job_for, artifacts
 
 # Some diagnostic code for debugging.
 # def show_request(request):
@@ -266,11 +283,12 @@ class show_room_detail(DetailView):
 def show_grid(request, gr):
   gid = int(gr)
   grid = Grid.objects.get(id = gid)
-  slots = grid.slots.all()
   if request.user.has_perm('streampunk.read_private'):
-    rooms = Room.objects.all();
+    matrix = GridMatrix(grid)
   else:
-    rooms = Room.objects.filter(visible=True);
+    matrix = GridMatrix(grid, rooms=Room.objects.filter(visible=True), public=True)
+  slots = matrix.slots
+  rooms = matrix.rooms
       
   return render_to_response('streampunk/show_grid.html',
                             locals(),
@@ -347,7 +365,8 @@ class show_item_detail(DetailView):
     context['biatable'] = make_tabler(BundleItemAssignment, BundleItemAssignmentTable, request=self.request,
                                       qs=context['bundleitems'], prefix='bia-', empty='No bundles assigned',
                                       extra_exclude=['item', 'room', 'day', 'time'])
-    context['missing_things'] = KitSatisfaction(self.object).missing_things()
+    # Leaves the satisfaction on the item, for the template to reuse.
+    context['missing_things'] = KitSatisfaction.for_items([ self.object ])[0].missing_things()
     return context
 
 class show_person_detail(DetailView):
@@ -850,7 +869,7 @@ def fill_slot_gen(request, r, s, cls, suf):
   slot = Slot.objects.get(id = sid)
   grid = slot.grid_set.all()[0]
   if request.method == 'POST':
-    form = cls(request.POST)
+    form = cls(request.POST, room=room, slot=slot)
     if form.is_valid():
       item = form.cleaned_data['item']
       item.room = room
@@ -858,7 +877,7 @@ def fill_slot_gen(request, r, s, cls, suf):
       item.save()
       return HttpResponseRedirect(reverse('show_grid', args=(grid.id,)))
   else:
-    form = cls()
+    form = cls(room=room, slot=slot)
   return render_to_response('streampunk/fill_slot.html',
                             locals(),
                             context_instance=RequestContext(request))
@@ -874,16 +893,11 @@ def list_checks(request):
   if request.method == 'POST':
     formset = CheckFormSet(request.POST)
     if formset.is_valid():
-      checkOutputs = []
-      for form in formset:
-        if form.cleaned_data['enable']:
-          check = form.instance
-          module = check.module
-          importcmd = "import streampunk.checks.%s" % (module,)
-          runcmd = "checkOutput = streampunk.checks.%s.run_check(check)" % (module,)
-          exec(importcmd)
-          exec(runcmd)
-          checkOutputs.append(checkOutput)
+      checks = [ form.instance for form in formset if form.cleaned_data['enable'] ]
+      if request.POST.has_key('rebuild'):
+        checkOutputs = rebuild(checks)
+      else:
+        checkOutputs = results(checks)
       return render_to_response('streampunk/checkresults.html',
                                 locals(),
                                 context_instance=RequestContext(request))
@@ -971,7 +985,12 @@ def list_items_filtered(request, extra_exclude):
     qs = Item.objects.all()
   else:
     qs = Item.objects.filter(visible = True)
-  table = make_tabler(Item, ItemTable, request=request, qs=qs, prefix='i-', empty='No items', extra_exclude=extra_exclude)
+  items = list(qs)
+  if 'satisfies_kit_requests' not in tabler_excludes(Item, request, extra_exclude):
+    # Work out the kit for all the rows at once, rather than row by row. It's
+    # left on each item for the kit column.
+    KitSatisfaction.for_items(items)
+  table = make_tabler(Item, ItemTable, request=request, qs=items, prefix='i-', empty='No items', extra_exclude=extra_exclude)
   return render(request, "streampunk/list_items.html", { "itable": table,
                                                          "verbose_name": 'item' })
 
@@ -1037,56 +1056,111 @@ def list_rooms_prog(request):
 def list_rooms_tech(request):
   return list_rooms_filtered(request, [ 'gridOrder', 'visible', 'isDefault', 'isUndefined', 'canClash', 'parent'])
 
-def xml_dump(request):
-  con_name = ConInfoString.objects.con_name()
-  if request.user.has_perm('streampunk.read_private'):
-    rooms = Room.objects.all()
-    allitems = Item.scheduled.all()
-    template = 'xml/streampunk.xml'
-  else:
-    rooms = Room.objects.filter(visible = True)
-    allitems = Item.scheduled.filter(visible = True, room__visible = True)
-    template = 'xml/streampunk_public.xml'
-  people = Person.objects.all()
+def request_version(request):
+  "The programme_version(), worked out once per request."
+  if not hasattr(request, '_programme_version'):
+    request._programme_version = programme_version()
+  return request._programme_version
+
+def programme_etag(request, *args, **kwargs):
+  "An ETag for a page made from the programme. Public and private pages differ, so they get different tags, as do deltas."
+  private = request.user.has_perm('streampunk.read_private')
+  tag = "%s-%s" % (request_version(request)[0], 'private' if private else 'public')
+  if 'since' in request.GET:
+    tag = "%s-since-%s" % (tag, request.GET['since'])
+  return tag
+
+def since_change(request):
+  """
+  The since=<version> a delta's been asked for, as given by change_version(),
+  or None for everything. Raises ValueError if it isn't a version.
+  """
+  if 'since' not in request.GET:
+    return None
+  parse_change_version(request.GET['since'])
+  return request.GET['since']
 
-  return render_to_response(template,
-                            { "rooms": rooms, "people": people, "items": allitems, "con_name": con_name },
-                            context_instance=RequestContext(request),
-                            content_type='application/xml')
+def programme_modified(request, *args, **kwargs):
+  return request_version(request)[1]
+
+# Pages that are polled over and over answer with a 304 if the programme
+# hasn't changed since the client last fetched them, before doing any work.
+programme_condition = condition(etag_func=programme_etag, last_modified_func=programme_modified)
+
+@programme_condition
+def xml_dump(request):
+  """
+  Stream the XML dump, private or public depending on who's asking. With
+  since=<version>, just what's changed since then.
+  """
+  try:
+    since = since_change(request)
+  except ValueError:
+    return HttpResponseBadRequest('since must be a version')
+  return StreamingHttpResponse(dump_xml(request.user.has_perm('streampunk.read_private'), since),
+                               content_type='application/xml')
 
 def xsl_stylesheet(request, template):
   return render_to_response(template, locals(), context_instance=RequestContext(request), content_type='text/xsl')
 
+@programme_condition
 def konopas(request):
-  items = Item.scheduled.filter(visible=True)
-  people = Person.objects.all()
-  return render_to_response('konopas/streampunk.json',
-                            { "items": items, "people": people },
-                            context_instance=RequestContext(request),
-                            content_type='application/json')
+  """
+  Serve the KonOpas JavaScript from the gzipped file written for the current
+  programme version, as it is if the client takes gzip. With
+  since=<version>, serve just what's changed since then, as JSON.
+  """
+  try:
+    since = since_change(request)
+  except ValueError:
+    return HttpResponseBadRequest('since must be a version')
+  if since is not None:
+    delta = konopas_delta(since, change_version())
+    return HttpResponse(simplejson.dumps(delta), content_type='application/json')
+  gzipped = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+  version = request_version(request)
+  try:
+    with open(konopas_file(version), 'rb') as f:
+      content = f.read()
+  except IOError:
+    # Newer versions have been written since, and this one's been removed
+    # before we could read it, so write it again, and send what was written.
+    content = rewrite_konopas_file(version)
+  if not gzipped:
+    content = gzip.GzipFile(fileobj=StringIO(content)).read()
+  response = HttpResponse(content, content_type='application/json')
+  if gzipped:
+    response['Content-Encoding'] = 'gzip'
+  patch_vary_headers(response, ('Accept-Encoding',))
+  return response
 
 
 # ----------------------------------------------------------------------------
 # PDF output
 # ----------------------------------------------------------------------------
 
-def pdf_response(filename):
-  "Create a response object to which we will write the PDF."
-  response = HttpResponse(content_type='application/pdf')
+# PDFs smaller than this are kept in memory until they're sent; bigger
+# ones go to a temporary file.
+pdf_spool_size = 1024 * 1024
+
+def pdf_response(filename, write):
+  """
+  Call write with a file to write the PDF to, and return a response that
+  streams it from there. The file's spooled, so a big PDF doesn't sit in
+  the web server's memory while it's made or sent.
+  """
+  spool = tempfile.SpooledTemporaryFile(max_size=pdf_spool_size)
+  write(spool)
+  size = spool.tell()
+  spool.seek(0)
+  response = StreamingHttpResponse(FileWrapper(spool), content_type='application/pdf')
+  response['Content-Length'] = size
   response['Content-Disposition'] = 'attachement; filename="%s"' % ( filename )
-  logo = ConInfoString.objects.con_logo_image_file()
-  return StreampunkPdf(response, logo)
+  return response
 
 def emit_namecards(items):
   "Emit namecards for the selected items."
-  pdf = pdf_response("namecards.pdf")
-  pdf.begin_namecards()
-  for item in items:
-    for ip in ItemPerson.objects.filter(item=item, role__namecard=True):
-      pdf.namecard(slot=item.start.startText, room=item.room.name, title=item.title,
-                   name=ip.person.as_badge(), is_mod=ip.role.is_moderator())
-  pdf.end_namecards()
-  return pdf.response
+  return pdf_response("namecards.pdf", lambda out: write_namecards(out, items))
 
 def name_cards_for_item(request, pk):
   "Emit name cards for all the people on this item."
@@ -1100,13 +1174,7 @@ def name_cards(request):
 
 def emit_drinks_forms(items):
   "Emit drinks forms for the selected items."
-  pdf = pdf_response("drinks.pdf")
-  pdf.begin_drinks_forms()
-  for item in items:
-    people = [ ( ip.person.as_badge(), ip.role.is_moderator() ) for ip in ItemPerson.objects.filter(item=item, role__drink=True) ]
-    pdf.drinksform(slot=str(item.start), room=item.room.name, title=item.title, people=people)
-  pdf.end_drinks_forms()
-  return pdf.response
+  return pdf_response("drinks.pdf", lambda out: write_drinks_forms(out, items))
 
 def drinks_form_for_item(request, pk):
   "Emit the drinks form for this item."
@@ -1120,15 +1188,8 @@ def drinks_forms(request):
 
 def emit_door_listings(rooms, days):
   "Emit door listings for the given rooms and days."
-  pdf = pdf_response("doors.pdf")
-  pdf.begin_door_listings()
-  for day in days:
-    for room in rooms:
-      items = [ (i.title, i.start.startText) for i in Item.objects.filter(room=room, visible=True, start__day=day) ]
-      pdf.door_listing(day.name, room.name, items)
-  pdf.end_door_listings()
-  return pdf.response
-  
+  return pdf_response("doors.pdf", lambda out: write_door_listings(out, rooms, days))
+
 def door_listing_for_room_and_day(request, rpk, dpk):
   "Emit the door listing for a given room, on a given day."
   return emit_door_listings(rooms=Room.objects.filter(id=int(rpk)), days=ConDay.objects.filter(id=int(dpk)))
@@ -1153,12 +1214,146 @@ class api_grid(APIView):
       return Grid.objects.get(pk=pk)
     except Grid.DoesNotExist:
       raise Http404
+  @method_decorator(programme_condition)
   def get(self, request, pk, format=None):
    obj = self.get_object(pk)
-   serializer = GridSerializer(obj)
+   serializer = GridSerializer(GridMatrix(obj, detail=True))
    return Response(serializer.data)
 
+class api_grid_moves(APIView):
+  """
+  Moves a batch of items at once, from a list of { "item", "room", "start" }
+  moves. Returns the grid as it now is, and the clashes of the moved items.
+  """
+  def get_object(self, pk):
+    try:
+      return Grid.objects.get(pk=pk)
+    except Grid.DoesNotExist:
+      raise Http404
+  def post(self, request, pk, format=None):
+    if not request.user.has_perm('streampunk.edit_programme'):
+      return Response({ 'non_field_errors': [u'No write access to Streampunk'] }, status=status.HTTP_401_UNAUTHORIZED)
+    grid = self.get_object(pk)
+    data = request.DATA
+    (moved, errors) = move_items(data.get('moves') if hasattr(data, 'get') else data)
+    if errors:
+      return Response({ 'non_field_errors': errors }, status=status.HTTP_400_BAD_REQUEST)
+    clashes = []
+    for (item, other, what) in clashes_for(moved):
+      kind = what._meta.module_name
+      clashes.append({ "item": item.id, "with": other.id, kind: what.id,
+                       "text": u"%s clashes with %s (%s)" % (item, other, what) })
+    return Response({ "moved": [ i.id for i in moved ],
+                      "clashes": clashes,
+                      "grid": GridSerializer(GridMatrix(grid, detail=True)).data })
+
+class api_changes(APIView):
+  """
+  The items that have changed since a version, so that a grid being edited
+  by several people at once can be kept up to date without fetching it all
+  again. Given ?since=V, returns the latest version (a change_version()),
+  the items changed since V as the grid API gives them, and the ids of those
+  deleted. If it can't tell which items have changed - a person's been taken
+  off an item, a slot's been moved, or anything else has changed that
+  ChangeLog doesn't describe (see change_version()) - reload is set, and the
+  client should fetch the whole grid again. Without since, just the latest
+  version is returned.
+
+  Given ?grid=G, only the changed items on grid G are returned; the ids of
+  those that have changed but aren't on it - moved to another day, say - are
+  in elsewhere, for the client to take off the grid.
+
+  Given ?wait=S as well, waits up to S seconds (no more than max_wait) for
+  something to change before answering. The web server's worker is tied up
+  all the while, so clients should poll without it unless there are workers
+  to spare.
+
+  A ChangeLog row can be committed after one with a higher id, so a client
+  should ask from a few ids before the last version it saw (lowering the
+  part before the dot), rather than from it exactly, and expect to be sent
+  some items again.
+  """
+  max_wait = 5
+
+  def get(self, request, format=None):
+    try:
+      since = request.GET.get('since')
+      if since is not None:
+        parse_change_version(since)
+      wait = min(int(request.GET.get('wait', 0)), self.max_wait)
+      grid = Grid.objects.get(id=int(request.GET['grid'])) if 'grid' in request.GET else None
+    except ValueError:
+      return Response({ 'non_field_errors': [u'since must be a version, and wait and grid numbers'] }, status=status.HTTP_400_BAD_REQUEST)
+    except Grid.DoesNotExist:
+      raise Http404
+    version = change_version()
+    if since is None:
+      return Response({ "version": version, "items": [], "deleted": [], "elsewhere": [], "reload": False })
+    waited = 0
+    while version == since and waited < wait:
+      time.sleep(1)
+      waited += 1
+      version = change_version()
+
+    changes = changes_between(since, version)
+    wanted = changes.items
+    elsewhere = set()
+    if grid is not None:
+      wanted = changes.items & set(grid.item_ids())
+      elsewhere = changes.items - wanted
+    items = list(Item.objects.filter(id__in=wanted).prefetch_related('people'))
+    fill_slots(items)
+    return Response({ "version": version,
+                      "items": GridItemSerializer(items, many=True).data,
+                      "deleted": sorted(changes.deleted),
+                      "elsewhere": sorted(elsewhere),
+                      "reload": changes.reload })
+
+class api_jobs(APIView):
+  """
+  Starts making an artifact (see jobs.py) in the background, from the
+  programme as it now is, or joins the job that's already making it. Returns
+  the job, for polling with api_job.
+  """
+  def post(self, request, kind, format=None):
+    if kind not in artifacts:
+      raise Http404
+    return Response(job_for(kind, request.user.has_perm('streampunk.read_private')).as_dict())
+
+class api_job(APIView):
+  "How a background job is getting on, and where to fetch its file once it's done."
+  def get(self, request, pk, format=None):
+    try:
+      job = Job.objects.get(pk=pk)
+    except Job.DoesNotExist:
+      raise Http404
+    return Response(job.as_dict())
+
+def job_file(request, pk):
+  "Send the file a background job has made."
+  job = get_object_or_404(Job, pk=pk, status='done')
+  if job.private and not request.user.has_perm('streampunk.read_private'):
+    raise Http404
+  (filename, content_type, varies, render) = artifacts[job.kind]
+  try:
+    f = open(job.path, 'rb')
+  except IOError:
+    raise Http404
+  response = StreamingHttpResponse(FileWrapper(f), content_type=content_type)
+  response['Content-Length'] = os.path.getsize(job.path)
+  response['Content-Disposition'] = 'attachment; filename="%s"' % (filename,)
+  return response
+
+def make_artifact(request, kind):
+  "A page that starts a background job, shows how it's getting on, and fetches the file when it's done."
+  if kind not in artifacts:
+    raise Http404
+  return render_to_response('streampunk/make_artifact.html',
+                            { "kind": kind, "filename": artifacts[kind][0], "direct_url": reverse(kind) },
+                            context_instance=RequestContext(request))
+
 class api_rooms(APIView):
+  @method_decorator(programme_condition)
   def get(self, request, format=None):
     objs = Room.objects.all()
     serializer = GridRoomSerializer(objs, many=True)
@@ -1170,6 +1365,7 @@ class api_item(APIView):
       return Item.objects.get(pk=pk)
     except Item.DoesNotExist:
       raise Http404
+  @method_decorator(programme_condition)
   def get(self, request, pk, format=None):
     obj = self.get_object(pk)
     serializer = GridItemSerializer(obj)
@@ -1192,7 +1388,10 @@ class api_slot_items(APIView):
       return Slot.objects.get(pk=pk)
     except Slot.DoesNotExist:
       raise Http404
+  @method_decorator(programme_condition)
   def get(self, request, pk, format=None):
     obj = self.get_object(pk)
-    serializer = GridItemSerializer(obj.items(), many=True)
+    items = list(obj.items_on().prefetch_related('people'))
+    fill_slots(items)
+    serializer = GridItemSerializer(items, many=True)
     return Response(serializer.data)
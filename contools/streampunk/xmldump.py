@@ -0,0 +1,112 @@
+# This file is part of Streampunk, a Django application for convention programmes
+# Copyright (C) 2012-2014 Stephen Kilbane
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The XML dump, written out as it's sent rather than built up in memory first.
+
+Rooms, people and items are fetched a chunk at a time, with everything their
+templates use - tags, availability, capacities, kit, and the items' people -
+loaded alongside them, so that each chunk takes a fixed number of queries.
+Each template is loaded once, and the nested ones (tags, kit things and so
+on) are pulled in with {% include %}, rather than rendered separately.
+"""
+
+from django.template import Context
+from django.template.loader import get_template, render_to_string
+
+from .models import Room, Person, Item, ItemPerson, ConInfoString, change_version, changes_between
+from .problems import chunks
+
+# What a kit thing's template needs, under whatever it's reached through.
+kit_lookups = [ 'kind', 'role', 'source', 'department', 'basis', 'status', 'availability__day' ]
+
+def kit(path):
+  return [ "%s__%s" % (path, k) for k in kit_lookups ]
+
+room_related = [ 'capacities__layout', 'availability__day' ] + kit('kit') + kit('bundles__things')
+person_related = [ 'tags', 'availability__day' ]
+item_select = [ 'start__day', 'length', 'kind', 'seating', 'frontLayout', 'mediaStatus', 'revision', 'room', 'follows' ]
+item_related = [ 'tags', 'kitRequests__kind', 'kitRequests__status' ] + kit('kit') + kit('bundles__things')
+
+def fetch(qs, select, prefetch, size):
+  """
+  Yield the objects in qs, in order, a chunk of size at a time, with the
+  select and prefetch lookups loaded.
+  """
+  ids = list(qs.values_list('id', flat=True))
+  loaded = qs.select_related(*select).prefetch_related(*prefetch)
+  for chunk in chunks(ids, size):
+    found = loaded.in_bulk(chunk)
+    yield [ found[oid] for oid in chunk if oid in found ]
+
+def load_itempeople(items):
+  "Fill in the items' itempeople() with one query."
+  by_id = dict((i.id, i) for i in items)
+  for i in items:
+    i._itempeople = []
+  for ip in ItemPerson.objects.filter(item__in=by_id.keys()).select_related('person', 'role', 'status').order_by('id'):
+    ip.item = by_id[ip.item_id]
+    ip.item._itempeople.append(ip)
+
+def xml_dump(private, since=None, size=500):
+  """
+  Yield the XML dump, a piece at a time. The private dump has everything; the
+  public one only has the visible rooms, and the visible items in them.
+
+  The dump gives the change_version() it was made from. Given since, an
+  earlier one, only the items and people that have changed since then are
+  included, and no rooms. What's been deleted (or, for the public dump, is
+  no longer shown) is listed by id at the end.
+  """
+  suffix = '' if private else '_public'
+  if private:
+    rooms = Room.objects.all()
+    items = Item.scheduled.all()
+  else:
+    rooms = Room.objects.filter(visible=True)
+    items = Item.scheduled.filter(visible=True, room__visible=True)
+  people = Person.objects.all()
+
+  # The version's read first, so anything that changes while the dump is
+  # being made is sent again in the next delta.
+  upto = change_version()
+  head = { "con_name": ConInfoString.objects.con_name(), "version": upto, "delta": since is not None }
+  if since is not None:
+    changes = changes_between(since, upto)
+    rooms = rooms.none()
+    items = items.filter(id__in=list(changes.items))
+    people = people.filter(id__in=list(changes.people))
+    head.update({ "since": since, "reload": changes.reload })
+  yield render_to_string('xml/streampunk_head.xml', head)
+
+  sections = [ ('rooms', 'r', 'room', rooms, [ 'parent' ], room_related),
+               ('people', 'p', 'person', people, [ 'gender' ], person_related),
+               ('items', 'i', 'item', items, item_select, item_related) ]
+  shown = set()
+  for (section, var, name, qs, select, prefetch) in sections:
+    template = get_template('xml/%s%s.xml' % (name, suffix))
+    yield u"<%s>\n" % (section,)
+    for objs in fetch(qs, select, prefetch, size):
+      if name == 'item':
+        load_itempeople(objs)
+        shown.update([ i.id for i in objs ])
+      yield u"".join([ template.render(Context({ var: obj })) + u"\n" for obj in objs ])
+    yield u"</%s>\n" % (section,)
+
+  if since is not None:
+    yield render_to_string('xml/deleted.xml', { "items": sorted(changes.deleted | (changes.items - shown)),
+                                                "people": sorted(changes.deleted_people),
+                                                "itempeople": sorted(changes.deleted_itempeople) })
+  yield u"</streampunk>\n"